@@ -0,0 +1,1212 @@
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import types
+
+
+class FakeUSBWatchDog(object):
+    # Registers and status of a USB Watchdog, counting the transfers made to it
+
+    def __init__(self, serial_number='FAKE0000000000000000'):
+        self.serial_number = serial_number
+        self.registers = {
+            0x1: [1, 0],
+            0x2: [ord(c) for c in serial_number],
+            0x3: [30, 0],
+            0x4: [30, 0],
+            0x5: [0x3],
+            0x6: [0x3],
+            0x7: [100],
+            0x8: [100],
+            0x9: [0x1],
+            0xA: [0x0],
+        }
+        self.status_flags = 0x2
+        self.counter = 0
+        # Status reports waiting to be read, the time between new ones, and whether they stopped
+        self.queued = 0
+        self.report_interval = 0.01
+        self.silent = False
+        self.plugged = True
+        self.writes = []
+        self.transfers = 0
+
+
+class FakeHIDDevice(object):
+    # The hid.device interface over the FakeUSBWatchDog models in fake_hid.devices
+
+    def __init__(self):
+        self.model = None
+        self.nonblocking = False
+
+    def open(self, vendor_id, product_id, serial_number=None):
+        for model in fake_hid.devices:
+            if model.plugged and serial_number in (None, model.serial_number):
+                self.model = model
+                return
+        raise IOError('open failed')
+
+    def close(self):
+        self.model = None
+
+    def transfer(self):
+        if not self.model.plugged:
+            raise IOError('device disconnected')
+        self.model.transfers += 1
+
+    def get_feature_report(self, fr_id, length):
+        self.transfer()
+        return ([fr_id] + self.model.registers[fr_id])[:length]
+
+    def send_feature_report(self, array):
+        self.transfer()
+        if array[0] == 0x9:
+            self.model.registers[0x9] = [0x0]
+        else:
+            self.model.registers[array[0]] = list(array[1:])
+        return len(array)
+
+    def set_nonblocking(self, val):
+        self.nonblocking = bool(val)
+        return 0
+
+    def read(self, length, timeout=0):
+        self.transfer()
+        if self.model.queued:
+            self.model.queued -= 1
+        elif self.nonblocking:
+            return []
+        elif self.model.silent:
+            time.sleep(timeout / 1000.0)
+            return []
+        else:
+            time.sleep(self.model.report_interval)
+        counter = self.model.counter
+        return [0x1, self.model.status_flags, counter % 256, counter // 256][:length]
+
+    def write(self, array):
+        self.transfer()
+        self.model.writes.append(list(array))
+        return len(array)
+
+
+# usb_watchdog imports hidapi on first use
+fake_hid = types.ModuleType('hid')
+fake_hid.device = FakeHIDDevice
+fake_hid.devices = []
+sys.modules['hid'] = fake_hid
+import usb_watchdog
+from usb_watchdog import USBWatchDog
+
+
+def open_fake(**kwargs):
+    model = FakeUSBWatchDog()
+    fake_hid.devices[:] = [model]
+    return model, USBWatchDog(**kwargs)
+
+
+def count_transfers(model, function, *args):
+    before = model.transfers
+    result = function(*args)
+    return result, model.transfers - before
+
+
+def test_cache_serves_written_values():
+    model, watchdog = open_fake(cache=True)
+    try:
+        assert watchdog.get_volatile_timeout() == 30
+        watchdog.set_volatile_timeout(20)
+        watchdog.set_volatile_pinglight(False)
+        assert count_transfers(model, watchdog.get_volatile_timeout) == (20, 0)
+        assert count_transfers(model, watchdog.get_volatile_pinglight) == (False, 0)
+        assert model.registers[USBWatchDog.FR_VOLATILE_TIMEOUT] == [20, 0]
+    finally:
+        watchdog.close()
+
+
+def test_cache_invalidation_reads_the_device_again():
+    model, watchdog = open_fake(cache=True)
+    try:
+        watchdog.get_volatile_timeout()
+        model.registers[USBWatchDog.FR_VOLATILE_TIMEOUT] = [10, 0]
+        assert count_transfers(model, watchdog.get_volatile_timeout) == (30, 0)
+        watchdog.invalidate(USBWatchDog.FR_VOLATILE_TIMEOUT)
+        assert count_transfers(model, watchdog.get_volatile_timeout) == (10, 1)
+    finally:
+        watchdog.close()
+
+
+def test_reboot_indicator_is_not_cached_as_written():
+    model, watchdog = open_fake(cache=True)
+    try:
+        assert watchdog.get_reboot_indicator() is True
+        watchdog.set_reboot_indicator()
+        assert count_transfers(model, watchdog.get_reboot_indicator) == (False, 1)
+    finally:
+        watchdog.close()
+
+
+def test_uncached_reads_the_device_every_time():
+    model, watchdog = open_fake()
+    try:
+        watchdog.set_volatile_timeout(20)
+        assert count_transfers(model, watchdog.get_volatile_timeout) == (20, 1)
+        assert count_transfers(model, watchdog.get_volatile_timeout) == (20, 1)
+    finally:
+        watchdog.close()
+
+
+def test_apply_reads_packed_register_once():
+    model, watchdog = open_fake()
+    try:
+        reports, transfers = count_transfers(model, watchdog.apply, {'pinglight': False, 'buzzer': False})
+        assert reports == [[USBWatchDog.FR_VOLATILE_PINGLIGHT_BUZZER, 0x0]]
+        assert transfers == 2
+        assert model.registers[USBWatchDog.FR_VOLATILE_PINGLIGHT_BUZZER] == [0x0]
+    finally:
+        watchdog.close()
+
+
+def test_apply_skips_writes_that_change_nothing():
+    model, watchdog = open_fake()
+    try:
+        config = {'timeout': 30, 'pinglight': True, 'buzzer': True, 'buzzer_frequency': 100}
+        reports, transfers = count_transfers(model, watchdog.apply, config)
+        assert reports == []
+        assert transfers == 3
+    finally:
+        watchdog.close()
+
+
+def test_cached_apply_reads_nothing_twice():
+    model, watchdog = open_fake(cache=True)
+    try:
+        watchdog.apply({'timeout': 20, 'pinglight': False})
+        reports, transfers = count_transfers(model, watchdog.apply, {'timeout': 20, 'pinglight': False})
+        assert reports == []
+        assert transfers == 0
+    finally:
+        watchdog.close()
+
+
+def test_transaction_commits_with_one_apply():
+    model, watchdog = open_fake()
+    try:
+        with watchdog.transaction() as transaction:
+            transaction.set_volatile_timeout(20)
+            transaction.set_volatile_buzzer(False)
+            transaction.set_reboot_indicator()
+            assert model.writes == [] and model.registers[USBWatchDog.FR_VOLATILE_TIMEOUT] == [30, 0]
+        assert model.registers[USBWatchDog.FR_VOLATILE_TIMEOUT] == [20, 0]
+        assert model.registers[USBWatchDog.FR_VOLATILE_PINGLIGHT_BUZZER] == [USBWatchDog.PINGLIGHT_BIT]
+        assert model.registers[USBWatchDog.FR_REBOOT_INDICATOR] == [0x0]
+    finally:
+        watchdog.close()
+
+
+def pet_at(scheduler, start, now=None):
+    # Runs the scheduler as if the pet started at start and finished at now
+    if scheduler.deadline is None:
+        scheduler.deadline = start
+    scheduler.petted(start, start if now is None else now)
+
+
+def test_scheduler_keeps_phase_when_skipping_missed_pets(capsys):
+    scheduler = usb_watchdog.PetScheduler(1.0, jitter_budget=0.25)
+    pet_at(scheduler, 100.0)
+    assert scheduler.deadline == 101.0
+    pet_at(scheduler, 101.1)
+    assert (scheduler.deadline, scheduler.missed) == (102.0, 0)
+    # Late by more than the jitter budget, with the next two deadlines already gone
+    pet_at(scheduler, 104.5)
+    assert (scheduler.deadline, scheduler.missed) == (105.0, 1)
+    assert 'pet was 2.500 seconds late' in capsys.readouterr().out
+
+
+def test_scheduler_reset_restarts_from_the_late_pet():
+    scheduler = usb_watchdog.PetScheduler(1.0, jitter_budget=0.25, missed_deadline='reset')
+    pet_at(scheduler, 100.0)
+    pet_at(scheduler, 102.7)
+    assert (scheduler.deadline, scheduler.missed) == (103.7, 1)
+
+
+def test_scheduler_warns_about_slack_against_device_timeout(capsys):
+    scheduler = usb_watchdog.PetScheduler(1.0, device_timeout=5, slack_warning=1.0)
+    pet_at(scheduler, 100.0)
+    pet_at(scheduler, 101.0, 103.5)
+    assert 'Warning: pet landed' not in capsys.readouterr().out
+    pet_at(scheduler, 104.0, 108.2)
+    assert 'pet landed 0.300 seconds before the USB Watchdog timeout' in capsys.readouterr().out
+    # A longer timeout takes effect from the next pet
+    scheduler.device_timeout = 10
+    pet_at(scheduler, 109.0, 116.0)
+    assert 'Warning: pet landed' not in capsys.readouterr().out
+
+
+def test_fast_petting_takes_beacon_mode_from_the_status():
+    model, watchdog = open_fake(cache=True)
+    try:
+        # Beacon mode is configured but not in effect until the USB Watchdog reboots
+        watchdog.set_nonvolatile_beacon_mode(True)
+        usb_watchdog.handle_fast_petting(watchdog)
+        model.queued = 3
+        usb_watchdog.handle_fast_petting(watchdog)
+        assert model.queued == 0
+        assert model.writes == [[USBWatchDog.OUT_PET_WATCHDOG, 0x3]] * 2
+
+        model.status_flags |= USBWatchDog.WATCHDOG_IN_NONVOLATILE_BEACON_MODE_BIT
+        try:
+            usb_watchdog.handle_fast_petting(watchdog)
+        except usb_watchdog.USBWatchDogError as e:
+            assert e.error_number == 1
+        else:
+            assert False, 'a USB Watchdog in beacon mode was pet'
+        assert len(model.writes) == 2
+    finally:
+        watchdog.close()
+
+
+def test_poll_status_returns_the_newest_queued_report():
+    model, watchdog = open_fake()
+    try:
+        assert watchdog.poll_status() is None
+        model.queued = 2
+        model.counter = 7
+        assert watchdog.poll_status() == (False, True, False, 7)
+        assert model.queued == 0
+        assert watchdog.poll_status(timeout=100) == (False, True, False, 7)
+    finally:
+        watchdog.close()
+
+
+def test_status_reader_keeps_the_newest_sample():
+    model, watchdog = open_fake()
+    try:
+        watchdog.start_status_reader(max_age=1.0, poll_timeout=50)
+        model.counter = 5
+        assert watchdog.get_status(timeout=1000) == (False, True, False, 5)
+        model.counter = 6
+        time.sleep(0.1)
+        assert watchdog.poll_status() == (False, True, False, 6)
+    finally:
+        watchdog.close()
+
+
+def test_status_reader_expires_stale_samples():
+    model, watchdog = open_fake()
+    try:
+        watchdog.start_status_reader(max_age=0.05, poll_timeout=20)
+        assert watchdog.get_status(timeout=1000) is not None
+        model.silent = True
+        time.sleep(0.2)
+        assert watchdog.poll_status() is None
+        try:
+            watchdog.get_status(timeout=50)
+        except IOError:
+            pass
+        else:
+            assert False, 'a stale sample was returned'
+        # A timeout waits for the reader to bring a fresh sample
+        threading.Timer(0.05, setattr, (model, 'silent', False)).start()
+        assert watchdog.poll_status(timeout=1000) == (False, True, False, 0)
+    finally:
+        watchdog.close()
+
+
+def test_status_reader_stops_cleanly():
+    model, watchdog = open_fake()
+    watchdog.start_status_reader(max_age=1.0, poll_timeout=20)
+    reader = watchdog._reader
+    watchdog.stop_status_reader()
+    assert not reader.is_alive()
+    assert watchdog._reader is None
+    transfers = model.transfers
+    time.sleep(0.05)
+    assert model.transfers == transfers
+    watchdog.start_status_reader(max_age=1.0, poll_timeout=20)
+    reader = watchdog._reader
+    watchdog.close()
+    assert not reader.is_alive()
+
+
+def test_fleet_reports_every_device_status(capsys):
+    args = usb_watchdog.build_parser().parse_args(['fleet', '--timeout', '20'])
+    models = [FakeUSBWatchDog('FAKE%016d' % i) for i in range(3)]
+    models[1].counter = 9
+    models[2].status_flags |= USBWatchDog.WATCHDOG_IN_TIMEOUT_BIT
+    fake_hid.devices[:] = models
+    members = [usb_watchdog.FleetMember(model.serial_number, args) for model in models]
+    for member in members:
+        member.thread.start()
+    try:
+        deadline = time.time() + 5
+        while not all(member.scheduler is not None and member.scheduler.pets for member in members):
+            assert time.time() < deadline, 'the fleet was not pet'
+            time.sleep(0.01)
+        assert [member.status() for member in members] == [(False, True, 0), (False, True, 9), (True, True, 0)]
+        for member in members:
+            member.report()
+        out = capsys.readouterr().out
+        assert 'FAKE0000000000000001: 1 pets, 0 missed deadlines, triggered: False, ' \
+                'reboot indicator: True, counter: 9' in out
+        assert 'FAKE0000000000000002: 1 pets, 0 missed deadlines, triggered: True' in out
+    finally:
+        for member in members:
+            member.stop()
+        for member in members:
+            member.thread.join()
+    for model in models:
+        assert model.registers[USBWatchDog.FR_VOLATILE_TIMEOUT] == [20, 0]
+        assert model.writes[0] == [USBWatchDog.OUT_PET_WATCHDOG, 0x3]
+    assert [member.error_number for member in members] == [None] * 3
+    assert [member.status() for member in members] == [None] * 3
+
+
+def test_reconnect_restores_volatile_settings():
+    model, watchdog = open_fake()
+    watchdog.close()
+    manager = usb_watchdog.USBWatchDogManager(status_max_age=1.0, max_delay=0.05)
+    try:
+        with manager.transaction() as transaction:
+            transaction.set_volatile_timeout(20)
+            transaction.set_volatile_pinglight(False)
+            transaction.set_volatile_buzzer(False)
+            transaction.set_nonvolatile_timeout(40)
+
+        # The USB Watchdog comes back with its volatile settings reset after a few failed attempts
+        model.plugged = False
+        replugged = FakeUSBWatchDog(model.serial_number)
+        replugged.plugged = False
+        fake_hid.devices[:] = [replugged]
+        threading.Timer(0.1, setattr, (replugged, 'plugged', True)).start()
+        manager.reconnect()
+
+        assert manager.reconnects == 1
+        assert replugged.registers[USBWatchDog.FR_VOLATILE_TIMEOUT] == [20, 0]
+        assert replugged.registers[USBWatchDog.FR_VOLATILE_PINGLIGHT_BUZZER] == [0x0]
+        assert replugged.registers[USBWatchDog.FR_NONVOLATILE_TIMEOUT] == [30, 0]
+        assert manager.get_volatile_timeout() == 20
+        assert manager.poll_status(timeout=1000) is not None
+    finally:
+        manager.close()
+
+
+class StubCheck(usb_watchdog.HealthCheck):
+    # A health check that only runs when the test asks, finishing at once with the outcome it sets
+    def __init__(self, name):
+        usb_watchdog.HealthCheck.__init__(self, name, interval=3600)
+        self.outcome = True
+
+    def check(self):
+        return self.outcome
+
+
+def run_checks(monitor, runs=1):
+    for _ in range(runs):
+        for check in monitor.checks:
+            check._due = 0
+            check.poll(usb_watchdog.monotonic())
+        deadline = time.time() + 5
+        while any(check._started is not None for check in monitor.checks):
+            assert time.time() < deadline, 'a health check did not finish'
+            time.sleep(0.001)
+
+
+def test_health_monitor_stops_petting_at_the_failure_threshold(capsys):
+    good, bad = StubCheck('good'), StubCheck('bad')
+    monitor = usb_watchdog.HealthMonitor([good, bad], failure_threshold=3)
+    run_checks(monitor)
+    assert monitor.healthy()
+    bad.outcome = False
+    run_checks(monitor, 2)
+    assert monitor.healthy()
+    run_checks(monitor)
+    assert not monitor.healthy()
+    assert not monitor.healthy()
+    run_checks(monitor, 5)
+    assert not monitor.healthy()
+    bad.outcome = True
+    run_checks(monitor)
+    assert monitor.healthy()
+    out = capsys.readouterr().out
+    assert out.count('Not petting USB Watchdog while health checks fail: bad') == 1
+    assert out.count('Health checks recovered') == 1
+
+
+def test_parser_checks_ranges_and_tcp_addresses(capsys):
+    parser = usb_watchdog.build_parser()
+    args = parser.parse_args(['continuous', '--check-tcp', '[::1]:80', '--check-tcp', 'localhost:22',
+            '--check-failure-threshold', '5'])
+    assert args.check_tcp == [('::1', 80), ('localhost', 22)]
+    assert args.check_failure_threshold == 5
+    for argv in (['--check-failure-threshold', '0'], ['--check-tcp', '[::1]']):
+        try:
+            parser.parse_args(['continuous'] + argv)
+        except SystemExit:
+            pass
+        else:
+            assert False, 'accepted ' + ' '.join(argv)
+        assert 'argument ' + argv[0] in capsys.readouterr().err
+
+
+def test_simulated_watchdog_triggers_and_is_pet():
+    transport = usb_watchdog.SimulatedTransport(2, timeout=10, report_interval=0.01)
+    model = transport.devices[1]
+    watchdog = USBWatchDog(model.serial_number, transport=transport)
+    try:
+        assert watchdog.get_serial_number() == 'SIM00000000000000001'
+        assert watchdog.get_status(timeout=1000)[:3] == (False, True, False)
+        model.last_pet -= 11
+        assert watchdog.get_status(timeout=1000) == (True, True, False, 11)
+        # A pet restarts the countdown and clears the alarm
+        watchdog.pet()
+        assert watchdog.get_status(timeout=1000) == (False, True, False, 0)
+        model.connected = False
+        try:
+            watchdog.get_volatile_timeout()
+        except IOError:
+            pass
+        else:
+            assert False, 'a disconnected USB Watchdog answered'
+    finally:
+        watchdog.close()
+
+
+def test_bench_times_every_operation():
+    transport = usb_watchdog.SimulatedTransport(report_interval=0.005)
+    watchdog = USBWatchDog(cache=True, transport=transport)
+    try:
+        results = usb_watchdog.run_benchmark(watchdog, iterations=2, jitter_pets=3, jitter_interval=0.01)
+    finally:
+        watchdog.close()
+    json.dumps(results)
+    for name in ('get_volatile_timeout', 'pet', 'print_settings_cached', 'handle_petting_detect_reader'):
+        stats = results['operations'][name]
+        assert 0 <= stats['p50'] <= stats['max']
+    assert results['pet_jitter']['interval'] == 0.01
+    assert set(results['pet_jitter']['lateness']) >= set(['p50', 'p99', 'max', 'mean'])
+
+
+def test_metrics_render_each_device(tmp_path):
+    first, second = usb_watchdog.PetMetrics('SIM1', timeout=30), usb_watchdog.PetMetrics('SIM2')
+    first.petted(0.003)
+    first.petted(2.0)
+    first.sampled((False, True, False, 10))
+    second.skipped = 4
+    path = str(tmp_path / 'usb_watchdog.prom')
+    usb_watchdog.write_metrics_textfile(path, [first, second])
+    with open(path) as f:
+        text = f.read()
+    lines = text.splitlines()
+    assert 'usb_watchdog_pets_total{serial_number="SIM1"} 2.0' in lines
+    assert 'usb_watchdog_skipped_pets_total{serial_number="SIM2"} 4.0' in lines
+    assert 'usb_watchdog_pet_latency_seconds_bucket{serial_number="SIM1",le="0.005"} 1.0' in lines
+    assert 'usb_watchdog_pet_latency_seconds_bucket{serial_number="SIM1",le="+Inf"} 2.0' in lines
+    assert 'usb_watchdog_counter{serial_number="SIM1"} 10.0' in lines
+    assert lines.count('# TYPE usb_watchdog_pets_total counter') == 1
+    remaining = float(text.split('remaining_timeout_seconds{serial_number="SIM1"} ')[1].split()[0])
+    assert 19 < remaining <= 20
+    assert 'usb_watchdog_remaining_timeout_seconds{serial_number="SIM2"}' not in text
+
+
+def test_snapshot_reads_every_register_once():
+    transport = usb_watchdog.SimulatedTransport(timeout=45, report_interval=0.01)
+    model = transport.devices[0]
+    watchdog = USBWatchDog(transport=transport)
+    try:
+        before = model.transfers
+        snapshot = watchdog.snapshot(status=False)
+        assert model.transfers - before == len(USBWatchDog.FEATURE_REPORTS)
+        assert (snapshot.nonvolatile_timeout, snapshot.volatile_timeout) == (45, 45)
+        assert snapshot.volatile_pinglight and snapshot.volatile_buzzer and snapshot.status is None
+        result = usb_watchdog.snapshot_to_dict(watchdog.snapshot())
+        assert result['version'] == '1.0'
+        assert result['status']['reboot_indicator'] is True
+        json.dumps(result)
+    finally:
+        watchdog.close()
+
+
+def test_status_action_prints_json(capsys):
+    try:
+        usb_watchdog.main(['status', '--json', '--simulate', '1'])
+    except SystemExit as e:
+        assert e.code == 0
+    result = json.loads(capsys.readouterr().out)
+    assert result['serial_number'] == 'SIM00000000000000000'
+    assert result['status']['triggered'] is False
+
+
+def serve_control(tmp_path, scheduler=None):
+    transport = usb_watchdog.SimulatedTransport(report_interval=0.01)
+    watchdog = USBWatchDog(transport=transport)
+    metrics = usb_watchdog.PetMetrics(watchdog.get_serial_number(),
+            scheduler.device_timeout if scheduler is not None else None)
+    path = str(tmp_path / 'control.sock')
+    return watchdog, usb_watchdog.ControlServer(path, watchdog, scheduler, metrics), metrics, path
+
+
+def control_requests(path, *requests):
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.connect(path)
+    try:
+        stream = connection.makefile('rb')
+        responses = []
+        for request in requests:
+            connection.sendall((json.dumps(request) + '\n').encode('utf-8'))
+            responses.append(json.loads(stream.readline().decode('utf-8')))
+        return responses
+    finally:
+        connection.close()
+
+
+def test_control_socket_configures_and_pauses_the_petter(tmp_path):
+    scheduler = usb_watchdog.PetScheduler(1.0, device_timeout=30)
+    watchdog, server, metrics, path = serve_control(tmp_path, scheduler)
+    try:
+        assert oct(os.stat(path).st_mode & 0o777) == oct(0o600)
+        status, configured, refused, unknown, paused = control_requests(path,
+                {'command': 'status'},
+                {'command': 'configure', 'settings': {'timeout': 20, 'pinglight': False}},
+                {'command': 'configure', 'settings': {'timeout': 0}},
+                {'command': 'reboot'},
+                {'command': 'pause', 'seconds': 60})
+        assert status['ok'] and status['volatile_timeout'] == 30 and status['paused'] is False
+        assert configured == {'ok': True, 'reports': 2}
+        assert watchdog.get_volatile_timeout() == 20 and watchdog.get_volatile_pinglight() is False
+        assert scheduler.device_timeout == 20 and metrics.timeout == 20
+        assert refused['ok'] is False and unknown['ok'] is False
+        assert paused == {'ok': True, 'paused': True} and scheduler.paused()
+        beacon, resumed = control_requests(path, {'command': 'beacon', 'state': 'on'}, {'command': 'resume'})
+        assert beacon == {'ok': False, 'error': 'USB Watchdog is in watchdog mode', 'type': 'ValueError'}
+        assert resumed == {'ok': True, 'paused': False} and not scheduler.paused()
+    finally:
+        server.close()
+        watchdog.close()
+    assert not os.path.exists(path)
+
+
+def test_control_calls_are_checked_like_configure(tmp_path):
+    scheduler = usb_watchdog.PetScheduler(1.0, device_timeout=30)
+    watchdog, server, metrics, path = serve_control(tmp_path, scheduler)
+    client = usb_watchdog.USBWatchDogClient(path)
+    try:
+        for call in (lambda: client.apply({'nonvolatile_beacon_mode': True}),
+                lambda: client.set_nonvolatile_beacon_mode(True),
+                lambda: client.set_volatile_timeout(0)):
+            try:
+                call()
+            except ValueError:
+                pass
+            else:
+                assert False, 'control call was not refused'
+        assert watchdog.get_nonvolatile_beacon_mode() is False
+
+        client.set_volatile_timeout(20)
+        assert watchdog.get_volatile_timeout() == 20
+        assert scheduler.device_timeout == 20 and metrics.timeout == 20
+        assert client.apply({'timeout': 25, 'pinglight': None}) == [[USBWatchDog.FR_VOLATILE_TIMEOUT, 25, 0]]
+        assert scheduler.device_timeout == 25
+    finally:
+        client.close()
+        server.close()
+        watchdog.close()
+
+
+def test_broker_may_change_beacon_mode(tmp_path):
+    watchdog, server, metrics, path = serve_control(tmp_path)
+    client = usb_watchdog.USBWatchDogClient(path)
+    try:
+        client.set_nonvolatile_beacon_mode(True)
+        assert watchdog.get_nonvolatile_beacon_mode() is True
+    finally:
+        client.close()
+        server.close()
+        watchdog.close()
+
+
+def test_systemd_notifier_sends_datagrams(tmp_path):
+    path = str(tmp_path / 'notify.sock')
+    receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    receiver.bind(path)
+    notifier = usb_watchdog.SystemdNotifier(path)
+    try:
+        assert notifier.notify('READY=1')
+        assert receiver.recv(64) == b'READY=1'
+    finally:
+        notifier.close()
+        receiver.close()
+    assert usb_watchdog.SystemdNotifier('').notify('READY=1') is False
+
+
+def test_config_file_sections_override_defaults(tmp_path, capsys):
+    path = str(tmp_path / 'usb_watchdog.ini')
+    with open(path, 'w') as f:
+        f.write('[DEFAULT]\ntimeout = 40\nbuzzer = off\n\n[SIM00000000000000001]\ntimeout = 50\n')
+    transport = usb_watchdog.SimulatedTransport(2)
+    watchdogs = [USBWatchDog(model.serial_number, cache=True, transport=transport)
+            for model in transport.devices]
+    try:
+        parser = usb_watchdog.build_parser()
+        usb_watchdog.general_configure(watchdogs[0], parser.parse_args(['configure', '--config', path,
+                '--dry-run']))
+        assert 'Would write FR_VOLATILE_TIMEOUT (0x4): 0x28 0x00' in capsys.readouterr().out
+        assert watchdogs[0].get_volatile_timeout() == 30
+
+        for watchdog in watchdogs:
+            usb_watchdog.general_configure(watchdog, parser.parse_args(['configure', '--config', path,
+                    '--pinglight', 'off']))
+        assert [watchdog.get_volatile_timeout() for watchdog in watchdogs] == [40, 50]
+        assert [watchdog.get_volatile_buzzer() for watchdog in watchdogs] == [False, False]
+        assert [watchdog.get_volatile_pinglight() for watchdog in watchdogs] == [False, False]
+    finally:
+        for watchdog in watchdogs:
+            watchdog.close()
+
+
+def test_pet_interval_must_be_auto_or_finite():
+    assert usb_watchdog.check_pet_interval('auto') == 'auto'
+    assert usb_watchdog.check_pet_interval('0.25') == 0.25
+    for value in ('nan', 'inf', '-inf', '0', '65536'):
+        try:
+            usb_watchdog.check_pet_interval(value)
+        except usb_watchdog.argparse.ArgumentTypeError:
+            pass
+        else:
+            assert False, 'accepted ' + value
+
+
+def test_adaptive_interval_follows_volatile_timeout_changes(tmp_path):
+    args = usb_watchdog.build_parser().parse_args(['continuous', '--pet-interval', 'auto',
+            '--jitter-budget', '0.05', '--timeout', '4'])
+    transport = usb_watchdog.SimulatedTransport(report_interval=0.01)
+    model = transport.devices[0]
+    watchdog = USBWatchDog(cache=True, transport=transport)
+    watchdog.start_status_reader()
+    usb_watchdog.general_configure(watchdog, args)
+    scheduler = usb_watchdog.create_pet_scheduler(watchdog, args)
+    server = usb_watchdog.ControlServer(str(tmp_path / 'control.sock'), watchdog, scheduler)
+    pets = []
+    thread = threading.Thread(target=usb_watchdog.run_pet_loop, args=(watchdog, args, scheduler))
+    thread.start()
+    try:
+        assert 1.8 < scheduler.interval <= 1.95
+        deadline = time.time() + 5
+        while scheduler.pets < 1:
+            assert time.time() < deadline, 'the USB Watchdog was not pet'
+            time.sleep(0.01)
+        # Cut the timeout right after a pet, while the next pet is still scheduled for the old one
+        time.sleep(0.2)
+        assert control_requests(server.path, {'command': 'configure', 'settings': {'timeout': 1}})[0]['ok']
+        assert 0.3 < scheduler.interval <= 0.45
+        assert scheduler.deadline <= scheduler.last_pet + scheduler.interval
+        while scheduler.pets < 4:
+            assert time.time() < deadline, 'the USB Watchdog was not pet'
+            assert model.triggered() is False
+            pets.append(model.elapsed())
+            time.sleep(0.01)
+        assert max(pets) < 1.0 * (1 - scheduler.safety_margin)
+        assert usb_watchdog.PetScheduler.MIN_ADAPTIVE_INTERVAL <= scheduler.interval
+    finally:
+        scheduler.stopped = True
+        thread.join()
+        server.close()
+        watchdog.close()
+
+
+def read_flight_events(path):
+    with open(path, 'rb') as f:
+        return usb_watchdog.FlightRecorder.events(f.read())
+
+
+def test_flight_recorder_file_keeps_the_history(tmp_path):
+    FlightRecorder = usb_watchdog.FlightRecorder
+    path = str(tmp_path / 'flight')
+    recorder = FlightRecorder(8, path, sync_interval=0.05)
+    try:
+        recorder.record(FlightRecorder.EVENT_PET, 0.002, (False, True, False, 3))
+        recorder.record(FlightRecorder.EVENT_USB_ERROR)
+        time.sleep(0.2)
+        assert recorder._flusher is None
+        events = read_flight_events(path)
+        assert [entry['event'] for entry in events] == ['start', 'pet', 'usb_error']
+        assert events[1]['status'] == {'triggered': False, 'reboot_indicator': True, 'beacon_mode': False,
+                'counter': 3}
+        assert 'status' not in events[2]
+    finally:
+        recorder.close()
+
+    # A later run appends, overwriting the oldest events once the ring is full
+    recorder = FlightRecorder(8, path, sync_interval=0)
+    try:
+        for i in range(6):
+            recorder.record(FlightRecorder.EVENT_SKIPPED)
+        events = read_flight_events(path)
+    finally:
+        recorder.close()
+    assert [entry['index'] for entry in events] == list(range(2, 10))
+    assert [entry['event'] for entry in events[:2]] == ['usb_error', 'start']
+
+    recorder = FlightRecorder(16, path)
+    recorder.close()
+    assert [entry['event'] for entry in read_flight_events(path)] == ['start']
+
+
+def test_flight_recorder_is_dumped_from_the_pet_loop(tmp_path, capsys):
+    args = usb_watchdog.build_parser().parse_args(['continuous', '--pet-interval', '0.05'])
+    transport = usb_watchdog.SimulatedTransport(report_interval=0.01)
+    watchdog = USBWatchDog(cache=True, transport=transport)
+    watchdog.start_status_reader()
+    scheduler = usb_watchdog.create_pet_scheduler(watchdog, args)
+    handlers = usb_watchdog.signal.getsignal(usb_watchdog.signal.SIGUSR1), \
+            usb_watchdog.signal.getsignal(usb_watchdog.signal.SIGTERM)
+    recorder = usb_watchdog.start_flight_recorder(args)
+    thread = threading.Thread(target=usb_watchdog.run_pet_loop,
+            args=(watchdog, args, scheduler, None, None, None, recorder))
+    thread.start()
+    try:
+        os.kill(os.getpid(), usb_watchdog.signal.SIGUSR1)
+        assert recorder.dump_requested
+        deadline = time.time() + 5
+        while recorder.dump_requested:
+            assert time.time() < deadline, 'the flight recorder was not dumped'
+            time.sleep(0.01)
+    finally:
+        scheduler.stopped = True
+        thread.join()
+        usb_watchdog.signal.signal(usb_watchdog.signal.SIGUSR1, handlers[0])
+        usb_watchdog.signal.signal(usb_watchdog.signal.SIGTERM, handlers[1])
+        recorder.close()
+        watchdog.close()
+    assert ' start' in capsys.readouterr().out
+
+
+def provision(argv, serial_numbers):
+    transport = usb_watchdog.SimulatedTransport(serial_numbers=serial_numbers)
+    args = usb_watchdog.build_parser().parse_args(['provision'] + argv)
+    try:
+        usb_watchdog.handle_provision_action(args, transport)
+        error_number = 0
+    except usb_watchdog.USBWatchDogError as e:
+        error_number = e.error_number
+    return error_number, [model.serial_number for model in transport.devices]
+
+
+def test_provision_rejects_repeated_serial_numbers():
+    try:
+        usb_watchdog.check_serial_numbers('A' * 20 + ',' + 'A' * 20)
+    except usb_watchdog.argparse.ArgumentTypeError:
+        pass
+    else:
+        assert False, 'repeated serial numbers were accepted'
+
+
+def test_provision_skips_serial_numbers_in_use():
+    unprovisioned = usb_watchdog.SimulatedUSBWatchDog.UNPROVISIONED_SERIAL_NUMBER
+    error_number, serial_numbers = provision(['--serial-numbers', 'A' * 20 + ',' + 'B' * 20],
+            [unprovisioned, unprovisioned, 'A' * 20])
+    assert error_number == 1
+    assert serial_numbers == [unprovisioned, 'B' * 20, 'A' * 20]
+
+
+def test_provision_pattern_skips_serial_numbers_in_use():
+    unprovisioned = usb_watchdog.SimulatedUSBWatchDog.UNPROVISIONED_SERIAL_NUMBER
+    error_number, serial_numbers = provision(['--serial-pattern', 'SER%017d', '--jobs', '2'],
+            [unprovisioned, 'SER%017d' % 0, unprovisioned])
+    assert error_number == 0
+    assert serial_numbers == ['SER%017d' % 1, 'SER%017d' % 0, 'SER%017d' % 2]
+
+
+def test_cached_reads_and_pets_reuse_their_buffers():
+    transport = usb_watchdog.SimulatedTransport()
+    watchdog = USBWatchDog(cache=True, transport=transport)
+    try:
+        assert watchdog.get_serial_number() is watchdog.get_serial_number()
+        watchdog.set_volatile_timeout(20)
+        assert watchdog.get_volatile_timeout() == 20
+        written = []
+        watchdog._h.write = lambda array: written.append(array) or len(array)
+        watchdog.pet()
+        watchdog.set_beacon_state(False)
+        assert written[0] is USBWatchDog.OUT_REPORTS[3] and written[1] is USBWatchDog.OUT_REPORTS[2]
+    finally:
+        watchdog.close()
+
+
+class CountingTransport(usb_watchdog.SimulatedTransport):
+    # Counts the enumerations and path opens the path cache leaves to the wrapped transport
+
+    def __init__(self, *args, **kwargs):
+        super(CountingTransport, self).__init__(*args, **kwargs)
+        self.enumerations = 0
+        self.opened_paths = []
+
+    def enumerate(self, vendor_id, product_id):
+        self.enumerations += 1
+        return super(CountingTransport, self).enumerate(vendor_id, product_id)
+
+    def open_path(self, path):
+        self.opened_paths.append(path)
+        return super(CountingTransport, self).open_path(path)
+
+
+def open_cached(transport, path, serial_number):
+    cache = usb_watchdog.PathCacheTransport(transport, path)
+    cache.open(USBWatchDog.VENDOR_ID, USBWatchDog.PRODUCT_ID, serial_number).close()
+    return cache
+
+
+def test_path_cache_skips_enumeration_until_stale_or_invalidated(tmp_path):
+    transport = CountingTransport(2)
+    serial_number = transport.devices[1].serial_number
+    path = str(tmp_path / 'paths.json')
+
+    open_cached(transport, path, serial_number)
+    assert transport.enumerations == 1
+    with open(path) as f:
+        assert json.load(f)['paths'][serial_number] == 'sim:1'
+
+    # A hit opens the remembered path, even from a new process reading the file
+    cache = open_cached(transport, path, serial_number)
+    assert transport.enumerations == 1
+    assert transport.opened_paths[-1] == b'sim:1'
+
+    # After a replug the remembered path belongs to another USB Watchdog
+    transport.devices.reverse()
+    cache.open(USBWatchDog.VENDOR_ID, USBWatchDog.PRODUCT_ID, serial_number).close()
+    assert transport.enumerations == 2
+    with open(path) as f:
+        assert json.load(f)['paths'][serial_number] == 'sim:0'
+
+    cache.invalidate()
+    assert not os.path.exists(path)
+    open_cached(transport, path, serial_number)
+    assert transport.enumerations == 3
+
+
+def test_path_cache_defaults_to_the_runtime_directory_of_other_users(monkeypatch):
+    monkeypatch.delenv('USB_WATCHDOG_PATH_CACHE', raising=False)
+    monkeypatch.setenv('XDG_RUNTIME_DIR', '/run/user/1000')
+    monkeypatch.setattr(usb_watchdog.os, 'geteuid', lambda: 1000)
+    assert usb_watchdog.default_path_cache() == '/run/user/1000/usb_watchdog-paths.json'
+    monkeypatch.setattr(usb_watchdog.os, 'geteuid', lambda: 0)
+    assert usb_watchdog.default_path_cache() == '/run/usb_watchdog-paths.json'
+    monkeypatch.setenv('USB_WATCHDOG_PATH_CACHE', '')
+    assert usb_watchdog.default_path_cache() == ''
+
+
+def test_heartbeat_senders_expire():
+    tracker = usb_watchdog.HeartbeatTracker(5.0)
+    tracker.beat('a', now=0.0)
+    tracker.beat('b', now=3.0)
+    tracker.beat('a', now=4.0)
+    assert tracker.fresh(now=6.0) == 2
+    assert tracker.fresh(now=8.5) == 1
+    assert tracker.fresh(now=9.5) == 0
+
+
+def test_heartbeats_from_unknown_senders_are_ignored():
+    tracker = usb_watchdog.HeartbeatTracker(5.0, ['a'])
+    assert tracker.beat('a') is True
+    assert tracker.beat('b') is False
+    assert tracker.fresh() == 1
+
+
+def test_quorum_transitions_are_logged_once(capsys):
+    tracker = usb_watchdog.HeartbeatTracker(60.0)
+    gate = usb_watchdog.QuorumGate(tracker, 2)
+    assert gate.healthy() is False
+    tracker.beat('a')
+    assert gate.healthy() is False
+    tracker.beat('b')
+    assert gate.healthy() is True
+    assert gate.healthy() is True
+    tracker.last_seen['a'] -= 120.0
+    assert gate.healthy() is False
+    assert capsys.readouterr().out.splitlines() == ['Quorum lost: 0 of 2 senders alive',
+            'Quorum held: 2 of 2 senders alive', 'Quorum lost: 1 of 2 senders alive']
+
+
+def test_quorum_assumed_during_startup_grace():
+    tracker = usb_watchdog.HeartbeatTracker(60.0)
+    assert usb_watchdog.QuorumGate(tracker, 1, grace=60.0).healthy() is True
+    gate = usb_watchdog.QuorumGate(tracker, 1, grace=60.0)
+    gate.grace_until -= 120.0
+    assert gate.healthy() is False
+
+
+def test_quorum_may_not_exceed_the_senders(capsys):
+    try:
+        usb_watchdog.main(['aggregate', '--simulate', '1', '--listen-unix', 'unused',
+                '--quorum', '3', '--sender', 'a', '--sender', 'b'])
+    except SystemExit as e:
+        assert e.code == 2
+    else:
+        assert False, 'a quorum larger than the senders was accepted'
+    assert '--quorum is larger than the number of --sender entries' in capsys.readouterr().err
+
+
+def listen_args(**kwargs):
+    args = usb_watchdog.argparse.Namespace(listen_udp=[], listen_unix=[])
+    args.__dict__.update(kwargs)
+    return args
+
+
+def test_anonymous_heartbeats_count_once_per_host():
+    tracker = usb_watchdog.HeartbeatTracker(60.0)
+    sockets = usb_watchdog.open_listen_sockets(listen_args(listen_udp=[('127.0.0.1', 0)]))
+    try:
+        address = sockets[0].getsockname()
+        for data in (b'', b'', b'', b'named\n'):
+            sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sender.sendto(data, address)
+            sender.close()
+        thread = threading.Thread(target=usb_watchdog.receive_heartbeats, args=(sockets[0], tracker))
+        thread.daemon = True
+        thread.start()
+        deadline = time.time() + 5
+        while tracker.received < 4 and time.time() < deadline:
+            time.sleep(0.01)
+        assert sorted(tracker.last_seen) == ['127.0.0.1', 'named']
+    finally:
+        usb_watchdog.close_listen_sockets(sockets)
+
+
+def test_listen_sockets_only_replace_stale_sockets(tmp_path):
+    path = str(tmp_path / 'heartbeat')
+    with open(path, 'w') as f:
+        f.write('not a socket')
+    try:
+        usb_watchdog.open_listen_sockets(listen_args(listen_unix=[path]))
+    except usb_watchdog.USBWatchDogError:
+        pass
+    else:
+        assert False, 'a regular file was replaced'
+    assert open(path).read() == 'not a socket'
+
+    os.unlink(path)
+    sockets = usb_watchdog.open_listen_sockets(listen_args(listen_unix=[path]))
+    try:
+        try:
+            usb_watchdog.open_listen_sockets(listen_args(listen_unix=[path]))
+        except usb_watchdog.USBWatchDogError:
+            pass
+        else:
+            assert False, 'a socket in use was replaced'
+    finally:
+        usb_watchdog.close_listen_sockets(sockets)
+    assert not os.path.exists(path)
+
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    stale.bind(path)
+    stale.close()
+    usb_watchdog.close_listen_sockets(usb_watchdog.open_listen_sockets(listen_args(listen_unix=[path])))
+
+
+def test_aggregate_takes_beacon_mode_from_the_status(tmp_path, monkeypatch):
+    args = usb_watchdog.build_parser().parse_args(['aggregate', '--quorum', '1',
+            '--listen-unix', str(tmp_path / 'heartbeat')])
+    transport = usb_watchdog.SimulatedTransport(report_interval=0.01)
+    watchdog = USBWatchDog(transport=transport)
+    loops = []
+    monkeypatch.setattr(usb_watchdog, 'run_petter', lambda watchdog, args, gate: loops.append('petter'))
+    monkeypatch.setattr(usb_watchdog, 'run_beacon_loop', lambda watchdog, args, gate: loops.append('beacon'))
+    handler = usb_watchdog.signal.getsignal(usb_watchdog.signal.SIGTERM)
+    try:
+        # Beacon mode is configured but not in effect until the USB Watchdog reboots
+        watchdog.set_nonvolatile_beacon_mode(True)
+        usb_watchdog.handle_aggregate_action(watchdog, args)
+        transport.devices[0].power_cycle()
+        usb_watchdog.handle_aggregate_action(watchdog, args)
+    finally:
+        usb_watchdog.signal.signal(usb_watchdog.signal.SIGTERM, handler)
+        watchdog.close()
+    assert loops == ['petter', 'beacon']
+
+
+class ScriptedGate(object):
+    # Reports the given quorum states, running check after each, then stops the beacon loop
+
+    def __init__(self, states, check):
+        self.states = list(states)
+        self.check = check
+
+    def healthy(self):
+        if not self.states:
+            raise usb_watchdog.USBWatchDogError(0)
+        state = self.states.pop(0)
+        self.check()
+        return state
+
+
+def test_beacon_loop_records_and_serves_the_control_socket(tmp_path):
+    path = str(tmp_path / 'flight')
+    control_path = str(tmp_path / 'control.sock')
+    args = usb_watchdog.build_parser().parse_args(['aggregate', '--quorum', '1', '--listen-unix', 'unused',
+            '--pet-interval', '0.01', '--flight-recorder', path, '--flight-recorder-sync', '0',
+            '--control-socket', control_path])
+    transport = usb_watchdog.SimulatedTransport(report_interval=0.01)
+    transport.devices[0].nonvolatile[USBWatchDog.FR_NONVOLATILE_BEACON_MODE] = [0x1]
+    transport.devices[0].power_cycle()
+    watchdog = usb_watchdog.USBWatchDogManager(transport=transport)
+    responses = []
+    gate = ScriptedGate([False, False, True],
+            lambda: responses.extend(control_requests(control_path, {'command': 'status'})))
+    handler = usb_watchdog.signal.getsignal(usb_watchdog.signal.SIGUSR1)
+    try:
+        usb_watchdog.run_beacon_loop(watchdog, args, gate)
+    except usb_watchdog.USBWatchDogError as e:
+        assert e.error_number == 0
+    finally:
+        usb_watchdog.signal.signal(usb_watchdog.signal.SIGUSR1, handler)
+        watchdog.close()
+    assert len(responses) == 3 and all(response['ok'] for response in responses)
+    assert not os.path.exists(control_path)
+    assert [entry['event'] for entry in read_flight_events(path)] == ['start', 'beacon_on', 'beacon_off']
+
+
+def sample_countdown(tracker, start, end, counter, period=0.1):
+    # Feeds the tracker status samples every period host seconds, with counter(now) as the status counter
+    now = start
+    while now < end:
+        now += period
+        tracker.sampled(now, (False, False, False, counter(now) % 2**16))
+    return now
+
+
+def test_countdown_rate_converges_and_errs_towards_less_time_left():
+    tracker = usb_watchdog.CountdownTracker()
+    assert tracker.time_to_trigger(100, now=0.0) is None
+    tracker.petted(0.0)
+    assert tracker.time_to_trigger(100, now=0.0) == 100
+    # A device clock running 25% fast
+    now = sample_countdown(tracker, 0.0, 60.0, lambda now: int(now * 1.25))
+    assert abs(tracker.rate - 1.25) < 0.01
+    actual = (100 - now * 1.25) / 1.25
+    assert actual - 0.25 < tracker.time_to_trigger(100, now=now) <= actual
+
+
+def test_countdown_follows_counter_wraps_and_foreign_pets():
+    tracker = usb_watchdog.CountdownTracker()
+    now = sample_countdown(tracker, 0.0, 20.0, lambda now: 65530 + int(now))
+    assert tracker.wraps == 1
+    actual = 70000 - 65530 - now
+    # Twenty counter steps only pin the rate down to within a percent
+    assert actual * 0.99 < tracker.time_to_trigger(70000, now=now) <= actual
+
+    # Pet by someone else at host time 30, which resets the counter without wrapping it
+    now = sample_countdown(tracker, now, 30.0, lambda now: 65530 + int(now))
+    now = sample_countdown(tracker, now, 40.0, lambda now: int(now - 30.0))
+    assert tracker.wraps == 0
+    actual = 60 - (now - 30.0)
+    assert actual - 1.25 < tracker.time_to_trigger(60, now=now) <= actual
+
+    tracker.sampled(now, (True, False, False, 65))
+    assert tracker.time_to_trigger(60, now=now) == 0.0
+    tracker.sampled(now, (False, False, True, 0))
+    assert tracker.time_to_trigger(60, now=now) is None
+
+
+def test_beacon_engine_debounces_changes():
+    engine = usb_watchdog.BeaconEngine(on_delay=2.0, off_delay=5.0, min_interval=1.0)
+    engine.wanted_since = 0.0
+    engine.event(True, 'a', now=10.0)
+    assert engine.next_state(now=11.0) == (None, 1.0)
+    # Flapping faster than the on delay never turns the beacon on
+    engine.event(False, 'a', now=11.5)
+    engine.event(True, 'a', now=12.0)
+    assert engine.next_state(now=13.0) == (None, 1.0)
+    assert engine.next_state(now=14.0) == (True, None)
+    engine.written(True, now=14.0)
+    assert engine.next_state(now=14.5) == (None, None)
+
+    engine.event(False, now=15.0)
+    assert engine.next_state(now=19.0) == (None, 1.0)
+    engine.event(True, 'b', now=18.5)
+    assert engine.next_state(now=30.0) == (None, None)
+    engine.event(False, 'b', now=30.0)
+    assert engine.next_state(now=35.0) == (False, None)
+
+
+def test_beacon_engine_rate_limits_changes():
+    engine = usb_watchdog.BeaconEngine(on_delay=0.0, off_delay=0.0, min_interval=5.0)
+    engine.written(False, now=0.0)
+    engine.event(True, now=1.0)
+    assert engine.next_state(now=1.0) == (None, 4.0)
+    assert engine.next_state(now=5.0) == (True, None)
+
+
+def test_beacon_engine_expires_keys():
+    engine = usb_watchdog.BeaconEngine(on_delay=0.0, off_delay=0.0, min_interval=0.0, expiry=3.0)
+    engine.event(True, 'a', now=1.0)
+    assert engine.next_state(now=1.0) == (True, None)
+    engine.written(True, now=1.0)
+    assert engine.next_state(now=2.0) == (None, 2.0)
+    assert engine.next_state(now=4.5) == (False, None)
+
+
+def test_beacon_engine_parses_events():
+    engine = usb_watchdog.BeaconEngine(on_patterns=[usb_watchdog.re.compile(r'ERROR (?P<key>\w+)')],
+            off_patterns=[usb_watchdog.re.compile(r'RECOVERED')])
+    assert engine.parse('on  disk full ') == (True, 'disk full')
+    assert engine.parse('off') == (False, None)
+    assert engine.parse('app: ERROR db down') == (True, 'db')
+    assert engine.parse('app: RECOVERED db') == (False, None)
+    assert engine.parse('app: started') is None
+
+
+class FlakyBeacon(object):
+    # Fails the first beacon write, then stops the engine on the next one
+
+    def __init__(self):
+        self.writes = []
+        self.reconnects = 0
+
+    def set_beacon_state(self, triggered):
+        self.writes.append(triggered)
+        if len(self.writes) == 1:
+            raise IOError('device went away')
+        raise usb_watchdog.USBWatchDogError(0)
+
+    def reconnect(self):
+        self.reconnects += 1
+
+
+def test_beacon_engine_restores_effective_state_after_reconnect():
+    engine = usb_watchdog.BeaconEngine(on_delay=60.0)
+    engine.event(True)
+    watchdog = FlakyBeacon()
+    try:
+        usb_watchdog.run_beacon_engine(watchdog, engine)
+    except usb_watchdog.USBWatchDogError:
+        pass
+    # The pending 'on' is still waiting out its delay
+    assert watchdog.writes == [False, False]
+    assert watchdog.reconnects == 1
+
+
+def test_beacon_engine_takes_beacon_mode_from_the_status(tmp_path, monkeypatch):
+    args = usb_watchdog.build_parser().parse_args(['beacon-engine', '--listen-unix', str(tmp_path / 'events')])
+    transport = usb_watchdog.SimulatedTransport(report_interval=0.01)
+    watchdog = USBWatchDog(transport=transport)
+    engines = []
+    monkeypatch.setattr(usb_watchdog, 'run_beacon_engine', lambda watchdog, engine: engines.append(engine))
+    handler = usb_watchdog.signal.getsignal(usb_watchdog.signal.SIGTERM)
+    try:
+        # Beacon mode is configured but not in effect until the USB Watchdog reboots
+        watchdog.set_nonvolatile_beacon_mode(True)
+        try:
+            usb_watchdog.handle_beacon_engine_action(watchdog, args)
+        except usb_watchdog.USBWatchDogError as e:
+            assert e.error_number == 1
+        else:
+            assert False, 'the beacon engine ran a USB Watchdog in watchdog mode'
+        transport.devices[0].power_cycle()
+        usb_watchdog.handle_beacon_engine_action(watchdog, args)
+    finally:
+        usb_watchdog.signal.signal(usb_watchdog.signal.SIGTERM, handler)
+        watchdog.close()
+    assert len(engines) == 1
@@ -10,17 +10,78 @@
 
 
 from __future__ import print_function
-import hid
 import re
 import argparse
+import collections
+import functools
+import importlib
+import json
+import math
+import mmap
+import os
+import random
+import signal
+import socket
+import stat
+import struct
+import subprocess
+import sys
+import threading
 import time
 
+try:
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    asyncio = None
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+try:
+    import configparser
+except ImportError:
+    import ConfigParser as configparser
+
+
+# time.monotonic is unavailable before Python 3.3
+monotonic = getattr(time, 'monotonic', time.time)
+
+# hidapi is imported on first use so the module can be imported without it
+hid = None
+
+def load_hid():
+    global hid
+    if hid is None:
+        import hid as hid_module
+        hid = hid_module
+    return hid
+
 
 def check_serialnumber(value):
     if re.match('^[\w-]+$', value) is None:
          raise argparse.ArgumentTypeError('%s must be alphanumeric' % value)
     return value
 
+def check_serial_numbers(value):
+    serial_numbers = value.split(',')
+    for serial_number in serial_numbers:
+        if re.match('^[\w-]{20}$', serial_number) is None:
+             raise argparse.ArgumentTypeError('%s must be 20 alphanumeric characters' % serial_number)
+    # Serial numbers are write-once, so a repeated one cannot be corrected afterwards
+    if len(set(serial_numbers)) != len(serial_numbers):
+         raise argparse.ArgumentTypeError('%s repeats a serial number' % value)
+    return serial_numbers
+
+def check_serial_pattern(value):
+    try:
+        check_serial_numbers(value % 0)
+    except TypeError:
+         raise argparse.ArgumentTypeError('%s must contain a single integer conversion such as %%08d' % value)
+    return value
+
 def check_timeout(value):
     ivalue = int(value)
     if ivalue == 0 or ivalue > 2**16-1:
@@ -33,131 +94,526 @@ def check_frequency(value):
          raise argparse.ArgumentTypeError('%s must be between 42 and 2^8-1' % value)
     return ivalue
 
-
-global_parser = argparse.ArgumentParser(add_help=False)
-global_parser.add_argument('--serial-number', type=check_serialnumber, 
-        help='Interacts with the designated USB Watchdog. '
-            'If not provided the first USB Watchdog found will be used.')
-global_parser.add_argument('--verbose', action='store_true', default=False, 
-        help='Reports additional information')
-
-
-watchdog_settings_parser = argparse.ArgumentParser(add_help=False)
-watchdog_settings_parser.add_argument('--nonvolatile-timeout', 
-        type=check_timeout, metavar='1-65535',
-        help='Sets a watchdog timeout period maintained across USB Watchdog reboots. '
-            'This does not take effect until the next USB Watchdog reboot.')
-watchdog_settings_parser.add_argument('--timeout', 
-        type=check_timeout, metavar='1-65535',
-        help='Sets a watchdog timeout period that is in effect until the USB Watchdog reboots.')
-
-
-settings_parser = argparse.ArgumentParser(add_help=False)
-settings_parser.add_argument('--nonvolatile-pinglight', 
-        dest='nonvolatile_pinglight', choices=['on', 'off'],
-        help='Enables/disables the ping light across USB Watchdog reboots. '
-            'This does not take effect until the next USB Watchdog reboot.')
-settings_parser.add_argument('--nonvolatile-buzzer',
-        dest='nonvolatile_buzzer', choices=['on', 'off'],
-        help='Enables/disables the buzzer across USB Watchdog reboots. '
-            'This does not take effect until the next USB Watchdog reboot.')
-settings_parser.add_argument('--pinglight', 
-        dest='pinglight', choices=['on', 'off'],
-        help='Enables/disables the ping light until the USB Watchdog reboots')
-settings_parser.add_argument('--buzzer', 
-        dest='buzzer', choices=['on', 'off'],
-        help='Enables/disables the buzzer until the USB Watchdog reboots')
-settings_parser.add_argument('--nonvolatile-buzzer-frequency',
-        type=check_frequency, metavar='42-255',
-        help='Sets the buzzer frequency maintained across USB Watchdog reboots. '
-            'This does not take effect until the next USB Watchdog reboot. '
-            'Accepts values in the range [42-255]')
-settings_parser.add_argument('--buzzer-frequency', 
-        type=check_frequency, metavar='42-255',
-        help='Sets the buzzer frequency until the USB Watchdog reboots. '
-            'Accepts values in the range [42-255]')
-settings_parser.add_argument('--clear-reboot-indicator', action='store_true', 
-        help='Clears the reboot indicator bit of the USB Watchdog')
-
-
-nonvolatile_mode_setting_parser = argparse.ArgumentParser(add_help=False)
-nonvolatile_mode_setting_parser.add_argument('--nonvolatile-beacon-mode', 
-        dest='nonvolatile_beacon_mode', choices=['on', 'off'],
-        help='Configures the USB Watchdog to act as a \'beacon\' (that can be turned on/off) instead of a timeout \'watchdog\'. '
-            'This setting is kept across reboots')
-
-
-pet_parser = argparse.ArgumentParser(add_help=False)
-pet_parser.add_argument('--detect-reboot', action='store_true', default=False, 
-        help='Exits program with status code of 2 if USB Watchdog is known to have reboot. The USB Watchdog will not be pet.')
-
-pet_parser.add_argument('--detect-triggered', action='store_true', default=False, 
-        help='Exits program with status code of 3 if the USB Watchdog is known to have triggered. '
-            'The USB Watchdog will not be pet.')
-
-
-parser = argparse.ArgumentParser(description='Program to set and pet a USB Watchdog from Macpod LLC.', version='1.0.0', 
-        epilog='Copyright Jeffrey Nelson, 2016. Licensed under GPL V3')
-subparsers = parser.add_subparsers(dest='action')
-
-
-reboot_detect_parser = subparsers.add_parser('rebooted', 
-        parents=[global_parser], 
-        help='Identifies if the USB Watchdog is known to have reboot.',
-        epilog='Returns 0 if the unit has not rebooted, 1 if an error occurs, or 2 if the unit has reboot')
-
-
-triggered_parser = subparsers.add_parser('triggered', 
-        parents=[global_parser], 
-        help='Identifies if the USB Watchdog has trigged either by timing out (watchdog mode) or via enabling beaconing.',
-        epilog='Returns 0 if the unit has not timed out, 1 if an error occurs, or 3 if the unit has triggered')
-
-
-configure_parser = subparsers.add_parser('configure', 
-        parents=[global_parser, settings_parser, watchdog_settings_parser, nonvolatile_mode_setting_parser], 
-        help='Configures the USB Watchdog and exits',
-        epilog='Returns 0 on success or 1 if an error occurs')
-
-
-oneshot_parser = subparsers.add_parser('oneshot', 
-        parents=[global_parser, watchdog_settings_parser, settings_parser, pet_parser],
-        help='Pets the Watchdog once and exits', 
-        epilog='Returns 0 on success or 1 if an error occurs')
-
-
-continuous_parser = subparsers.add_parser('continuous', 
-        parents=[global_parser, watchdog_settings_parser, settings_parser, pet_parser],
-        help='Pets the USB Watchdog continuously',
-        epilog='Returns 0 on success or 1 if an error occurs')
-continuous_parser.add_argument('--pet-interval', type=check_timeout, default=1, 
-        help='Set time in seconds between when the USB Watchdog is \'pet\'. '
-        'This should be well below the Watchdog timeout threshold.')
-
-
-mode_parser = subparsers.add_parser('mode',
-        parents=[global_parser],
-        help='Identifies if the USB Watchdog is in watchdog or beacon mode',
-        epilog='Returns 0 if the unit is in watchdog mode, 1 if an error occurs, or 2 if the unit is in beacon mode') 
-
-
-beacon_parser = subparsers.add_parser('beacon',
-        parents=[global_parser, settings_parser],
-        help='In \'beacon\' mode, this triggers or clears the trigger of the USB Watchdog',
-        epilog='Returns 0 on success, or 1 if an error occurs')
-beacon_parser.add_argument('beacon_state', 
-        choices=['on', 'off'])
-
-args = parser.parse_args()
+def check_range(low, high):
+    def check(value):
+        ivalue = int(value)
+        if ivalue < low or ivalue > high:
+             raise argparse.ArgumentTypeError('%s must be between %d and %d' % (value, low, high))
+        return ivalue
+    return check
+
+def check_pet_interval(value):
+    if value == 'auto':
+        return value
+    fvalue = float(value)
+    if math.isnan(fvalue) or math.isinf(fvalue) or fvalue <= 0 or fvalue > 2**16-1:
+         raise argparse.ArgumentTypeError('%s must be auto or between 0 and 2^16-1' % value)
+    return fvalue
+
+def check_seconds(value):
+    fvalue = float(value)
+    if fvalue < 0:
+         raise argparse.ArgumentTypeError('%s must not be negative' % value)
+    return fvalue
+
+def check_fraction(value):
+    fvalue = float(value)
+    if fvalue < 0 or fvalue > 1:
+         raise argparse.ArgumentTypeError('%s must be between 0 and 1' % value)
+    return fvalue
+
+def check_file_check(value):
+    path, sep, max_age = value.rpartition(':')
+    if not path:
+         raise argparse.ArgumentTypeError('%s must be of the form PATH:SECONDS' % value)
+    return path, check_seconds(max_age)
+
+def check_tcp_check(value):
+    host, sep, port = value.rpartition(':')
+    # IPv6 addresses are given in brackets, as in [::1]:80
+    if host.startswith('[') and host.endswith(']'):
+        host = host[1:-1]
+    if not host or not port.isdigit() or not 0 < int(port) < 2**16:
+         raise argparse.ArgumentTypeError('%s must be of the form HOST:PORT' % value)
+    return host, int(port)
+
+def check_python_check(value):
+    module, sep, function = value.partition(':')
+    if not module or not function:
+         raise argparse.ArgumentTypeError('%s must be of the form MODULE:FUNCTION' % value)
+    return module, function
+
+def check_switch(value):
+    if value.lower() in ('on', 'yes', 'true', '1'):
+        return True
+    if value.lower() in ('off', 'no', 'false', '0'):
+        return False
+    raise argparse.ArgumentTypeError('%s must be on or off' % value)
+
+def check_regex(value):
+    try:
+        return re.compile(value)
+    except re.error as e:
+        raise argparse.ArgumentTypeError('%s is not a valid regular expression: %s' % (value, e))
+
+
+def default_path_cache():
+    # /run is only writable by root, so other users keep the cache in their own runtime directory
+    if 'USB_WATCHDOG_PATH_CACHE' in os.environ:
+        return os.environ['USB_WATCHDOG_PATH_CACHE']
+    if os.geteuid() != 0 and os.environ.get('XDG_RUNTIME_DIR'):
+        return os.path.join(os.environ['XDG_RUNTIME_DIR'], 'usb_watchdog-paths.json')
+    return '/run/usb_watchdog-paths.json'
+
+
+def build_parser():
+    global_parser = argparse.ArgumentParser(add_help=False)
+    global_parser.add_argument('--serial-number', type=check_serialnumber, 
+            help='Interacts with the designated USB Watchdog. '
+                'If not provided the first USB Watchdog found will be used.')
+    global_parser.add_argument('--verbose', action='store_true', default=False, 
+            help='Reports additional information')
+    global_parser.add_argument('--status-max-age', type=check_seconds, default=1.0, metavar='SECONDS',
+            help='Oldest status sample from the background status reader that is still reported. Defaults to 1')
+    global_parser.add_argument('--control-socket', metavar='PATH', default=os.environ.get('USB_WATCHDOG_CONTROL_SOCKET'),
+            help='Unix socket of a running broker or continuous petter, which serve JSON requests on it. '
+                'Other actions send their requests through it while it is being served and open the '
+                'USB Watchdog directly otherwise. Defaults to $USB_WATCHDOG_CONTROL_SOCKET')
+    global_parser.add_argument('--path-cache', metavar='PATH',
+            default=default_path_cache(),
+            help='File remembering the device path of each USB Watchdog, so opening one by serial number '
+                'does not enumerate every HID device. An empty value disables it. '
+                'Defaults to $USB_WATCHDOG_PATH_CACHE, or usb_watchdog-paths.json in /run for root '
+                'and in $XDG_RUNTIME_DIR for other users')
+    global_parser.add_argument('--simulate', type=check_range(1, 64), metavar='COUNT',
+        help='Talks to COUNT simulated USB Watchdogs instead of real hardware')
+    global_parser.add_argument('--simulate-latency', type=check_seconds, default=0.0, metavar='SECONDS',
+        help='Delay added to every transfer with a simulated USB Watchdog. Defaults to 0')
+    global_parser.add_argument('--simulate-failure-rate', type=check_fraction, default=0.0, metavar='FRACTION',
+        help='Fraction of transfers with a simulated USB Watchdog that fail. Defaults to 0')
+
+
+    watchdog_settings_parser = argparse.ArgumentParser(add_help=False)
+    watchdog_settings_parser.add_argument('--nonvolatile-timeout', 
+            type=check_timeout, metavar='1-65535',
+            help='Sets a watchdog timeout period maintained across USB Watchdog reboots. '
+                'This does not take effect until the next USB Watchdog reboot.')
+    watchdog_settings_parser.add_argument('--timeout', 
+            type=check_timeout, metavar='1-65535',
+            help='Sets a watchdog timeout period that is in effect until the USB Watchdog reboots.')
+
+
+    settings_parser = argparse.ArgumentParser(add_help=False)
+    settings_parser.add_argument('--config', metavar='PATH',
+            help='Reads settings from this INI file. Options in [DEFAULT] apply to every USB Watchdog and '
+                'are overridden by those in a section named after its serial number. '
+                'Settings given on the command line take precedence')
+    settings_parser.add_argument('--nonvolatile-pinglight', 
+            dest='nonvolatile_pinglight', choices=['on', 'off'],
+            help='Enables/disables the ping light across USB Watchdog reboots. '
+                'This does not take effect until the next USB Watchdog reboot.')
+    settings_parser.add_argument('--nonvolatile-buzzer',
+            dest='nonvolatile_buzzer', choices=['on', 'off'],
+            help='Enables/disables the buzzer across USB Watchdog reboots. '
+                'This does not take effect until the next USB Watchdog reboot.')
+    settings_parser.add_argument('--pinglight', 
+            dest='pinglight', choices=['on', 'off'],
+            help='Enables/disables the ping light until the USB Watchdog reboots')
+    settings_parser.add_argument('--buzzer', 
+            dest='buzzer', choices=['on', 'off'],
+            help='Enables/disables the buzzer until the USB Watchdog reboots')
+    settings_parser.add_argument('--nonvolatile-buzzer-frequency',
+            type=check_frequency, metavar='42-255',
+            help='Sets the buzzer frequency maintained across USB Watchdog reboots. '
+                'This does not take effect until the next USB Watchdog reboot. '
+                'Accepts values in the range [42-255]')
+    settings_parser.add_argument('--buzzer-frequency', 
+            type=check_frequency, metavar='42-255',
+            help='Sets the buzzer frequency until the USB Watchdog reboots. '
+                'Accepts values in the range [42-255]')
+    settings_parser.add_argument('--clear-reboot-indicator', action='store_true', 
+            help='Clears the reboot indicator bit of the USB Watchdog')
+
+
+    nonvolatile_mode_setting_parser = argparse.ArgumentParser(add_help=False)
+    nonvolatile_mode_setting_parser.add_argument('--nonvolatile-beacon-mode', 
+            dest='nonvolatile_beacon_mode', choices=['on', 'off'],
+            help='Configures the USB Watchdog to act as a \'beacon\' (that can be turned on/off) instead of a timeout \'watchdog\'. '
+                'This setting is kept across reboots')
+
+
+    pet_parser = argparse.ArgumentParser(add_help=False)
+    pet_parser.add_argument('--detect-reboot', action='store_true', default=False, 
+            help='Exits program with status code of 2 if USB Watchdog is known to have reboot. The USB Watchdog will not be pet.')
+
+    pet_parser.add_argument('--detect-triggered', action='store_true', default=False, 
+            help='Exits program with status code of 3 if the USB Watchdog is known to have triggered. '
+                'The USB Watchdog will not be pet.')
+
+
+    health_parser = argparse.ArgumentParser(add_help=False)
+    health_parser.add_argument('--check-command', action='append', default=[], metavar='COMMAND',
+            help='Only pets while this shell command exits with status 0. May be given multiple times')
+    health_parser.add_argument('--check-file', action='append', default=[], type=check_file_check,
+            metavar='PATH:SECONDS',
+            help='Only pets while this file was modified within the given number of seconds. May be given multiple times')
+    health_parser.add_argument('--check-tcp', action='append', default=[], type=check_tcp_check,
+            metavar='HOST:PORT',
+            help='Only pets while a TCP connection to this port can be made. May be given multiple times')
+    health_parser.add_argument('--check-python', action='append', default=[], type=check_python_check,
+            metavar='MODULE:FUNCTION',
+            help='Only pets while this Python function returns a true value. May be given multiple times')
+    health_parser.add_argument('--check-interval', type=check_seconds, default=5.0, metavar='SECONDS',
+            help='Set time in seconds between runs of each health check. Defaults to 5')
+    health_parser.add_argument('--check-timeout', type=check_seconds, default=2.0, metavar='SECONDS',
+            help='Health checks taking longer than this count as failed. Defaults to 2')
+    health_parser.add_argument('--check-failure-threshold', type=check_range(1, 1000), default=3, metavar='COUNT',
+            help='Consecutive failures of a health check before petting stops. Defaults to 3')
+
+
+    metrics_parser = argparse.ArgumentParser(add_help=False)
+    metrics_parser.add_argument('--metrics-port', type=check_range(1, 2**16-1), metavar='PORT',
+            help='Serves Prometheus metrics about petting over HTTP on this port')
+    metrics_parser.add_argument('--metrics-address', default='127.0.0.1',
+            help='Address the metrics HTTP server listens on. Defaults to 127.0.0.1')
+    metrics_parser.add_argument('--metrics-textfile', metavar='PATH',
+            help='Periodically writes Prometheus metrics about petting to this file, '
+                'for the node exporter\'s textfile collector')
+    metrics_parser.add_argument('--metrics-interval', type=check_seconds, default=15.0, metavar='SECONDS',
+            help='Set time in seconds between writes of the metrics text file. Defaults to 15')
+
+
+    parser = argparse.ArgumentParser(description='Program to set and pet a USB Watchdog from Macpod LLC.', 
+            epilog='Copyright Jeffrey Nelson, 2016. Licensed under GPL V3')
+    parser.add_argument('--version', action='version', version='1.0.0')
+    subparsers = parser.add_subparsers(dest='action')
+    subparsers.required = True
+
+
+    subparsers.add_parser('rebooted', 
+            parents=[global_parser], 
+            help='Identifies if the USB Watchdog is known to have reboot.',
+            epilog='Returns 0 if the unit has not rebooted, 1 if an error occurs, or 2 if the unit has reboot')
+
+
+    subparsers.add_parser('triggered', 
+            parents=[global_parser], 
+            help='Identifies if the USB Watchdog has trigged either by timing out (watchdog mode) or via enabling beaconing.',
+            epilog='Returns 0 if the unit has not timed out, 1 if an error occurs, or 3 if the unit has triggered')
+
+
+    configure_parser = subparsers.add_parser('configure', 
+            parents=[global_parser, settings_parser, watchdog_settings_parser, nonvolatile_mode_setting_parser], 
+            help='Configures the USB Watchdog and exits',
+            epilog='Returns 0 on success or 1 if an error occurs')
+    configure_parser.add_argument('--dry-run', action='store_true', default=False,
+            help='Prints the feature reports that would be written instead of writing them')
+
+
+    provision_parser = subparsers.add_parser('provision',
+            parents=[global_parser, watchdog_settings_parser, settings_parser, nonvolatile_mode_setting_parser],
+            help='Assigns serial numbers to every attached unprovisioned USB Watchdog and configures them in parallel',
+            epilog='Returns 0 if every USB Watchdog was provisioned and verified, or 1 otherwise')
+    serial_group = provision_parser.add_mutually_exclusive_group(required=True)
+    serial_group.add_argument('--serial-numbers', type=check_serial_numbers, metavar='SERIAL[,SERIAL...]',
+            help='Comma separated serial numbers to assign, in order of device path')
+    serial_group.add_argument('--serial-pattern', type=check_serial_pattern, metavar='PATTERN',
+            help='Assigns serial numbers formatted from this pattern and a counter, such as WD%%018d. '
+                'Serial numbers already in use are skipped')
+    provision_parser.add_argument('--serial-start', type=int, default=1, metavar='NUMBER',
+            help='First counter value used with --serial-pattern. Defaults to 1')
+    provision_parser.add_argument('--jobs', type=check_range(1, 64), default=8, metavar='COUNT',
+            help='Number of USB Watchdogs provisioned at the same time. Defaults to 8')
+
+
+    subparsers.add_parser('oneshot', 
+            parents=[global_parser, watchdog_settings_parser, settings_parser, pet_parser],
+            help='Pets the Watchdog once and exits', 
+            epilog='Returns 0 on success or 1 if an error occurs')
+
+
+    schedule_parser = argparse.ArgumentParser(add_help=False)
+    schedule_parser.add_argument('--pet-interval', type=check_pet_interval, default=1, 
+            help='Set time in seconds between when the USB Watchdog is \'pet\'. '
+            'This should be well below the Watchdog timeout threshold. Fractions of a second are accepted. '
+            '\'auto\' picks the longest interval that keeps the safety margin, given the '
+            'USB Watchdog timeout and the recent pet latency')
+    schedule_parser.add_argument('--safety-margin', type=check_fraction, default=0.5, metavar='FRACTION',
+            help='Fraction of the USB Watchdog timeout kept in reserve by --pet-interval auto. Defaults to 0.5')
+    schedule_parser.add_argument('--latency-window', type=check_range(1, 1024), default=32, metavar='COUNT',
+            help='Number of recent pets whose latency --pet-interval auto accounts for. Defaults to 32')
+    schedule_parser.add_argument('--jitter-budget', type=check_seconds, default=0.25, metavar='SECONDS',
+            help='How late a pet may be before its deadline is considered missed. Defaults to 0.25')
+    schedule_parser.add_argument('--missed-deadline', choices=['skip', 'reset'], default='skip',
+            help='After a missed deadline, \'skip\' drops the missed pets and keeps the original schedule, '
+                '\'reset\' restarts the schedule from the late pet. Defaults to skip')
+    schedule_parser.add_argument('--slack-warning', type=check_seconds, default=1.0, metavar='SECONDS',
+            help='Warns when a pet lands less than this many seconds before the USB Watchdog timeout. Defaults to 1')
+
+
+    reconnect_parser = argparse.ArgumentParser(add_help=False)
+    reconnect_parser.add_argument('--reconnect-max-delay', type=check_seconds, default=5.0, metavar='SECONDS',
+            help='Longest wait between attempts to reopen a disconnected USB Watchdog. Defaults to 5')
+
+
+    recorder_parser = argparse.ArgumentParser(add_help=False)
+    recorder_parser.add_argument('--flight-recorder', metavar='PATH',
+            help='Keeps the pet history in this memory mapped file, so it survives a reset by the USB Watchdog. '
+                'Read it with the dump action')
+    recorder_parser.add_argument('--flight-recorder-size', type=check_range(1, 2**20), default=4096, metavar='COUNT',
+            help='Number of events kept by the flight recorder. Defaults to 4096')
+    recorder_parser.add_argument('--flight-recorder-sync', type=check_seconds, default=1.0, metavar='SECONDS',
+            help='Longest time flight recorder events stay unwritten to disk. 0 writes every event at once. '
+                'Defaults to 1')
+
+
+    subparsers.add_parser('continuous',
+            parents=[global_parser, watchdog_settings_parser, settings_parser, pet_parser, schedule_parser,
+                reconnect_parser, health_parser, metrics_parser, recorder_parser],
+            help='Pets the USB Watchdog continuously',
+            epilog='Returns 0 on success or 1 if an error occurs')
+
+
+    aggregate_parser = subparsers.add_parser('aggregate',
+            parents=[global_parser, watchdog_settings_parser, settings_parser, pet_parser, schedule_parser,
+                reconnect_parser, metrics_parser, recorder_parser],
+            help='Pets the USB Watchdog only while a quorum of heartbeat senders is alive. '
+                'A USB Watchdog in beacon mode is turned on when the quorum is lost instead, with metrics, '
+                'the flight recorder and --control-socket working as for a petter',
+            epilog='Heartbeats are datagrams holding the name of their sender. An empty datagram is '
+                'attributed to its source host, or for Unix sockets to the path the sender bound. '
+                'Returns 0 on success or 1 if an error occurs')
+    aggregate_parser.add_argument('--listen-udp', action='append', default=[], type=check_tcp_check,
+            metavar='HOST:PORT',
+            help='Receives heartbeats on this UDP address. May be given multiple times. Senders sharing '
+                'a host only count separately when their heartbeats hold their names')
+    aggregate_parser.add_argument('--listen-unix', action='append', default=[], metavar='PATH',
+            help='Receives heartbeats on this Unix datagram socket. May be given multiple times')
+    aggregate_parser.add_argument('--quorum', type=check_range(1, 1000), required=True, metavar='COUNT',
+            help='Number of senders that must have sent a heartbeat within --heartbeat-expiry. '
+                'May not exceed the number of --sender entries')
+    aggregate_parser.add_argument('--heartbeat-expiry', type=check_seconds, default=5.0, metavar='SECONDS',
+            help='Time after which a sender without a new heartbeat no longer counts. Defaults to 5')
+    aggregate_parser.add_argument('--sender', action='append', default=[], metavar='NAME',
+            help='Only counts heartbeats from this sender. May be given multiple times. '
+                'Heartbeats from any sender count when not given')
+    aggregate_parser.add_argument('--startup-grace', type=check_seconds, default=0.0, metavar='SECONDS',
+            help='Time after starting during which the quorum is assumed, so senders have time to start. '
+                'Defaults to 0')
+
+
+    fleet_parser = subparsers.add_parser('fleet',
+            parents=[global_parser, watchdog_settings_parser, settings_parser, pet_parser, schedule_parser,
+                reconnect_parser, health_parser, metrics_parser],
+            help='Configures and pets every attached USB Watchdog continuously',
+            epilog='Returns 0 on success, or the first error code reported by a USB Watchdog')
+    fleet_parser.add_argument('--report-interval', type=check_timeout, default=60, metavar='SECONDS',
+            help='Set time in seconds between per-device status reports when --verbose is given. Defaults to 60')
+
+
+    subparsers.add_parser('invalidate-path-cache',
+            parents=[global_parser],
+            help='Forgets the device paths remembered in --path-cache. Meant to be run from a udev rule, e.g. '
+                'ACTION=="add|remove", ATTRS{idVendor}=="16d0", ATTRS{idProduct}=="0776", '
+                'RUN+="/usr/bin/usb_watchdog.py invalidate-path-cache"',
+            epilog='Returns 0 on success or 1 if an error occurs')
+
+
+    subparsers.add_parser('broker',
+            parents=[global_parser],
+            help='Holds the USB Watchdog open and serves requests for it on --control-socket, '
+                'so other actions do not have to open it themselves',
+            epilog='Returns 0 on success or 1 if an error occurs')
+
+
+    status_parser = subparsers.add_parser('status',
+            parents=[global_parser],
+            help='Reports the settings and live status of the USB Watchdog',
+            epilog='Returns 0 on success or 1 if an error occurs')
+    status_parser.add_argument('--json', action='store_true', default=False,
+            help='Reports the settings and status as a JSON object')
+
+
+    subparsers.add_parser('mode',
+            parents=[global_parser],
+            help='Identifies if the USB Watchdog is in watchdog or beacon mode',
+            epilog='Returns 0 if the unit is in watchdog mode, 1 if an error occurs, or 2 if the unit is in beacon mode') 
+
+
+    beacon_parser = subparsers.add_parser('beacon',
+            parents=[global_parser, settings_parser],
+            help='In \'beacon\' mode, this triggers or clears the trigger of the USB Watchdog',
+            epilog='Returns 0 on success, or 1 if an error occurs')
+    beacon_parser.add_argument('beacon_state', 
+            choices=['on', 'off'])
+
+
+    beacon_engine_parser = subparsers.add_parser('beacon-engine',
+            parents=[global_parser, settings_parser, reconnect_parser],
+            help='Holds a USB Watchdog in beacon mode open and turns the beacon on and off from events, '
+                'writing to it only when the debounced state changes',
+            epilog='Events are lines of the form \'on [KEY]\' or \'off [KEY]\', or lines matching '
+                '--on-pattern or --off-pattern. The beacon is on while any KEY is on, and a bare \'off\' '
+                'turns every KEY off. Returns 0 on success or 1 if an error occurs')
+    beacon_engine_parser.add_argument('--listen-fifo', action='append', default=[], metavar='PATH',
+            help='Reads events from this named pipe, creating it if needed. May be given multiple times')
+    beacon_engine_parser.add_argument('--listen-unix', action='append', default=[], metavar='PATH',
+            help='Receives events on this Unix datagram socket. May be given multiple times')
+    beacon_engine_parser.add_argument('--listen-udp', action='append', default=[], type=check_tcp_check,
+            metavar='HOST:PORT',
+            help='Receives events on this UDP address. May be given multiple times')
+    beacon_engine_parser.add_argument('--tail', action='append', default=[], metavar='PATH',
+            help='Reads events from lines appended to this log file, following it across rotation. '
+                'May be given multiple times')
+    beacon_engine_parser.add_argument('--on-pattern', action='append', default=[], type=check_regex,
+            metavar='REGEX',
+            help='Lines matching this regular expression are \'on\' events. A group named key gives their '
+                'KEY. May be given multiple times')
+    beacon_engine_parser.add_argument('--off-pattern', action='append', default=[], type=check_regex,
+            metavar='REGEX',
+            help='Lines matching this regular expression are \'off\' events. A group named key gives their '
+                'KEY. May be given multiple times')
+    beacon_engine_parser.add_argument('--on-delay', type=check_seconds, default=0.0, metavar='SECONDS',
+            help='Time the events must keep asking for the beacon to be on before it is turned on. Defaults to 0')
+    beacon_engine_parser.add_argument('--off-delay', type=check_seconds, default=10.0, metavar='SECONDS',
+            help='Time the events must keep asking for the beacon to be off before it is turned off. Defaults to 10')
+    beacon_engine_parser.add_argument('--min-change-interval', type=check_seconds, default=1.0, metavar='SECONDS',
+            help='Shortest time between two changes of the beacon. Defaults to 1')
+    beacon_engine_parser.add_argument('--event-expiry', type=check_seconds, default=0.0, metavar='SECONDS',
+            help='Time after which a KEY without a new \'on\' event is turned off. '
+                'Defaults to 0, which keeps it on until an \'off\' event')
+
+
+    bench_parser = subparsers.add_parser('bench',
+            parents=[global_parser],
+            help='Measures the latency of USB Watchdog operations and the jitter of the pet schedule. '
+                'Only volatile settings are written, with the values already in effect',
+            epilog='Prints the results in seconds as JSON. Returns 0 on success or 1 if an error occurs')
+    bench_parser.add_argument('--iterations', type=check_range(1, 100000), default=50, metavar='COUNT',
+            help='Number of times each operation is timed. Defaults to 50')
+    bench_parser.add_argument('--jitter-pets', type=check_range(1, 100000), default=50, metavar='COUNT',
+            help='Number of scheduled pets used to measure pet jitter. Defaults to 50')
+    bench_parser.add_argument('--jitter-interval', type=check_seconds, default=0.1, metavar='SECONDS',
+            help='Interval of the pet schedule used to measure pet jitter. Defaults to 0.1')
+
+    dump_parser = subparsers.add_parser('dump',
+            parents=[global_parser],
+            help='Prints the pet history kept in a flight recorder file by continuous --flight-recorder',
+            epilog='Returns 0 on success or 1 if an error occurs')
+    dump_parser.add_argument('path', metavar='PATH',
+            help='Flight recorder file to read')
+    dump_parser.add_argument('--json', action='store_true', default=False,
+            help='Prints one JSON object per event')
+
+    return parser
 	
 ###############################################################################
 
+USBWatchDogSnapshot = collections.namedtuple('USBWatchDogSnapshot', (
+    'version', 'serial_number', 'nonvolatile_timeout', 'volatile_timeout',
+    'nonvolatile_pinglight', 'nonvolatile_buzzer', 'volatile_pinglight', 'volatile_buzzer',
+    'nonvolatile_buzzer_frequency', 'volatile_buzzer_frequency', 'nonvolatile_beacon_mode',
+    'reboot_indicator', 'status'))
+
+
+class CountdownTracker(object):
+    # Estimates how long the USB Watchdog has left before it triggers. The status counter counts
+    # the device's seconds since the last pet, so the host time at which it steps to a new value
+    # pins down the device's elapsed time, and the host time between steps gives the rate of the
+    # device clock relative to the host's monotonic clock. Estimates err towards less time left.
+
+    def __init__(self, window=64):
+        self.lock = threading.Lock()
+        # (counter steps, host seconds) between consecutive counter steps
+        self.intervals = collections.deque(maxlen=window)
+        # Device seconds per host second
+        self.rate = 1.0
+        self.pet_time = None
+        # Host time, unwrapped counter and timing uncertainty of the last counter step
+        self.step = None
+        # Host time, raw and unwrapped counter of the last sample
+        self.last = None
+        self.wraps = 0
+        self.triggered = False
+        self.beacon_mode = False
+
+    def petted(self, now):
+        with self.lock:
+            self.pet_time = now
+            self.step = None
+            self.last = None
+            self.wraps = 0
+            self.triggered = False
+
+    def sampled(self, now, status):
+        triggered, reboot_indicator, beacon_mode, counter = status
+        with self.lock:
+            self.triggered = triggered
+            self.beacon_mode = beacon_mode
+            if self.last is None:
+                self.last = (now, counter, counter)
+                return
+            last_time, last_counter, last_value = self.last
+            if counter < last_counter:
+                if last_counter - counter > 2**15:
+                    self.wraps += 1
+                else:
+                    # Pet by someone else, or a report that predates our own pet
+                    self.step = None
+                    self.wraps = 0
+            value = counter + self.wraps * 2**16
+            if value != last_value:
+                # The step happened somewhere between the previous sample and this one
+                if self.step is not None and value > self.step[1]:
+                    self.intervals.append((value - self.step[1], now - self.step[0]))
+                    ticks = sum(interval[0] for interval in self.intervals)
+                    seconds = sum(interval[1] for interval in self.intervals)
+                    if seconds > 0:
+                        self.rate = min(2.0, max(0.5, ticks / seconds))
+                self.step = (now, value, now - last_time)
+            self.last = (now, counter, value)
+
+    def elapsed(self, now):
+        # Upper bound of the device seconds since the last pet, or None when unknown
+        if self.step is not None:
+            step_time, value, uncertainty = self.step
+            return value + (now - step_time + uncertainty) * self.rate
+        bounds = []
+        if self.last is not None:
+            # The counter may be about to step
+            last_time, counter, value = self.last
+            bounds.append(value + 1 + (now - last_time) * self.rate)
+        if self.pet_time is not None:
+            # Until the counter steps, our own pet is usually the tighter bound
+            bounds.append((now - self.pet_time) * self.rate)
+        return min(bounds) if bounds else None
+
+    def time_to_trigger(self, timeout, now=None):
+        # Host seconds left before the USB Watchdog triggers, or None when unknown
+        if now is None:
+            now = monotonic()
+        with self.lock:
+            if self.beacon_mode:
+                return None
+            if self.triggered:
+                return 0.0
+            elapsed = self.elapsed(now)
+        if elapsed is None:
+            return None
+        return max(0.0, (timeout - elapsed) / self.rate)
+
+
 class USBWatchDog(object):
+    VENDOR_ID = 0x16D0
+    PRODUCT_ID = 0x0776
+
     FR_VERSION = 0x1
     FR_VERSION_LEN = 2
 
     FR_SERIAL_NUMBER = 0x2
     FR_SERIAL_NUMBER_LEN = 20
     SERIAL_NUMBER_LEN = 20
+    UNPROVISIONED_SERIAL_NUMBER = '00000000000000000000'
     
     FR_NONVOLATILE_TIMEOUT = 0x3
     FR_NONVOLATILE_TIMEOUT_LEN = 2
@@ -194,13 +650,34 @@ class USBWatchDog(object):
     OUT_PET_WATCHDOG_LEN = 1
     WATCHDOG_OUT_TIMEOUT_BIT = 0x1
     WATCHDOG_OUT_CLEARALARM_BIT = 0x2
+    # Every output report there is, indexed by its value, so a pet writes a prebuilt buffer.
+    # bytearray indexes to ints on Python 2 as well, which hidapi and the simulator rely on.
+    OUT_REPORTS = (
+        bytearray([OUT_PET_WATCHDOG, 0]),
+        bytearray([OUT_PET_WATCHDOG, WATCHDOG_OUT_TIMEOUT_BIT]),
+        bytearray([OUT_PET_WATCHDOG, WATCHDOG_OUT_CLEARALARM_BIT]),
+        bytearray([OUT_PET_WATCHDOG, WATCHDOG_OUT_TIMEOUT_BIT | WATCHDOG_OUT_CLEARALARM_BIT]),
+    )
+
+    FEATURE_REPORTS = (
+        (FR_VERSION, FR_VERSION_LEN),
+        (FR_SERIAL_NUMBER, FR_SERIAL_NUMBER_LEN),
+        (FR_NONVOLATILE_TIMEOUT, FR_NONVOLATILE_TIMEOUT_LEN),
+        (FR_VOLATILE_TIMEOUT, FR_VOLATILE_TIMEOUT_LEN),
+        (FR_NONVOLATILE_PINGLIGHT_BUZZER, FR_NONVOLATILE_PINGLIGHT_BUZZER_LEN),
+        (FR_VOLATILE_PINGLIGHT_BUZZER, FR_VOLATILE_PINGLIGHT_BUZZER_LEN),
+        (FR_NONVOLATILE_BUZZER_FREQUENCY, FR_NONVOLATILE_BUZZER_FREQUENCY_LEN),
+        (FR_VOLATILE_BUZZER_FREQUENCY, FR_VOLATILE_BUZZER_FREQUENCY_LEN),
+        (FR_REBOOT_INDICATOR, FR_REBOOT_INDICATOR_LEN),
+        (FR_NONVOLATILE_BEACON_MODE, FR_NONVOLATILE_BEACON_MODE_LEN),
+    )
 
     def __check_open(self):
         if self._h is None:
             raise IOError('USB Watchdog not open')  
 
     def __to_uint16(self, array):
-        return array[1]*256 + array[0]
+        return array[0] | array[1] << 8
 
     def __from_uint16(self, val):
         if val > 2**16 - 1:
@@ -208,19 +685,33 @@ class USBWatchDog(object):
         return [val % 256, val // 256]
 
     def __get_feature_report(self, fr_id, length):
-        self.__check_open()
-        array = self._h.get_feature_report(fr_id, length+1)  # report id, max len
-        # hidapi's windows/hid.c seems to append an extra byte at least under Windows 10 (bug?)
-        # We need to strip this off.
-        if len(array) < length+1:
-            raise ValueError('received unexpected value', array)
-        return array[1:length+1]
+        with self._lock:
+            self.__check_open()
+            # Cached payloads are handed out without copying, so they must not be modified
+            if self._cache is not None and fr_id in self._cache:
+                return self._cache[fr_id]
+            array = self._h.get_feature_report(fr_id, length+1)  # report id, max len
+            # hidapi's windows/hid.c seems to append an extra byte at least under Windows 10 (bug?)
+            # We need to strip this off.
+            if len(array) < length+1:
+                raise ValueError('received unexpected value', array)
+            array = array[1:length+1]
+            if self._cache is not None:
+                self._cache[fr_id] = array
+            return array
 
     def __send_feature_report(self, array):
-        self.__check_open()
-        length = self._h.send_feature_report(array)
-        if len(array) != length:
-            raise IOError('data send failed')
+        with self._lock:
+            self.__check_open()
+            length = self._h.send_feature_report(array)
+            if len(array) != length:
+                raise IOError('data send failed')
+            if self._cache is not None:
+                # Writing the reboot indicator clears it rather than storing the written value
+                if array[0] == self.FR_REBOOT_INDICATOR:
+                    self._cache.pop(array[0], None)
+                else:
+                    self._cache[array[0]] = list(array[1:])
 
     def __read_input(self, length, timeout):
         self.__check_open()
@@ -233,89 +724,188 @@ class USBWatchDog(object):
         array = self.__get_feature_report(self.FR_NONVOLATILE_PINGLIGHT_BUZZER, self.FR_NONVOLATILE_PINGLIGHT_BUZZER_LEN)
         return array[0]
 
-    def __set_nonvolatile_pinglight_buzzer(self, pinglight=None, buzzer=None):
-        val = self.__get_nonvolatile_lights_buzzer()
+    def __merge_pinglight_buzzer(self, val, pinglight=None, buzzer=None):
         newval = 0
 
         if pinglight is None:
             newval |= val & self.PINGLIGHT_BIT
-        elif pinglight == True:
+        elif pinglight:
             newval |= self.PINGLIGHT_BIT
 
         if buzzer is None:
             newval |= val & self.BUZZER_BIT
-        elif buzzer is True:
+        elif buzzer:
             newval |= self.BUZZER_BIT
 
-        self.__send_feature_report([self.FR_NONVOLATILE_PINGLIGHT_BUZZER, newval])
+        return newval
+
+    def __set_nonvolatile_pinglight_buzzer(self, pinglight=None, buzzer=None):
+        with self._lock:
+            val = self.__get_nonvolatile_lights_buzzer()
+            newval = self.__merge_pinglight_buzzer(val, pinglight, buzzer)
+            self.__send_feature_report([self.FR_NONVOLATILE_PINGLIGHT_BUZZER, newval])
 
     def __get_volatile_lights_buzzer(self):
         array = self.__get_feature_report(self.FR_VOLATILE_PINGLIGHT_BUZZER, self.FR_VOLATILE_PINGLIGHT_BUZZER_LEN)
         return array[0]
 
     def __set_volatile_pinglight_buzzer(self, pinglight=None, buzzer=None):
-        val = self.__get_volatile_lights_buzzer()
-        newval = 0
-
-        if pinglight is None:
-            newval |= val & self.PINGLIGHT_BIT
-        elif pinglight is True:
-            newval |= self.PINGLIGHT_BIT
-
-        if buzzer is None:
-            newval |= val & self.BUZZER_BIT
-        elif buzzer is True:
-            newval |= self.BUZZER_BIT
-
-        self.__send_feature_report([self.FR_VOLATILE_PINGLIGHT_BUZZER, newval])
+        with self._lock:
+            val = self.__get_volatile_lights_buzzer()
+            newval = self.__merge_pinglight_buzzer(val, pinglight, buzzer)
+            self.__send_feature_report([self.FR_VOLATILE_PINGLIGHT_BUZZER, newval])
 
     def __update_watchdog(self, timeout_bit=True, clear_alarm_bit=True):
-        self.__check_open()
         val = 0
         if timeout_bit:
             val = self.WATCHDOG_OUT_TIMEOUT_BIT
         if clear_alarm_bit:
             val |= self.WATCHDOG_OUT_CLEARALARM_BIT
-        length = self._h.write([self.OUT_PET_WATCHDOG, val])
+        with self._lock:
+            self.__check_open()
+            length = self._h.write(self.OUT_REPORTS[val])
         if self.OUT_PET_WATCHDOG_LEN+1 != length:
             raise ValueError('encountered unexpected error')
 
-    def __init__(self, serial_number=None):
-        self._h = hid.device()
-        self._h.open(0x16D0, 0x0776, serial_number)
+    def __read_status_loop(self, poll_timeout):
+        # The first report may have been queued before the reader started, so it is dropped
+        skip = 1
+        while not self._reader_stop.is_set():
+            try:
+                array = self._h.read(self.IN_WATCHDOG_STATUS_LEN+1, poll_timeout)
+            except (IOError, ValueError) as e:
+                with self._status_condition:
+                    self._reader_error = e
+                    self._status_condition.notify_all()
+                return
+            if len(array) != self.IN_WATCHDOG_STATUS_LEN+1:
+                continue
+            if skip:
+                skip -= 1
+                continue
+            status = self.__decode_status(array)
+            now = monotonic()
+            self.countdown.sampled(now, status)
+            with self._status_condition:
+                self._status = (now, status)
+                self._status_condition.notify_all()
+
+    def __wait_status(self, timeout, max_age):
+        if max_age is None:
+            max_age = self._status_max_age
+        deadline = monotonic() + timeout / 1000.0
+        with self._status_condition:
+            while 1:
+                if self._reader_error is not None:
+                    raise IOError('status reader failed: %s' % self._reader_error)
+                now = monotonic()
+                if self._status is not None and now - self._status[0] <= max_age:
+                    return self._status[1]
+                if now >= deadline:
+                    raise IOError('timed out waiting for status')
+                self._status_condition.wait(deadline - now)
+
+    def __init__(self, serial_number=None, cache=False, transport=None, path=None):
+        # Feature report payloads keyed by report id, or None when caching is disabled
+        self._cache = {} if cache else None
+        # Newest (timestamp, status) sample from the background status reader
+        self._reader = None
+        self._reader_stop = threading.Event()
+        self._reader_error = None
+        self._status = None
+        self._status_max_age = 1.0
+        self._status_condition = threading.Condition()
+        # Serializes HID transfers between threads. Blocking status reads are left outside of
+        # it, as hidapi allows reading while another thread writes.
+        self._lock = threading.RLock()
+        # Register payload the serial number was last decoded from, and the decoded string
+        self._serial_number = (None, None)
+        self.countdown = CountdownTracker()
+        self.transport = transport if transport is not None else HIDTransport()
+        # Unprovisioned USB Watchdogs share a serial number and can only be told apart by path
+        if path is not None:
+            self._h = self.transport.open_path(path)
+        else:
+            self._h = self.transport.open(self.VENDOR_ID, self.PRODUCT_ID, serial_number)
+
+    @classmethod
+    def enumerate(cls, transport=None):
+        if transport is None:
+            transport = HIDTransport()
+        return transport.enumerate(cls.VENDOR_ID, cls.PRODUCT_ID)
     
     def close(self):
         self.__check_open()
+        self.stop_status_reader()
         self._h.close()
         self._h = None
 
+    def start_status_reader(self, max_age=1.0, poll_timeout=100):
+        # Reads status reports in a background thread so get_status() and poll_status()
+        # return the newest sample instead of blocking on the interrupt endpoint
+        self.__check_open()
+        if self._reader is not None:
+            return
+        self._status_max_age = max_age
+        self._reader_stop.clear()
+        self._reader_error = None
+        self._status = None
+        self._reader = threading.Thread(target=self.__read_status_loop, args=(poll_timeout,))
+        self._reader.daemon = True
+        self._reader.start()
+
+    def stop_status_reader(self):
+        if self._reader is None:
+            return
+        self._reader_stop.set()
+        self._reader.join()
+        self._reader = None
+
+    def invalidate(self, fr_id=None):
+        if self._cache is None:
+            return
+        if fr_id is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(fr_id, None)
+
+    def refresh(self):
+        if self._cache is None:
+            raise ValueError('Register cache is not enabled')
+        self._cache.clear()
+        for fr_id, length in self.FEATURE_REPORTS:
+            self.__get_feature_report(fr_id, length)
+
     def get_version(self):
         array = self.__get_feature_report(self.FR_VERSION, self.FR_VERSION_LEN)
         return array[0], array[1]
     
     def get_serial_number(self):
         array = self.__get_feature_report(self.FR_SERIAL_NUMBER, self.FR_SERIAL_NUMBER_LEN)
-        return ''.join(map(chr, array[0:]))
+        # Decoded once per cached payload; the cache hands out the same list until it changes
+        if self._serial_number[0] is not array:
+            self._serial_number = (array, ''.join(map(chr, array)))
+        return self._serial_number[1]
 
     def set_serial_number(self, string):
-        if self.get_serial_number() != '00000000000000000000':
+        if self.get_serial_number() != self.UNPROVISIONED_SERIAL_NUMBER:
             raise ValueError('Serial number is already set')
         if re.match('^[\w-]+$', string) is None:
             raise ValueError('Serial number must be alphanumeric')
         if len(string) != self.SERIAL_NUMBER_LEN:
-            raise ValueError('Serial number must be ', self.SERIAL_NUMBER_LEN, ' characters long')
+            raise ValueError('Serial number must be %d characters long' % self.SERIAL_NUMBER_LEN)
         self.__send_feature_report([self.FR_SERIAL_NUMBER] + [ord(i) for i in string])
 
     def get_nonvolatile_timeout(self):
         array = self.__get_feature_report(self.FR_NONVOLATILE_TIMEOUT, self.FR_NONVOLATILE_TIMEOUT_LEN)
-        return self.__to_uint16(array[0:])
+        return self.__to_uint16(array)
 
     def set_nonvolatile_timeout(self, val):
         self.__send_feature_report([self.FR_NONVOLATILE_TIMEOUT] + self.__from_uint16(val))
 
     def get_volatile_timeout(self):
         array = self.__get_feature_report(self.FR_VOLATILE_TIMEOUT, self.FR_VOLATILE_TIMEOUT_LEN)
-        return self.__to_uint16(array[0:])
+        return self.__to_uint16(array)
 
     def set_volatile_timeout(self, val):
         self.__send_feature_report([self.FR_VOLATILE_TIMEOUT] + self.__from_uint16(val))
@@ -380,21 +970,558 @@ class USBWatchDog(object):
     def set_nonvolatile_beacon_mode(self, val):
         self.__send_feature_report([self.FR_NONVOLATILE_BEACON_MODE, 0x1 if val else 0x0])
 
-    def get_status(self, timeout=2000):
+    def __decode_status(self, array):
+        # Indexes the report in place; hidapi returns a list of ints, so a struct would first
+        # need the report copied into a bytes object
+        flags = array[1]
+        return (bool(flags & self.WATCHDOG_IN_TIMEOUT_BIT), bool(flags & self.WATCHDOG_IN_REBOOT_BIT),
+                bool(flags & self.WATCHDOG_IN_NONVOLATILE_BEACON_MODE_BIT), array[2] | array[3] << 8)
+
+    def get_status(self, timeout=2000, max_age=None):
+        if self._reader is not None:
+            return self.__wait_status(timeout, max_age)
         array = self.__read_input(self.IN_WATCHDOG_STATUS_LEN+1, timeout)
         array = self.__read_input(self.IN_WATCHDOG_STATUS_LEN+1, timeout) # Read twice to flush out old sample
-        triggered = bool(array[1] & self.WATCHDOG_IN_TIMEOUT_BIT)
-        reboot_indicator = bool(array[1] & self.WATCHDOG_IN_REBOOT_BIT)
-        beacon_mode = bool(array[1] & self.WATCHDOG_IN_NONVOLATILE_BEACON_MODE_BIT)
-        counter = self.__to_uint16(array[2:])
-        return triggered, reboot_indicator, beacon_mode, counter
+        status = self.__decode_status(array)
+        self.countdown.sampled(monotonic(), status)
+        return status
+
+    def poll_status(self, max_reports=64, timeout=0):
+        # Drains the queued status reports without blocking and returns the newest one. If the
+        # USB Watchdog has not sent one since the last read, waits up to timeout milliseconds
+        # for the next one, or returns None when no timeout is given.
+        self.__check_open()
+        if self._reader is not None:
+            if timeout:
+                return self.__wait_status(timeout, None)
+            with self._status_condition:
+                if self._reader_error is not None:
+                    raise IOError('status reader failed: %s' % self._reader_error)
+                if self._status is None or monotonic() - self._status[0] > self._status_max_age:
+                    return None
+                return self._status[1]
+        array = None
+        with self._lock:
+            self._h.set_nonblocking(1)
+            try:
+                for i in range(max_reports):
+                    sample = self._h.read(self.IN_WATCHDOG_STATUS_LEN+1)
+                    if not sample:
+                        break
+                    array = sample
+            finally:
+                self._h.set_nonblocking(0)
+        if array is None:
+            if not timeout:
+                return None
+            array = self.__read_input(self.IN_WATCHDOG_STATUS_LEN+1, timeout)
+        if len(array) != self.IN_WATCHDOG_STATUS_LEN+1:
+            raise ValueError('received unexpected value')
+        status = self.__decode_status(array)
+        self.countdown.sampled(monotonic(), status)
+        return status
+
+    def snapshot(self, status=True, timeout=2000):
+        # Every register is read once; status is the get_status() tuple, or None if not requested
+        registers = {}
+        for fr_id, length in self.FEATURE_REPORTS:
+            registers[fr_id] = self.__get_feature_report(fr_id, length)
+        nonvolatile_lights_buzzer = registers[self.FR_NONVOLATILE_PINGLIGHT_BUZZER][0]
+        volatile_lights_buzzer = registers[self.FR_VOLATILE_PINGLIGHT_BUZZER][0]
+        return USBWatchDogSnapshot(
+            version=tuple(registers[self.FR_VERSION]),
+            serial_number=''.join(map(chr, registers[self.FR_SERIAL_NUMBER])),
+            nonvolatile_timeout=self.__to_uint16(registers[self.FR_NONVOLATILE_TIMEOUT]),
+            volatile_timeout=self.__to_uint16(registers[self.FR_VOLATILE_TIMEOUT]),
+            nonvolatile_pinglight=bool(nonvolatile_lights_buzzer & self.PINGLIGHT_BIT),
+            nonvolatile_buzzer=bool(nonvolatile_lights_buzzer & self.BUZZER_BIT),
+            volatile_pinglight=bool(volatile_lights_buzzer & self.PINGLIGHT_BIT),
+            volatile_buzzer=bool(volatile_lights_buzzer & self.BUZZER_BIT),
+            nonvolatile_buzzer_frequency=registers[self.FR_NONVOLATILE_BUZZER_FREQUENCY][0],
+            volatile_buzzer_frequency=registers[self.FR_VOLATILE_BUZZER_FREQUENCY][0],
+            nonvolatile_beacon_mode=bool(registers[self.FR_NONVOLATILE_BEACON_MODE][0]),
+            reboot_indicator=bool(registers[self.FR_REBOOT_INDICATOR][0]),
+            status=self.get_status(timeout) if status else None)
+
+    def plan(self, config):
+        # Returns the feature reports needed to bring the device in line with config,
+        # reading each register at most once and leaving out writes that would not change it
+        reports = []
+
+        def stage(fr_id, current, newval):
+            if current != newval:
+                reports.append([fr_id] + newval)
+
+        if config.get('nonvolatile_timeout') is not None:
+            stage(self.FR_NONVOLATILE_TIMEOUT,
+                    self.__get_feature_report(self.FR_NONVOLATILE_TIMEOUT, self.FR_NONVOLATILE_TIMEOUT_LEN),
+                    self.__from_uint16(config['nonvolatile_timeout']))
+
+        if config.get('timeout') is not None:
+            stage(self.FR_VOLATILE_TIMEOUT,
+                    self.__get_feature_report(self.FR_VOLATILE_TIMEOUT, self.FR_VOLATILE_TIMEOUT_LEN),
+                    self.__from_uint16(config['timeout']))
+
+        for fr_id, length, pinglight_key, buzzer_key in (
+                (self.FR_NONVOLATILE_PINGLIGHT_BUZZER, self.FR_NONVOLATILE_PINGLIGHT_BUZZER_LEN,
+                    'nonvolatile_pinglight', 'nonvolatile_buzzer'),
+                (self.FR_VOLATILE_PINGLIGHT_BUZZER, self.FR_VOLATILE_PINGLIGHT_BUZZER_LEN,
+                    'pinglight', 'buzzer')):
+            pinglight = config.get(pinglight_key)
+            buzzer = config.get(buzzer_key)
+            if pinglight is None and buzzer is None:
+                continue
+            current = self.__get_feature_report(fr_id, length)
+            stage(fr_id, current, [self.__merge_pinglight_buzzer(current[0], pinglight, buzzer)])
+
+        for fr_id, length, key in (
+                (self.FR_NONVOLATILE_BUZZER_FREQUENCY, self.FR_NONVOLATILE_BUZZER_FREQUENCY_LEN,
+                    'nonvolatile_buzzer_frequency'),
+                (self.FR_VOLATILE_BUZZER_FREQUENCY, self.FR_VOLATILE_BUZZER_FREQUENCY_LEN,
+                    'buzzer_frequency')):
+            if config.get(key) is not None:
+                if config[key] > 2**8 - 1:
+                    raise ValueError('Frequency value is too large')
+                stage(fr_id, self.__get_feature_report(fr_id, length), [config[key]])
+
+        if config.get('nonvolatile_beacon_mode') is not None:
+            stage(self.FR_NONVOLATILE_BEACON_MODE,
+                    self.__get_feature_report(self.FR_NONVOLATILE_BEACON_MODE, self.FR_NONVOLATILE_BEACON_MODE_LEN),
+                    [0x1 if config['nonvolatile_beacon_mode'] else 0x0])
+
+        # The reboot indicator is cleared by writing 0x1, so only write it while it is set
+        if config.get('clear_reboot_indicator') and self.get_reboot_indicator():
+            reports.append([self.FR_REBOOT_INDICATOR, 0x1])
+
+        return reports
+
+    def apply(self, config):
+        # Held across planning and writing so the read-modify-write cycles are not interleaved
+        with self._lock:
+            reports = self.plan(config)
+            for array in reports:
+                self.__send_feature_report(array)
+        return reports
+
+    def transaction(self):
+        return USBWatchDogTransaction(self)
 
     def pet(self, clear_alarm=True):
+        # Taken before the transfer, as the device may reset its counter any time during it
+        now = monotonic()
         self.__update_watchdog(clear_alarm_bit=True)
+        self.countdown.petted(now)
+
+    def time_to_trigger(self):
+        # Estimated seconds before the USB Watchdog triggers, or None when not yet known
+        return self.countdown.time_to_trigger(self.get_volatile_timeout())
 
     def set_beacon_state(self, triggered=True):  
         self.__update_watchdog(timeout_bit=triggered)
         
+
+class USBWatchDogTransaction(object):
+    # Collects settings changes and writes them with a single USBWatchDog.apply() call
+
+    def __init__(self, watchdog):
+        self._watchdog = watchdog
+        self.config = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+
+    def commit(self):
+        config, self.config = self.config, {}
+        return self._watchdog.apply(config)
+
+    def set_nonvolatile_timeout(self, val):
+        self.config['nonvolatile_timeout'] = val
+
+    def set_volatile_timeout(self, val):
+        self.config['timeout'] = val
+
+    def set_nonvolatile_pinglight(self, val):
+        self.config['nonvolatile_pinglight'] = val
+
+    def set_nonvolatile_buzzer(self, val):
+        self.config['nonvolatile_buzzer'] = val
+
+    def set_volatile_pinglight(self, val):
+        self.config['pinglight'] = val
+
+    def set_volatile_buzzer(self, val):
+        self.config['buzzer'] = val
+
+    def set_nonvolatile_buzzer_frequency(self, val):
+        self.config['nonvolatile_buzzer_frequency'] = val
+
+    def set_volatile_buzzer_frequency(self, val):
+        self.config['buzzer_frequency'] = val
+
+    def set_reboot_indicator(self):
+        self.config['clear_reboot_indicator'] = True
+
+    def set_nonvolatile_beacon_mode(self, val):
+        self.config['nonvolatile_beacon_mode'] = val
+
+
+class AsyncUSBWatchDog(object):
+    # Exposes USBWatchDog calls as awaitables for asyncio applications. Every call runs on a
+    # single worker thread owned by this object, so HID transfers for the device never interleave
+    # and the event loop never blocks on USB.
+
+    METHODS = (
+        'get_version', 'get_serial_number', 'set_serial_number',
+        'get_nonvolatile_timeout', 'set_nonvolatile_timeout',
+        'get_volatile_timeout', 'set_volatile_timeout',
+        'get_nonvolatile_pinglight', 'set_nonvolatile_pinglight',
+        'get_nonvolatile_buzzer', 'set_nonvolatile_buzzer',
+        'get_volatile_pinglight', 'set_volatile_pinglight',
+        'get_volatile_buzzer', 'set_volatile_buzzer',
+        'get_nonvolatile_buzzer_frequency', 'set_nonvolatile_buzzer_frequency',
+        'get_volatile_buzzer_frequency', 'set_volatile_buzzer_frequency',
+        'get_reboot_indicator', 'set_reboot_indicator',
+        'get_nonvolatile_beacon_mode', 'set_nonvolatile_beacon_mode',
+        'get_status', 'poll_status', 'start_status_reader', 'stop_status_reader',
+        'pet', 'set_beacon_state', 'snapshot', 'plan', 'apply', 'invalidate', 'refresh',
+        'time_to_trigger',
+    )
+
+    def __init__(self, serial_number=None, cache=False, watchdog=None, loop=None, transport=None):
+        if asyncio is None:
+            raise RuntimeError('AsyncUSBWatchDog requires asyncio')
+        self._loop = loop
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._opening = None
+        self.watchdog = watchdog
+        if watchdog is None:
+            # Opened on the worker thread; errors are raised by the first awaited call
+            self._opening = self._executor.submit(USBWatchDog, serial_number, cache, transport)
+
+    def __getattr__(self, name):
+        if name not in self.METHODS:
+            raise AttributeError(name)
+        return functools.partial(self._call, name)
+
+    def __invoke(self, name, args, kwargs):
+        if self.watchdog is None:
+            self.watchdog = self._opening.result()
+        return getattr(self.watchdog, name)(*args, **kwargs)
+
+    def _call(self, name, *args, **kwargs):
+        loop = self._loop if self._loop is not None else asyncio.get_event_loop()
+        return loop.run_in_executor(self._executor, self.__invoke, name, args, kwargs)
+
+    def close(self):
+        future = self._call('close')
+        # Already queued calls, including the close, still run before the worker exits
+        self._executor.shutdown(wait=False)
+        return future
+
+
+class HIDTransport(object):
+    # Opens USB Watchdogs through hidapi
+
+    def enumerate(self, vendor_id, product_id):
+        return load_hid().enumerate(vendor_id, product_id)
+
+    def open(self, vendor_id, product_id, serial_number=None):
+        h = load_hid().device()
+        h.open(vendor_id, product_id, serial_number)
+        return h
+
+    def open_path(self, path):
+        h = load_hid().device()
+        h.open_path(path)
+        return h
+
+
+def read_boot_id():
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+class PathCacheTransport(object):
+    # Wraps another transport so USB Watchdogs are opened by a device path remembered on disk,
+    # skipping the enumeration of every HID device that opening by serial number implies.
+    # Entries are dropped after a reboot, when the device at a path has another serial number,
+    # and when opening fails. A miss enumerates once and refreshes every USB Watchdog's entry.
+
+    def __init__(self, transport, path):
+        self.transport = transport
+        self.path = path
+        self.boot_id = read_boot_id()
+        self.paths = self.__load()
+
+    def __load(self):
+        try:
+            with open(self.path) as f:
+                cache = json.load(f)
+            if cache.get('boot_id') == self.boot_id and isinstance(cache.get('paths'), dict):
+                return cache['paths']
+        except (IOError, OSError, ValueError, AttributeError):
+            pass
+        return {}
+
+    def __save(self):
+        # Written to a temporary file first so a concurrent reader never sees a partial file.
+        # A cache that can not be written only costs the next open an enumeration.
+        temporary = '%s.%d.tmp' % (self.path, os.getpid())
+        try:
+            with open(temporary, 'w') as f:
+                json.dump({'boot_id': self.boot_id, 'paths': self.paths}, f, sort_keys=True)
+            os.rename(temporary, self.path)
+        except (IOError, OSError) as e:
+            vprint('Error writing device path cache:', e)
+
+    def enumerate(self, vendor_id, product_id):
+        devices = self.transport.enumerate(vendor_id, product_id)
+        paths = {}
+        for device in devices:
+            path = device['path']
+            paths[str(device['serial_number'])] = path.decode('latin-1') if isinstance(path, bytes) else path
+        if paths != self.paths:
+            self.paths = paths
+            self.__save()
+        return devices
+
+    def __open_cached(self, serial_number):
+        path = self.paths.get(serial_number)
+        if path is None:
+            return None
+        h = None
+        try:
+            h = self.transport.open_path(path.encode('latin-1'))
+            # Paths are handed out again after a replug, so make sure it is still the same device
+            array = h.get_feature_report(USBWatchDog.FR_SERIAL_NUMBER, USBWatchDog.FR_SERIAL_NUMBER_LEN+1)
+            if ''.join(map(chr, array[1:USBWatchDog.FR_SERIAL_NUMBER_LEN+1])) == serial_number:
+                return h
+        except (IOError, OSError, ValueError):
+            pass
+        if h is not None:
+            h.close()
+        vprint('Device path cache entry for', serial_number, 'is stale')
+        del self.paths[serial_number]
+        self.__save()
+        return None
+
+    def open(self, vendor_id, product_id, serial_number=None):
+        if serial_number is not None:
+            h = self.__open_cached(serial_number)
+            if h is not None:
+                return h
+        for device in self.enumerate(vendor_id, product_id):
+            if serial_number in (None, str(device['serial_number'])):
+                return self.transport.open_path(device['path'])
+        raise IOError('open failed')
+
+    def open_path(self, path):
+        return self.transport.open_path(path)
+
+    def invalidate(self):
+        self.paths = {}
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class SimulatedUSBWatchDog(object):
+    # Software model of the USB Watchdog's reports. The status counter is modelled as the
+    # seconds elapsed since the last pet. Every transfer can be slowed down by latency
+    # seconds and fails with probability failure_rate.
+
+    VERSION = [1, 0]
+    UNPROVISIONED_SERIAL_NUMBER = USBWatchDog.UNPROVISIONED_SERIAL_NUMBER
+
+    def __init__(self, serial_number=UNPROVISIONED_SERIAL_NUMBER, timeout=30,
+            latency=0.0, failure_rate=0.0, report_interval=0.1, seed=None):
+        self.serial_number = serial_number
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.report_interval = report_interval
+        self.connected = True
+        self.transfers = 0
+        self.lock = threading.Lock()
+        self._random = random.Random(seed)
+        self.nonvolatile = {
+            USBWatchDog.FR_NONVOLATILE_TIMEOUT: [timeout % 256, timeout // 256],
+            USBWatchDog.FR_NONVOLATILE_PINGLIGHT_BUZZER: [USBWatchDog.PINGLIGHT_BIT | USBWatchDog.BUZZER_BIT],
+            USBWatchDog.FR_NONVOLATILE_BUZZER_FREQUENCY: [100],
+            USBWatchDog.FR_NONVOLATILE_BEACON_MODE: [0x0],
+        }
+        self.power_cycle()
+
+    def power_cycle(self):
+        with self.lock:
+            self.volatile = {
+                USBWatchDog.FR_VOLATILE_TIMEOUT: self.nonvolatile[USBWatchDog.FR_NONVOLATILE_TIMEOUT][:],
+                USBWatchDog.FR_VOLATILE_PINGLIGHT_BUZZER:
+                    self.nonvolatile[USBWatchDog.FR_NONVOLATILE_PINGLIGHT_BUZZER][:],
+                USBWatchDog.FR_VOLATILE_BUZZER_FREQUENCY:
+                    self.nonvolatile[USBWatchDog.FR_NONVOLATILE_BUZZER_FREQUENCY][:],
+            }
+            self.reboot_indicator = True
+            self.beacon_mode = bool(self.nonvolatile[USBWatchDog.FR_NONVOLATILE_BEACON_MODE][0])
+            self.beacon_state = False
+            self.alarm = False
+            self.last_pet = monotonic()
+
+    def transfer(self):
+        # Applies the configured latency and failure injection to one USB transfer
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.transfers += 1
+            if not self.connected:
+                raise IOError('simulated USB Watchdog disconnected')
+            if self.failure_rate and self._random.random() < self.failure_rate:
+                raise IOError('simulated transfer failure')
+
+    def elapsed(self):
+        return monotonic() - self.last_pet
+
+    def triggered(self):
+        if self.beacon_mode:
+            return self.beacon_state
+        timeout = self.volatile[USBWatchDog.FR_VOLATILE_TIMEOUT]
+        if self.elapsed() >= timeout[0] + timeout[1]*256:
+            self.alarm = True
+        return self.alarm
+
+    def get_feature_report(self, fr_id):
+        with self.lock:
+            if fr_id == USBWatchDog.FR_VERSION:
+                return self.VERSION[:]
+            if fr_id == USBWatchDog.FR_SERIAL_NUMBER:
+                return [ord(c) for c in self.serial_number]
+            if fr_id == USBWatchDog.FR_REBOOT_INDICATOR:
+                return [0x1 if self.reboot_indicator else 0x0]
+            if fr_id in self.nonvolatile:
+                return self.nonvolatile[fr_id][:]
+            if fr_id in self.volatile:
+                return self.volatile[fr_id][:]
+        raise IOError('unknown feature report', fr_id)
+
+    def send_feature_report(self, fr_id, payload):
+        with self.lock:
+            if fr_id == USBWatchDog.FR_SERIAL_NUMBER:
+                if self.serial_number != self.UNPROVISIONED_SERIAL_NUMBER:
+                    raise IOError('serial number is already set')
+                self.serial_number = ''.join(map(chr, payload))
+            elif fr_id == USBWatchDog.FR_REBOOT_INDICATOR:
+                self.reboot_indicator = False
+            elif fr_id in self.nonvolatile:
+                self.nonvolatile[fr_id] = list(payload)
+            elif fr_id in self.volatile:
+                self.volatile[fr_id] = list(payload)
+            else:
+                raise IOError('unknown feature report', fr_id)
+
+    def status(self):
+        with self.lock:
+            flags = 0
+            if self.triggered():
+                flags |= USBWatchDog.WATCHDOG_IN_TIMEOUT_BIT
+            if self.reboot_indicator:
+                flags |= USBWatchDog.WATCHDOG_IN_REBOOT_BIT
+            if self.beacon_mode:
+                flags |= USBWatchDog.WATCHDOG_IN_NONVOLATILE_BEACON_MODE_BIT
+            counter = int(self.elapsed()) % 2**16
+            return [USBWatchDog.IN_WATCHDOG_STATUS, flags, counter % 256, counter // 256]
+
+    def update(self, val):
+        with self.lock:
+            if self.beacon_mode:
+                self.beacon_state = bool(val & USBWatchDog.WATCHDOG_OUT_TIMEOUT_BIT)
+                return
+            if val & USBWatchDog.WATCHDOG_OUT_TIMEOUT_BIT:
+                self.last_pet = monotonic()
+            if val & USBWatchDog.WATCHDOG_OUT_CLEARALARM_BIT:
+                self.alarm = False
+
+
+class SimulatedHIDDevice(object):
+    # An open handle to a SimulatedUSBWatchDog with the hid.device interface
+
+    def __init__(self, model):
+        self.model = model
+        self.nonblocking = False
+        self._next_report = monotonic() + model.report_interval
+
+    def close(self):
+        pass
+
+    def set_nonblocking(self, val):
+        self.nonblocking = bool(val)
+        return 0
+
+    def get_feature_report(self, fr_id, length):
+        self.model.transfer()
+        return ([fr_id] + self.model.get_feature_report(fr_id))[:length]
+
+    def send_feature_report(self, array):
+        self.model.transfer()
+        self.model.send_feature_report(array[0], array[1:])
+        return len(array)
+
+    def read(self, length, timeout=0):
+        # Status reports arrive every report_interval seconds, as on the interrupt endpoint
+        now = monotonic()
+        if now < self._next_report:
+            if self.nonblocking:
+                return []
+            wait = self._next_report - now
+            if timeout > 0 and timeout / 1000.0 < wait:
+                time.sleep(timeout / 1000.0)
+                return []
+            time.sleep(wait)
+        self._next_report = max(self._next_report + self.model.report_interval, monotonic())
+        self.model.transfer()
+        return self.model.status()[:length]
+
+    def write(self, array):
+        self.model.transfer()
+        if array[0] != USBWatchDog.OUT_PET_WATCHDOG:
+            raise IOError('unknown output report', array[0])
+        self.model.update(array[1])
+        return len(array)
+
+
+class SimulatedTransport(object):
+    # Stands in for HIDTransport with a set of SimulatedUSBWatchDog models
+
+    def __init__(self, count=1, serial_numbers=None, **kwargs):
+        if serial_numbers is None:
+            serial_numbers = ['SIM%017d' % i for i in range(count)]
+        self.devices = [SimulatedUSBWatchDog(serial_number, **kwargs) for serial_number in serial_numbers]
+
+    def enumerate(self, vendor_id, product_id):
+        return [{'path': ('sim:%d' % i).encode('ascii'), 'serial_number': model.serial_number,
+                    'vendor_id': vendor_id, 'product_id': product_id}
+                for i, model in enumerate(self.devices) if model.connected]
+
+    def open(self, vendor_id, product_id, serial_number=None):
+        for model in self.devices:
+            if model.connected and serial_number in (None, model.serial_number):
+                return SimulatedHIDDevice(model)
+        raise IOError('open failed')
+
+    def open_path(self, path):
+        if not isinstance(path, str):
+            path = path.decode('ascii')
+        prefix, sep, index = path.partition(':')
+        if prefix == 'sim' and index.isdigit() and int(index) < len(self.devices):
+            model = self.devices[int(index)]
+            if model.connected:
+                return SimulatedHIDDevice(model)
+        raise IOError('open failed')
+
 ###############################################################################
 
 class USBWatchDogError(Exception):
@@ -402,101 +1529,1221 @@ class USBWatchDogError(Exception):
         self.error_number = error_number 
 
 
+class USBWatchDogIOError(USBWatchDogError):
+    # Raised when talking to the USB Watchdog fails, as opposed to it reporting an unwanted state
+    pass
+
+
+class USBWatchDogManager(object):
+    # Stands in for a USBWatchDog and reopens it by serial number when it disconnects,
+    # reapplying the volatile settings that were lost with it
+
+    VOLATILE_SETTINGS = ('timeout', 'pinglight', 'buzzer', 'buzzer_frequency')
+
+    def __init__(self, serial_number=None, cache=True, status_max_age=None,
+            initial_delay=0.01, max_delay=5.0, transport=None):
+        self.serial_number = serial_number
+        self.cache = cache
+        self.transport = transport
+        self.status_max_age = status_max_age
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.volatile_config = {}
+        self.reconnects = 0
+        self.stopped = False
+        self.closed = False
+        self.watchdog = self.__open()
+        if self.serial_number is None:
+            self.serial_number = self.watchdog.get_serial_number()
+
+    def __getattr__(self, name):
+        if name == 'watchdog':
+            raise AttributeError(name)
+        return getattr(self.watchdog, name)
+
+    def __open(self):
+        watchdog = USBWatchDog(self.serial_number, cache=self.cache, transport=self.transport)
+        if self.status_max_age is not None:
+            watchdog.start_status_reader(self.status_max_age)
+        return watchdog
+
+    def apply(self, config):
+        reports = self.watchdog.apply(config)
+        for key in self.VOLATILE_SETTINGS:
+            if config.get(key) is not None:
+                self.volatile_config[key] = config[key]
+        return reports
+
+    def transaction(self):
+        return USBWatchDogTransaction(self)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.watchdog.close()
+
+    def reconnect(self):
+        try:
+            self.closed = True
+            self.watchdog.close()
+        except (IOError, ValueError):
+            pass
+
+        delay = self.initial_delay
+        attempts = 1
+        while not self.stopped:
+            watchdog = None
+            try:
+                watchdog = self.__open()
+                watchdog.apply(self.volatile_config)
+            except (IOError, ValueError) as e:
+                if watchdog is not None:
+                    try:
+                        watchdog.close()
+                    except (IOError, ValueError):
+                        pass
+                vprint('Reconnect attempt', attempts, 'failed:', e)
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_delay)
+                attempts += 1
+                continue
+
+            self.watchdog = watchdog
+            self.closed = False
+            self.reconnects += 1
+            print('Reconnected to USB Watchdog', self.serial_number, 'after', attempts, 'attempts')
+            return
+
+        raise USBWatchDogIOError(1)
+
+
+verbose = False
+
 def vprint(*print_args, **print_kwargs):
-    if args.verbose:
+    if verbose:
         print(*print_args, **print_kwargs)
 
 
-def general_configure(watchdog):
+class PetScheduler(object):
+    # Pets against absolute monotonic deadlines so time spent petting does not stretch the period
+
+    # Shortest interval an adaptive schedule tightens to
+    MIN_ADAPTIVE_INTERVAL = 0.05
+
+    def __init__(self, interval, jitter_budget=0.25, missed_deadline='skip',
+            device_timeout=None, slack_warning=1.0, adaptive=False, safety_margin=0.5, latency_window=32,
+            time_to_trigger=None):
+        self.interval = interval
+        self.jitter_budget = jitter_budget
+        self.missed_deadline = missed_deadline
+        self.device_timeout = device_timeout
+        self.slack_warning = slack_warning
+        self.adaptive = adaptive
+        self.safety_margin = safety_margin
+        self.latencies = collections.deque(maxlen=latency_window)
+        # Returns the estimated seconds left before the USB Watchdog triggers, or None
+        self.time_to_trigger = time_to_trigger
+        if adaptive:
+            self.interval = self.adaptive_interval()
+        self.deadline = None
+        self.last_pet = None
+        self.pets = 0
+        self.missed = 0
+        self.stopped = False
+        # Monotonic time petting resumes at, infinite when paused until resume() is called
+        self.paused_until = None
+        # Set to cut a wait short after the deadline was moved
+        self._wakeup = threading.Event()
+
+    def pause(self, seconds=None):
+        self.paused_until = float('inf') if seconds is None else monotonic() + seconds
+
+    def resume(self):
+        self.paused_until = None
+
+    def paused(self):
+        return self.paused_until is not None and monotonic() < self.paused_until
+
+    def wait(self):
+        now = monotonic()
+        if self.deadline is None:
+            self.deadline = now
+        while 1:
+            self._wakeup.clear()
+            if self.deadline <= now:
+                return now
+            self._wakeup.wait(self.deadline - now)
+            now = monotonic()
+
+    def set_device_timeout(self, device_timeout):
+        # An adaptive schedule follows the new timeout at once. A pending deadline picked for a
+        # longer timeout is pulled in, as it could otherwise land after the USB Watchdog triggers.
+        self.device_timeout = device_timeout
+        if self.adaptive:
+            self.interval = self.adaptive_interval()
+            if self.deadline is not None and self.last_pet is not None:
+                self.deadline = min(self.deadline, self.last_pet + self.interval)
+            self._wakeup.set()
+
+    def adaptive_interval(self):
+        # The longest interval after which a late wakeup and the slowest recent pet still land
+        # before the reserved part of the timeout. Using the slowest pet of the window tightens
+        # the schedule as soon as latency spikes and relaxes it once the spike has aged out.
+        # The countdown estimate is the timeout in host seconds, corrected for the device clock
+        # running fast or slow. It counts from now, while the interval counts from the last pet.
+        remaining = self.time_to_trigger() if self.time_to_trigger is not None else None
+        if remaining is not None and self.last_pet is not None:
+            remaining += monotonic() - self.last_pet
+        if remaining is None:
+            remaining = self.device_timeout
+        if remaining is None:
+            return self.interval
+        latency = max(self.latencies) if self.latencies else 0.0
+        interval = remaining * (1 - self.safety_margin) - self.jitter_budget - latency
+        return max(self.MIN_ADAPTIVE_INTERVAL, interval)
+
+    def petted(self, start, now=None):
+        if now is None:
+            now = monotonic()
+        if self.device_timeout is not None and self.last_pet is not None:
+            slack = self.last_pet + self.device_timeout - now
+            if slack < self.slack_warning:
+                print('Warning: pet landed %.3f seconds before the USB Watchdog timeout' % slack)
+        self.last_pet = now
+        self.pets += 1
+        self.latencies.append(now - start)
+
+        if self.adaptive:
+            interval = self.adaptive_interval()
+            if abs(interval - self.interval) > 0.1 * self.interval:
+                vprint('Pet interval adapted to %.3f seconds' % interval)
+            self.interval = interval
+
+        self.__advance(start, now)
+
+    def skipped(self, start):
+        self.__advance(start, monotonic())
+
+    def __advance(self, start, now):
+        lateness = start - self.deadline
+        self.deadline += self.interval
+        if lateness > self.jitter_budget:
+            self.missed += 1
+            print('Warning: pet was %.3f seconds late' % lateness)
+            if self.missed_deadline == 'reset':
+                self.deadline = start + self.interval
+        if self.deadline <= now:
+            # Drop the pets that can no longer be made on time, keeping the schedule's phase
+            self.deadline += (int((now - self.deadline) // self.interval) + 1) * self.interval
+
+
+class HealthCheck(object):
+    # A liveness check run in its own thread every interval seconds. Callers only ever look at
+    # the outcome of the last completed run, so a slow check can not hold up a pet.
+
+    def __init__(self, name, interval=5.0, timeout=2.0):
+        self.name = name
+        self.interval = interval
+        self.timeout = timeout
+        self.failures = 0
+        self._lock = threading.Lock()
+        self._started = None
+        self._timed_out = False
+        self._due = 0
+
+    def check(self):
+        raise NotImplementedError
+
+    def __run(self):
+        try:
+            healthy = bool(self.check())
+        except Exception as e:
+            vprint('Health check', self.name, 'raised', e)
+            healthy = False
+        with self._lock:
+            late = monotonic() - self._started > self.timeout
+            if healthy and not late:
+                self.failures = 0
+            elif not self._timed_out:
+                self.failures += 1
+            self._started = None
+
+    def poll(self, now):
+        with self._lock:
+            if self._started is not None:
+                # A hung run counts as one more failure every interval until it returns
+                if now - self._started > self.timeout and now >= self._due:
+                    self.failures += 1
+                    self._timed_out = True
+                    self._due = now + self.interval
+                return
+            if now >= self._due:
+                self._started = now
+                self._timed_out = False
+                self._due = now + self.interval
+                thread = threading.Thread(target=self.__run)
+                thread.daemon = True
+                thread.start()
+
+
+class CommandCheck(HealthCheck):
+    def __init__(self, command, **kwargs):
+        HealthCheck.__init__(self, command, **kwargs)
+        self.command = command
+
+    def check(self):
+        with open(os.devnull, 'w') as devnull:
+            process = subprocess.Popen(self.command, shell=True, stdout=devnull, stderr=devnull)
+            deadline = monotonic() + self.timeout
+            while process.poll() is None:
+                if monotonic() > deadline:
+                    process.kill()
+                    process.wait()
+                    return False
+                time.sleep(0.05)
+        return process.returncode == 0
+
+
+class FileFreshnessCheck(HealthCheck):
+    def __init__(self, path, max_age, **kwargs):
+        HealthCheck.__init__(self, path, **kwargs)
+        self.path = path
+        self.max_age = max_age
+
+    def check(self):
+        return time.time() - os.path.getmtime(self.path) <= self.max_age
+
+
+class TCPCheck(HealthCheck):
+    def __init__(self, host, port, **kwargs):
+        HealthCheck.__init__(self, '%s:%d' % (host, port), **kwargs)
+        self.address = (host, port)
+
+    def check(self):
+        socket.create_connection(self.address, self.timeout).close()
+        return True
+
+
+class CallableCheck(HealthCheck):
+    def __init__(self, function, name=None, **kwargs):
+        HealthCheck.__init__(self, name or getattr(function, '__name__', repr(function)), **kwargs)
+        self.function = function
+
+    def check(self):
+        return self.function()
+
+
+class HealthMonitor(object):
+    # Decides whether to pet from the cached results of concurrently run health checks
+
+    def __init__(self, checks, failure_threshold=3):
+        self.checks = checks
+        self.failure_threshold = failure_threshold
+        self.failing = []
+        # Fleet members share one monitor, so only one of them reports each change
+        self._lock = threading.Lock()
+
+    def healthy(self):
+        now = monotonic()
+        for check in self.checks:
+            check.poll(now)
+        failing = [check.name for check in self.checks if check.failures >= self.failure_threshold]
+        with self._lock:
+            if failing != self.failing:
+                if failing:
+                    print('Not petting USB Watchdog while health checks fail:', ', '.join(failing))
+                else:
+                    print('Health checks recovered, petting USB Watchdog again')
+                self.failing = failing
+        return not failing
+
+
+def create_health_monitor(args):
+    kwargs = {'interval': args.check_interval, 'timeout': args.check_timeout}
+    checks = [CommandCheck(command, **kwargs) for command in args.check_command]
+    checks += [FileFreshnessCheck(path, max_age, **kwargs) for path, max_age in args.check_file]
+    checks += [TCPCheck(host, port, **kwargs) for host, port in args.check_tcp]
+    for module, function in args.check_python:
+        try:
+            function = getattr(importlib.import_module(module), function)
+        except (ImportError, AttributeError) as e:
+            print('Error loading health check', module + ':' + function + ':', e)
+            raise USBWatchDogError(1)
+        checks.append(CallableCheck(function, name=module + ':' + function.__name__, **kwargs))
+    if not checks:
+        return None
+    return HealthMonitor(checks, args.check_failure_threshold)
+
+
+class PetMetrics(object):
+    # Pet loop statistics of one USB Watchdog. The pet loop records into it and exporters only
+    # read it, so exporting never adds USB transfers.
+
+    LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self, serial_number, timeout=None):
+        self.serial_number = serial_number
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.pets = 0
+        self.skipped = 0
+        self.missed = 0
+        self.usb_errors = 0
+        self.reconnects = 0
+        self.last_pet = None
+        self.interval = None
+        self.latency_counts = [0] * (len(self.LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.status = None
+        self.status_time = None
+        # Host time of the last countdown estimate, the estimate and the device clock rate
+        self.countdown = None
+
+    def estimated(self, remaining, rate):
+        with self.lock:
+            self.countdown = (monotonic(), remaining, rate)
+
+    def sampled(self, status):
+        if status is not None:
+            with self.lock:
+                self.status = status
+                self.status_time = monotonic()
+
+    def petted(self, latency):
+        with self.lock:
+            self.pets += 1
+            self.last_pet = time.time()
+            self.latency_sum += latency
+            for i, bound in enumerate(self.LATENCY_BUCKETS):
+                if latency <= bound:
+                    break
+            else:
+                i = len(self.LATENCY_BUCKETS)
+            self.latency_counts[i] += 1
+
+    def samples(self):
+        # Returns (name, suffix, extra labels, value) tuples for render_metrics
+        with self.lock:
+            samples = [
+                ('pets_total', '', '', self.pets),
+                ('skipped_pets_total', '', '', self.skipped),
+                ('missed_deadlines_total', '', '', self.missed),
+                ('usb_errors_total', '', '', self.usb_errors),
+                ('reconnects_total', '', '', self.reconnects),
+            ]
+            if self.last_pet is not None:
+                samples.append(('last_pet_timestamp_seconds', '', '', self.last_pet))
+            cumulative = 0
+            for bound, count in zip(self.LATENCY_BUCKETS + ('+Inf',), self.latency_counts):
+                cumulative += count
+                samples.append(('pet_latency_seconds', '_bucket', ',le="%s"' % bound, cumulative))
+            samples.append(('pet_latency_seconds', '_sum', '', self.latency_sum))
+            samples.append(('pet_latency_seconds', '_count', '', cumulative))
+            if self.timeout is not None:
+                samples.append(('timeout_seconds', '', '', self.timeout))
+            if self.interval is not None:
+                samples.append(('pet_interval_seconds', '', '', self.interval))
+            if self.status is not None:
+                triggered, reboot_indicator, beacon_mode, counter = self.status
+                samples.append(('triggered', '', '', int(triggered)))
+                samples.append(('reboot_indicator', '', '', int(reboot_indicator)))
+                samples.append(('beacon_mode', '', '', int(beacon_mode)))
+                samples.append(('counter', '', '', counter))
+                if self.timeout is not None and not beacon_mode and self.countdown is None:
+                    remaining = self.timeout - counter - (monotonic() - self.status_time)
+                    samples.append(('remaining_timeout_seconds', '', '', max(0.0, remaining)))
+            if self.countdown is not None:
+                estimate_time, remaining, rate = self.countdown
+                if remaining is not None:
+                    remaining -= monotonic() - estimate_time
+                    samples.append(('remaining_timeout_seconds', '', '', max(0.0, remaining)))
+                samples.append(('clock_rate', '', '', rate))
+        return samples
+
+
+METRICS = (
+    ('pets_total', 'counter', 'Number of times the USB Watchdog was pet'),
+    ('skipped_pets_total', 'counter', 'Number of pets skipped because health checks failed'),
+    ('missed_deadlines_total', 'counter', 'Number of pets later than the jitter budget'),
+    ('usb_errors_total', 'counter', 'Number of failed USB transfers in the pet loop'),
+    ('reconnects_total', 'counter', 'Number of times the USB Watchdog was reopened'),
+    ('last_pet_timestamp_seconds', 'gauge', 'Unix time of the last pet'),
+    ('pet_latency_seconds', 'histogram', 'Time taken by each pet, including status checks'),
+    ('timeout_seconds', 'gauge', 'Volatile timeout of the USB Watchdog'),
+    ('pet_interval_seconds', 'gauge', 'Current time between scheduled pets'),
+    ('triggered', 'gauge', 'Whether the last status sample reported the USB Watchdog as triggered'),
+    ('reboot_indicator', 'gauge', 'Whether the last status sample reported the reboot indicator as set'),
+    ('beacon_mode', 'gauge', 'Whether the last status sample reported beacon mode'),
+    ('counter', 'gauge', 'Counter of the last status sample'),
+    ('remaining_timeout_seconds', 'gauge', 'Estimated time left before the USB Watchdog triggers'),
+    ('clock_rate', 'gauge', 'Estimated USB Watchdog seconds per host second'),
+)
+
+
+def render_metrics(metrics_list):
+    samples = [(metrics.serial_number, metrics.samples()) for metrics in metrics_list]
+    lines = []
+    for name, kind, description in METRICS:
+        family = []
+        for serial_number, device_samples in samples:
+            for sample_name, suffix, labels, value in device_samples:
+                if sample_name == name:
+                    family.append('usb_watchdog_%s%s{serial_number="%s"%s} %s' % (
+                            name, suffix, serial_number, labels, repr(float(value))))
+        if family:
+            lines.append('# HELP usb_watchdog_%s %s' % (name, description))
+            lines.append('# TYPE usb_watchdog_%s %s' % (name, kind))
+            lines.extend(family)
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render_metrics(self.server.metrics_list).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *log_args):
+        pass
+
+
+def write_metrics_textfile(path, metrics_list):
+    # Written to a temporary file first so the collector never reads a partial file
+    temporary = path + '.tmp'
+    with open(temporary, 'w') as f:
+        f.write(render_metrics(metrics_list))
+    os.rename(temporary, path)
+
+
+def start_metrics_exporters(args, metrics_list):
+    if args.metrics_port is not None:
+        try:
+            server = HTTPServer((args.metrics_address, args.metrics_port), MetricsRequestHandler)
+        except (IOError, OSError) as e:
+            print('Error starting metrics server:', e)
+            raise USBWatchDogError(1)
+        server.metrics_list = metrics_list
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        vprint('Serving metrics on', args.metrics_address + ':' + str(args.metrics_port))
+
+    if args.metrics_textfile is not None:
+        def write_periodically():
+            while 1:
+                try:
+                    write_metrics_textfile(args.metrics_textfile, metrics_list)
+                except (IOError, OSError) as e:
+                    print('Error writing metrics:', e)
+                time.sleep(args.metrics_interval)
+        thread = threading.Thread(target=write_periodically)
+        thread.daemon = True
+        thread.start()
+
+
+class FlightRecorder(object):
+    # Fixed-size ring buffer of pet loop events, packed into a bytearray or a memory mapped file.
+    # Recording an event overwrites the oldest slot in place, so a long running petter allocates
+    # nothing for its history, and the mapped file still holds it after the USB Watchdog resets the host.
+
+    MAGIC = b'USBWDFR1'
+    # Magic, record size, capacity and the number of events ever recorded
+    HEADER = struct.Struct('<8sIIQ')
+    # Monotonic time, wall clock time, latency, counter, event and status bits
+    RECORD = struct.Struct('<ddfHBB')
+
+    EVENT_START = 1
+    EVENT_PET = 2
+    EVENT_SKIPPED = 3
+    EVENT_USB_ERROR = 4
+    EVENT_RECONNECT = 5
+    EVENT_MISSED = 6
+    EVENT_BEACON_ON = 7
+    EVENT_BEACON_OFF = 8
+    EVENT_NAMES = {EVENT_START: 'start', EVENT_PET: 'pet', EVENT_SKIPPED: 'skipped',
+            EVENT_USB_ERROR: 'usb_error', EVENT_RECONNECT: 'reconnect', EVENT_MISSED: 'missed',
+            EVENT_BEACON_ON: 'beacon_on', EVENT_BEACON_OFF: 'beacon_off'}
+
+    STATUS_KNOWN_BIT = 0x1
+    STATUS_TRIGGERED_BIT = 0x2
+    STATUS_REBOOT_BIT = 0x4
+    STATUS_BEACON_MODE_BIT = 0x8
+
+    def __init__(self, capacity=4096, path=None, sync_interval=1.0):
+        self.path = path
+        self.sync_interval = sync_interval
+        # Set by the SIGUSR1 handler; the pet loop prints the history, as printing from a signal
+        # handler could interleave with, or deadlock against, output from the interrupted code
+        self.dump_requested = False
+        self._lock = threading.Lock()
+        self._file = None
+        # Pending flush of events recorded since the last one
+        self._flusher = None
+        size = self.HEADER.size + capacity * self.RECORD.size
+        if path is None:
+            self.buffer = bytearray(size)
+            self.count = 0
+        else:
+            self._file = open(path, 'a+b')
+            self._file.seek(0, os.SEEK_END)
+            # Existing history is kept and appended to, unless it is from a differently sized recorder
+            preserve = self._file.tell() == size
+            if not preserve:
+                self._file.truncate(size)
+            self.buffer = mmap.mmap(self._file.fileno(), size)
+            magic, record_size, file_capacity, count = self.HEADER.unpack_from(self.buffer, 0)
+            if preserve and magic == self.MAGIC and record_size == self.RECORD.size and file_capacity == capacity:
+                self.count = count
+            else:
+                self.count = 0
+        self.capacity = capacity
+        self.HEADER.pack_into(self.buffer, 0, self.MAGIC, self.RECORD.size, capacity, self.count)
+        self.record(self.EVENT_START)
+
+    def record(self, event, latency=0.0, status=None):
+        bits = 0
+        counter = 0
+        if status is not None:
+            triggered, reboot_indicator, beacon_mode, counter = status
+            bits = self.STATUS_KNOWN_BIT
+            if triggered:
+                bits |= self.STATUS_TRIGGERED_BIT
+            if reboot_indicator:
+                bits |= self.STATUS_REBOOT_BIT
+            if beacon_mode:
+                bits |= self.STATUS_BEACON_MODE_BIT
+        with self._lock:
+            offset = self.HEADER.size + (self.count % self.capacity) * self.RECORD.size
+            self.RECORD.pack_into(self.buffer, offset, monotonic(), time.time(), latency, counter, event, bits)
+            self.count += 1
+            self.HEADER.pack_into(self.buffer, 0, self.MAGIC, self.RECORD.size, self.capacity, self.count)
+            if self._file is None:
+                return
+            # Every event reaches the disk within sync_interval seconds, even if no other event follows it
+            if self.sync_interval <= 0:
+                self.buffer.flush()
+            elif self._flusher is None:
+                self._flusher = threading.Timer(self.sync_interval, self.flush)
+                self._flusher.daemon = True
+                self._flusher.start()
+
+    def flush(self):
+        with self._lock:
+            self._flusher = None
+            if self._file is not None:
+                self.buffer.flush()
+
+    def close(self):
+        with self._lock:
+            if self._flusher is not None:
+                self._flusher.cancel()
+                self._flusher = None
+            if self._file is not None:
+                self.buffer.flush()
+                self.buffer.close()
+                self._file.close()
+                self._file = None
+
+    @classmethod
+    def events(cls, buffer):
+        # Returns the recorded events, oldest first, as dicts
+        magic, record_size, capacity, count = cls.HEADER.unpack_from(buffer, 0)
+        if magic != cls.MAGIC or record_size != cls.RECORD.size:
+            raise ValueError('not a flight recorder file')
+        if len(buffer) < cls.HEADER.size + capacity * record_size:
+            raise ValueError('flight recorder file is truncated')
+        events = []
+        for index in range(max(0, count - capacity), count):
+            offset = cls.HEADER.size + (index % capacity) * record_size
+            uptime, timestamp, latency, counter, event, bits = cls.RECORD.unpack_from(buffer, offset)
+            entry = {'index': index, 'monotonic': uptime, 'time': timestamp,
+                    'event': cls.EVENT_NAMES.get(event, str(event)), 'latency': latency}
+            if bits & cls.STATUS_KNOWN_BIT:
+                entry['status'] = {'triggered': bool(bits & cls.STATUS_TRIGGERED_BIT),
+                        'reboot_indicator': bool(bits & cls.STATUS_REBOOT_BIT),
+                        'beacon_mode': bool(bits & cls.STATUS_BEACON_MODE_BIT), 'counter': counter}
+            events.append(entry)
+        return events
+
+    def snapshot(self):
+        with self._lock:
+            return self.events(bytes(self.buffer[:]))
+
+
+def print_flight_events(events, as_json=False):
+    for entry in events:
+        if as_json:
+            print(json.dumps(entry, sort_keys=True))
+            continue
+        line = '%s.%03d %-10s' % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['time'])),
+                int(entry['time'] * 1000) % 1000, entry['event'])
+        if entry['event'] == 'pet':
+            line += ' latency %.3f ms' % (entry['latency'] * 1000)
+        status = entry.get('status')
+        if status is not None:
+            line += ' counter %d' % status['counter']
+            for key in ('triggered', 'reboot_indicator', 'beacon_mode'):
+                if status[key]:
+                    line += ' ' + key
+        print(line.rstrip())
+
+
+def start_flight_recorder(args):
+    try:
+        recorder = FlightRecorder(args.flight_recorder_size, args.flight_recorder, args.flight_recorder_sync)
+    except (IOError, OSError, ValueError) as e:
+        print('Error opening flight recorder:', e)
+        raise USBWatchDogError(1)
+
+    # SIGUSR1 has the pet loop print the history without stopping the petter
+    def dump(signum, frame):
+        recorder.dump_requested = True
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, dump)
+    # Flushes the history before the process ends
+    exit_on_sigterm()
+    return recorder
+
+
+def exit_on_sigterm():
+    # Unwinds the main thread like a clean exit, so sockets are removed and files flushed
+    def terminate(signum, frame):
+        raise USBWatchDogError(0)
+    signal.signal(signal.SIGTERM, terminate)
+
+
+class SystemdNotifier(object):
+    # Sends sd_notify() messages when run as a Type=notify systemd service, and does nothing otherwise
+
+    def __init__(self, address=None):
+        if address is None:
+            address = os.environ.get('NOTIFY_SOCKET')
+        self.address = None
+        self._socket = None
+        if address:
+            # A leading @ names a socket in the abstract namespace
+            if address[0] == '@':
+                address = '\0' + address[1:]
+            self.address = address
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+    def watchdog_interval(self):
+        # Seconds between the keep-alives systemd expects, when WatchdogSec= is set for us
+        usec = os.environ.get('WATCHDOG_USEC')
+        pid = os.environ.get('WATCHDOG_PID')
+        if not usec or not usec.isdigit() or (pid is not None and pid != str(os.getpid())):
+            return None
+        return int(usec) / 1000000.0
+
+    def notify(self, state):
+        if self._socket is None:
+            return False
+        try:
+            self._socket.sendto(state.encode('utf-8'), self.address)
+        except (IOError, OSError) as e:
+            vprint('Error notifying systemd:', e)
+            return False
+        return True
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+
+# First file descriptor passed by systemd socket activation
+SD_LISTEN_FDS_START = 3
+
+def systemd_listen_fds():
+    fds = os.environ.get('LISTEN_FDS')
+    if not fds or not fds.isdigit() or os.environ.get('LISTEN_PID') != str(os.getpid()):
+        return 0
+    return int(fds)
+
+
+def check_bool(value):
+    if not isinstance(value, bool):
+        raise ValueError('%r must be true or false' % (value,))
+    return value
+
+
+class ControlServer(object):
+    # Answers newline delimited JSON requests on a Unix socket using the petter's own USB Watchdog,
+    # so querying or reconfiguring it needs neither a second handle nor a stopped petter
+
+    # Settings that may be changed through the configure command, or a call to apply or a setter.
+    # Beacon mode is only accepted when not petting, as the petter stops once the USB Watchdog
+    # becomes a beacon.
+    SETTINGS = {
+        'nonvolatile_timeout': check_timeout,
+        'timeout': check_timeout,
+        'nonvolatile_pinglight': check_bool,
+        'pinglight': check_bool,
+        'nonvolatile_buzzer': check_bool,
+        'buzzer': check_bool,
+        'nonvolatile_buzzer_frequency': check_frequency,
+        'buzzer_frequency': check_frequency,
+        'clear_reboot_indicator': check_bool,
+    }
+
+    SETTERS = {
+        'set_nonvolatile_timeout': 'nonvolatile_timeout',
+        'set_volatile_timeout': 'timeout',
+        'set_nonvolatile_pinglight': 'nonvolatile_pinglight',
+        'set_volatile_pinglight': 'pinglight',
+        'set_nonvolatile_buzzer': 'nonvolatile_buzzer',
+        'set_volatile_buzzer': 'buzzer',
+        'set_nonvolatile_buzzer_frequency': 'nonvolatile_buzzer_frequency',
+        'set_volatile_buzzer_frequency': 'buzzer_frequency',
+        'set_nonvolatile_beacon_mode': 'nonvolatile_beacon_mode',
+    }
+
+    COMMANDS = ('status', 'configure', 'pause', 'resume', 'beacon', 'call')
+
+    def __init__(self, path, watchdog, scheduler=None, metrics=None):
+        self.path = path
+        self.watchdog = watchdog
+        self.scheduler = scheduler
+        self.metrics = metrics
+        self.closed = False
+        if systemd_listen_fds():
+            # Socket activated: systemd already bound and is listening on the socket
+            self.path = None
+            self.socket = socket.fromfd(SD_LISTEN_FDS_START, socket.AF_UNIX, socket.SOCK_STREAM)
+            os.close(SD_LISTEN_FDS_START)
+        else:
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            # A socket left behind by an earlier run would make bind fail
+            if os.path.exists(path):
+                probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    probe.connect(path)
+                except (IOError, OSError):
+                    os.unlink(path)
+                else:
+                    raise IOError('%s is already being served' % path)
+                finally:
+                    probe.close()
+            self.socket.bind(path)
+            os.chmod(path, 0o600)
+            self.socket.listen(5)
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        while not self.closed:
+            try:
+                connection, address = self.socket.accept()
+            except (IOError, OSError) as e:
+                if not self.closed:
+                    print('Error accepting control connection:', e)
+                return
+            thread = threading.Thread(target=self.handle, args=(connection,))
+            thread.daemon = True
+            thread.start()
+
+    def handle(self, connection):
+        try:
+            stream = connection.makefile('rb')
+            for line in iter(stream.readline, b''):
+                if not line.strip():
+                    continue
+                response = json.dumps(self.dispatch(line), sort_keys=True) + '\n'
+                connection.sendall(response.encode('utf-8'))
+        except (IOError, OSError) as e:
+            vprint('Control connection failed:', e)
+        finally:
+            connection.close()
+
+    def dispatch(self, line):
+        try:
+            request = json.loads(line.decode('utf-8'))
+            if not isinstance(request, dict) or request.get('command') not in self.COMMANDS:
+                raise ValueError('command must be one of ' + ', '.join(self.COMMANDS))
+            response = getattr(self, 'command_' + request['command'])(request)
+        except (IOError, OSError) as e:
+            return {'ok': False, 'error': str(e), 'type': 'IOError'}
+        except (argparse.ArgumentTypeError, TypeError, ValueError) as e:
+            return {'ok': False, 'error': str(e), 'type': 'ValueError'}
+        except USBWatchDogError as e:
+            return {'ok': False, 'error': 'USB Watchdog error %d' % e.error_number}
+        response['ok'] = True
+        return response
+
+    def __check_scheduler(self):
+        if self.scheduler is None:
+            raise ValueError('not petting the USB Watchdog')
+
+    def command_status(self, request):
+        response = snapshot_to_dict(self.watchdog.snapshot())
+        if self.scheduler is not None:
+            response['paused'] = self.scheduler.paused()
+            response['pets'] = self.scheduler.pets
+            response['missed'] = self.scheduler.missed
+        return response
+
+    def __configure(self, settings):
+        config = {}
+        for key, value in settings.items():
+            check = self.SETTINGS.get(key)
+            if check is None and key == 'nonvolatile_beacon_mode' and self.scheduler is None:
+                check = check_bool
+            if check is None:
+                raise ValueError('unknown setting ' + key)
+            config[key] = check(value)
+        reports = self.watchdog.apply(config)
+        if config.get('timeout') is not None and self.scheduler is not None:
+            self.scheduler.set_device_timeout(config['timeout'])
+            if self.metrics is not None:
+                self.metrics.timeout = config['timeout']
+        return reports
+
+    def command_configure(self, request):
+        settings = request.get('settings')
+        if not isinstance(settings, dict) or not settings:
+            raise ValueError('settings must be a non-empty object')
+        return {'reports': len(self.__configure(settings))}
+
+    def command_pause(self, request):
+        self.__check_scheduler()
+        seconds = request.get('seconds')
+        if seconds is not None:
+            seconds = check_seconds(seconds)
+        self.scheduler.pause(seconds)
+        print('Petting paused' + ('' if seconds is None else ' for %g seconds' % seconds))
+        return {'paused': True}
+
+    def command_resume(self, request):
+        self.__check_scheduler()
+        self.scheduler.resume()
+        print('Petting resumed')
+        return {'paused': False}
+
+    def command_beacon(self, request):
+        state = request.get('state')
+        if state not in ('on', 'off'):
+            raise ValueError('state must be on or off')
+        triggered, reboot_indicator, beacon_mode, counter = self.watchdog.get_status()
+        if not beacon_mode:
+            raise ValueError('USB Watchdog is in watchdog mode')
+        self.watchdog.set_beacon_state(state == 'on')
+        return {'state': state}
+
+    def command_call(self, request):
+        # Runs a USBWatchDog method for a USBWatchDogClient. Calls from all connections go through
+        # the one open USB Watchdog, whose lock keeps their transfers apart.
+        method = request.get('method')
+        if method not in USBWatchDogClient.METHODS:
+            raise ValueError('unknown method %s' % (method,))
+        call_args = request.get('args', [])
+        call_kwargs = request.get('kwargs', {})
+        if not isinstance(call_args, list) or not isinstance(call_kwargs, dict):
+            raise ValueError('args must be an array and kwargs an object')
+        call_kwargs = dict((str(key), value) for key, value in call_kwargs.items())
+        # Settings changes get the same checks and scheduler updates as the configure command
+        if method == 'apply':
+            config = call_kwargs.get('config', call_args[0] if call_args else None)
+            if not isinstance(config, dict):
+                raise ValueError('config must be an object')
+            return {'result': self.__configure(dict(
+                    (key, value) for key, value in config.items() if value is not None))}
+        if method in self.SETTERS:
+            if len(call_args) != 1 or call_kwargs:
+                raise ValueError('%s takes a single value' % method)
+            self.__configure({self.SETTERS[method]: call_args[0]})
+            return {'result': None}
+        return {'result': getattr(self.watchdog, method)(*call_args, **call_kwargs)}
+
+    def close(self):
+        self.closed = True
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except (IOError, OSError):
+            pass
+        self.socket.close()
+        if self.path is not None and os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class USBWatchDogClient(object):
+    # Stands in for a USBWatchDog by sending each call to the ControlServer of a broker or
+    # continuous petter that already holds the USB Watchdog open
+
+    METHODS = tuple(name for name in AsyncUSBWatchDog.METHODS
+            if name not in ('set_serial_number', 'start_status_reader', 'stop_status_reader'))
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._socket.connect(path)
+        except (IOError, OSError):
+            self._socket.close()
+            raise
+        self._stream = self._socket.makefile('rb')
+
+    def __getattr__(self, name):
+        if name not in self.METHODS:
+            raise AttributeError(name)
+        return functools.partial(self._call, name)
+
+    def _call(self, method, *call_args, **call_kwargs):
+        request = json.dumps({'command': 'call', 'method': method, 'args': list(call_args),
+                'kwargs': call_kwargs}) + '\n'
+        with self._lock:
+            self._socket.sendall(request.encode('utf-8'))
+            line = self._stream.readline()
+        if not line:
+            raise IOError('control socket closed')
+        response = json.loads(line.decode('utf-8'))
+        if not response['ok']:
+            if response.get('type') == 'IOError':
+                raise IOError(response['error'])
+            raise ValueError(response['error'])
+        result = response['result']
+        # JSON turns tuples into lists
+        if method == 'snapshot':
+            result[0] = tuple(result[0])
+            if result[-1] is not None:
+                result[-1] = tuple(result[-1])
+            return USBWatchDogSnapshot(*result)
+        if method in ('get_version', 'get_status', 'poll_status') and result is not None:
+            return tuple(result)
+        return result
+
+    def transaction(self):
+        return USBWatchDogTransaction(self)
+
+    def start_status_reader(self, max_age=1.0, poll_timeout=100):
+        # The serving process runs its own status reader
+        pass
+
+    def stop_status_reader(self):
+        pass
+
+    def close(self):
+        self._stream.close()
+        self._socket.close()
+
+
+def open_control_client(args):
+    # Returns a USBWatchDogClient when --control-socket is being served for the requested
+    # USB Watchdog, or None to have the caller open it directly
+    if args.control_socket is None or not os.path.exists(args.control_socket):
+        return None
+    try:
+        client = USBWatchDogClient(args.control_socket)
+        if args.serial_number is not None and client.get_serial_number() != args.serial_number:
+            vprint('Control socket serves another USB Watchdog, opening it directly')
+            client.close()
+            return None
+    except (IOError, OSError, ValueError) as e:
+        vprint('Not using control socket:', e)
+        return None
+    vprint('Using USB Watchdog through', args.control_socket)
+    return client
+
+
+def start_control_server(args, watchdog, scheduler=None, metrics=None):
+    if args.control_socket is None and not systemd_listen_fds():
+        return None
     try:
-        if hasattr(args, 'nonvolatile_timeout') and args.nonvolatile_timeout is not None:
-            vprint('Setting nonvolatile timeout to', args.nonvolatile_timeout, 'seconds')
-            watchdog.set_nonvolatile_timeout(args.nonvolatile_timeout)
+        server = ControlServer(args.control_socket, watchdog, scheduler, metrics)
+    except (IOError, OSError) as e:
+        print('Error starting control server:', e)
+        raise USBWatchDogError(1)
+    vprint('Serving control requests on', server.path or 'the socket passed by systemd')
+    return server
+
+
+# Config file options, named after the matching command line options, and the apply() keys they set
+CONFIG_FILE_OPTIONS = {
+    'nonvolatile-timeout': ('nonvolatile_timeout', check_timeout),
+    'timeout': ('timeout', check_timeout),
+    'nonvolatile-pinglight': ('nonvolatile_pinglight', check_switch),
+    'pinglight': ('pinglight', check_switch),
+    'nonvolatile-buzzer': ('nonvolatile_buzzer', check_switch),
+    'buzzer': ('buzzer', check_switch),
+    'nonvolatile-buzzer-frequency': ('nonvolatile_buzzer_frequency', check_frequency),
+    'buzzer-frequency': ('buzzer_frequency', check_frequency),
+    'nonvolatile-beacon-mode': ('nonvolatile_beacon_mode', check_switch),
+    'clear-reboot-indicator': ('clear_reboot_indicator', check_switch),
+}
+
+def load_config_file(path, serial_number):
+    parser = configparser.RawConfigParser()
+    try:
+        if not parser.read(path):
+            raise IOError('unable to read config file ' + path)
+    except configparser.Error as e:
+        raise ValueError('invalid config file %s: %s' % (path, e))
+
+    if parser.has_section(serial_number):
+        options = parser.items(serial_number)
+    else:
+        options = parser.defaults().items()
+
+    config = {}
+    for option, value in options:
+        option = option.replace('_', '-')
+        if option not in CONFIG_FILE_OPTIONS:
+            raise ValueError('unknown option %s in config file %s' % (option, path))
+        key, check = CONFIG_FILE_OPTIONS[option]
+        try:
+            config[key] = check(value)
+        except (argparse.ArgumentTypeError, ValueError) as e:
+            raise ValueError('invalid %s in config file %s: %s' % (option, path, e))
+    return config
+
+
+def describe_report(array):
+    names = dict((getattr(USBWatchDog, name), name) for name in dir(USBWatchDog)
+            if name.startswith('FR_') and not name.endswith('_LEN'))
+    return '%s (0x%X): %s' % (names.get(array[0], 'unknown report'), array[0],
+            ' '.join('0x%02X' % value for value in array[1:]))
+
+
+def create_transaction(watchdog, args):
+    # Collects the settings given by the config file and the command line, which take precedence
+    transaction = watchdog.transaction()
+
+    if getattr(args, 'config', None) is not None:
+        serial_number = watchdog.get_serial_number()
+        vprint('Reading settings for', serial_number, 'from', args.config)
+        transaction.config.update(load_config_file(args.config, serial_number))
+
+    if hasattr(args, 'nonvolatile_timeout') and args.nonvolatile_timeout is not None:
+        vprint('Setting nonvolatile timeout to', args.nonvolatile_timeout, 'seconds')
+        transaction.set_nonvolatile_timeout(args.nonvolatile_timeout)
+
+    if hasattr(args, 'timeout') and args.timeout is not None:
+        vprint('Setting volatile timeout to', args.timeout, 'seconds')
+        transaction.set_volatile_timeout(args.timeout)
+
 
-        if hasattr(args, 'timeout') and args.timeout is not None:
-            vprint('Setting volatile timeout to', args.timeout, 'seconds')
-            watchdog.set_volatile_timeout(args.timeout)
+    if args.nonvolatile_pinglight is not None:
+        vprint('Setting nonvolatile ping light to', args.nonvolatile_pinglight)
+        transaction.set_nonvolatile_pinglight(
+            True if args.nonvolatile_pinglight == 'on' else False)
 
+    if args.pinglight is not None:
+        vprint('Setting volatile ping light to', args.pinglight)
+        transaction.set_volatile_pinglight(
+            True if args.pinglight == 'on' else False)
 
-        if args.nonvolatile_pinglight is not None:
-            vprint('Setting nonvolatile ping light to', args.nonvolatile_pinglight)
-            watchdog.set_nonvolatile_pinglight(
-                True if args.nonvolatile_pinglight == 'on' else False)
 
-        if args.pinglight is not None:
-            vprint('Setting volatile ping light to', args.pinglight)
-            watchdog.set_volatile_pinglight(
-                True if args.pinglight == 'on' else False)
+    if args.nonvolatile_buzzer is not None:
+        vprint('Setting nonvolatile buzzer to', args.nonvolatile_buzzer)
+        transaction.set_nonvolatile_buzzer(
+            True if args.nonvolatile_buzzer == 'on' else False)
 
+    if args.buzzer is not None:
+        vprint('Setting volatile buzzer to', args.buzzer)
+        transaction.set_volatile_buzzer(
+            True if args.buzzer == 'on' else False)
 
-        if args.nonvolatile_buzzer is not None:
-            vprint('Setting nonvolatile buzzer to', args.nonvolatile_buzzer)
-            watchdog.set_nonvolatile_buzzer(
-                True if args.nonvolatile_buzzer == 'on' else False)
 
-        if args.buzzer is not None:
-            vprint('Setting volatile buzzer to', args.buzzer)
-            watchdog.set_volatile_buzzer(
-                True if args.buzzer == 'on' else False)
+    if args.nonvolatile_buzzer_frequency is not None:
+        vprint('Setting nonvolatile buzzer frequency to', args.nonvolatile_buzzer_frequency)
+        transaction.set_nonvolatile_buzzer_frequency(args.nonvolatile_buzzer_frequency)
 
+    if args.buzzer_frequency is not None:
+        vprint('Setting volatile buzzer frequency to', args.buzzer_frequency)
+        transaction.set_volatile_buzzer_frequency(args.buzzer_frequency)
 
-        if args.nonvolatile_buzzer_frequency is not None:
-            vprint('Setting nonvolatile buzzer frequency to', args.nonvolatile_buzzer_frequency)
-            watchdog.set_nonvolatile_buzzer_frequency(args.nonvolatile_buzzer_frequency)
+    if hasattr(args, 'nonvolatile_beacon_mode') and args.nonvolatile_beacon_mode is not None:
+        vprint('Setting nonvolatile beacon mode to', args.nonvolatile_beacon_mode)
+        transaction.set_nonvolatile_beacon_mode(
+            True if args.nonvolatile_beacon_mode == 'on' else False)
 
-        if args.buzzer_frequency is not None:
-            vprint('Setting volatile buzzer frequency to', args.buzzer_frequency)
-            watchdog.set_volatile_buzzer_frequency(args.buzzer_frequency)
+    if args.clear_reboot_indicator:
+        vprint('Clearing reboot indicator')
+        transaction.set_reboot_indicator()
 
-        if hasattr(args, 'nonvolatile_beacon_mode') and args.nonvolatile_beacon_mode is not None:
-            vprint('Setting nonvolatile beacon mode to', args.nonvolatile_beacon_mode)
-            watchdog.set_nonvolatile_beacon_mode(
-                True if args.nonvolatile_beacon_mode == 'on' else False)
+    return transaction
 
-        if args.clear_reboot_indicator:
-            vprint('Clearing reboot indicator')
-            watchdog.set_reboot_indicator()
-    except (IOError, ValueError), e:
+
+def general_configure(watchdog, args):
+    try:
+        transaction = create_transaction(watchdog, args)
+
+        if getattr(args, 'dry_run', False):
+            reports = watchdog.plan(transaction.config)
+            for array in reports:
+                print('Would write', describe_report(array))
+            if not reports:
+                print('Settings already match, nothing would be written')
+            return
+
+        requested = bool(transaction.config)
+        reports = transaction.commit()
+        if requested and not reports:
+            vprint('Settings already match, nothing written')
+    except (IOError, ValueError) as e:
         print('Error configuring USB Watchdog:', e)
         raise USBWatchDogError(1)
 
 
+def print_snapshot(snapshot, printer=print):
+    printer('Serial number:', snapshot.serial_number)
+    printer('Nonvolatile timeout:', snapshot.nonvolatile_timeout, 'seconds')
+    printer('Volatile timeout:', snapshot.volatile_timeout, 'seconds')
+    printer('Nonvolatile ping light:', 'on' if snapshot.nonvolatile_pinglight else 'off')
+    printer('Nonvolatile buzzer:', 'on' if snapshot.nonvolatile_buzzer else 'off')
+    printer('Volatile ping light:', 'on' if snapshot.volatile_pinglight else 'off')
+    printer('Volatile buzzer:', 'on' if snapshot.volatile_buzzer else 'off')
+    printer('Nonvolatile buzzer frequency:', snapshot.nonvolatile_buzzer_frequency)
+    printer('Volatile buzzer frequency:', snapshot.volatile_buzzer_frequency)
+    printer('Beacon mode:', 'on' if snapshot.nonvolatile_beacon_mode else 'off')
+    printer('Reboot indicator:', snapshot.reboot_indicator)
+    if snapshot.status is not None:
+        triggered, reboot_indicator, beacon_mode, counter = snapshot.status
+        printer('Triggered:', triggered)
+        printer('Counter:', counter)
+
+
+def snapshot_to_dict(snapshot):
+    result = snapshot._asdict()
+    result['version'] = '%d.%d' % snapshot.version
+    if snapshot.status is not None:
+        result['status'] = dict(zip(('triggered', 'reboot_indicator', 'beacon_mode', 'counter'),
+                snapshot.status))
+    return result
+
+
 def print_settings(watchdog):
     try:
-        vprint('~Configuration info~')
-        vprint('Serial number:',
-                watchdog.get_serial_number())
-        vprint('Nonvolatile timeout:',
-                watchdog.get_nonvolatile_timeout(), 'seconds')
-        vprint('Volatile timeout:',
-                watchdog.get_volatile_timeout(), 'seconds')
-        vprint('Nonvolatile ping light:',
-                'on' if watchdog.get_nonvolatile_pinglight() else 'off')
-        vprint('Nonvolatile buzzer:',
-                'on' if watchdog.get_nonvolatile_buzzer() else 'off')
-        vprint('Volatile ping light:',
-                'on' if watchdog.get_volatile_pinglight() else 'off')
-        vprint('Volatile buzzer:',
-                'on' if watchdog.get_volatile_buzzer() else 'off')
-        vprint('Nonvolatile buzzer frequency:', 
-                watchdog.get_nonvolatile_buzzer_frequency())
-        vprint('Volatile buzzer frequency:',
-                watchdog.get_volatile_buzzer_frequency())
-        vprint('Beacon mode:',
-                'on' if watchdog.get_nonvolatile_beacon_mode() else 'off')
-        vprint('Reboot indicator:', watchdog.get_reboot_indicator())
-        vprint('~~~~~~~~~~~~~~~~~~~~')
-    except (IOError, ValueError), e:
+        snapshot = watchdog.snapshot(status=False)
+    except (IOError, ValueError) as e:
         print('Error obtaining USB Watchdog settings:', e)
         raise USBWatchDogError(1)
 
+    vprint('~Configuration info~')
+    print_snapshot(snapshot, vprint)
+    vprint('~~~~~~~~~~~~~~~~~~~~')
+
+
+def handle_petting(watchdog, args, health=None):
+    if health is not None and not health.healthy():
+        return False
+
+    if not args.detect_reboot and not args.detect_triggered:
+        handle_fast_petting(watchdog)
+        return True
 
-def handle_petting(watchdog):
     try:
         triggered, reboot_indicator, beacon_mode, counter = watchdog.get_status()
-    except (IOError, ValueError), e:
+    except (IOError, ValueError) as e:
         print('Error obtaining USB Watchdog status:', e)
-        raise USBWatchDogError(1)
+        raise USBWatchDogIOError(1)
 
     if beacon_mode:
         print('USB Watchdog is in beacon mode!')
@@ -513,37 +2760,864 @@ def handle_petting(watchdog):
     try:
         vprint('Petting')
         watchdog.pet()
-    except (IOError, ValueError), e:
+    except (IOError, ValueError) as e:
         print('Error petting USB Watchdog:', e)
+        raise USBWatchDogIOError(1)
+    return True
+
+
+def handle_fast_petting(watchdog):
+    # Only beacon mode matters when reboots and triggers are not being detected. Take it from
+    # whatever status report is already queued, so a pet usually costs a single USB write instead
+    # of two blocking status reads. The beacon mode register is no use here: a change to it only
+    # takes effect when the USB Watchdog reboots.
+    try:
+        beacon_mode = watchdog.poll_status(timeout=2000)[2]
+    except (IOError, ValueError) as e:
+        print('Error obtaining USB Watchdog status:', e)
+        raise USBWatchDogIOError(1)
+
+    if beacon_mode:
+        print('USB Watchdog is in beacon mode!')
         raise USBWatchDogError(1)
 
+    try:
+        vprint('Petting')
+        watchdog.pet()
+    except (IOError, ValueError) as e:
+        print('Error petting USB Watchdog:', e)
+        raise USBWatchDogIOError(1)
 
-def handle_configure_action(watchdog):
-    general_configure(watchdog)
+
+def handle_configure_action(watchdog, args):
+    general_configure(watchdog, args)
     print_settings(watchdog)
 
 
-def handle_oneshot_action(watchdog):
-    general_configure(watchdog)
+def handle_oneshot_action(watchdog, args):
+    general_configure(watchdog, args)
     print_settings(watchdog)
-    handle_petting(watchdog)
+    handle_petting(watchdog, args)
 
 
-def handle_continuous_action(watchdog):
-    general_configure(watchdog)
+def handle_continuous_action(watchdog, args):
+    general_configure(watchdog, args)
     print_settings(watchdog)
+    run_petter(watchdog, args, create_health_monitor(args))
 
-    vprint('Pet interval:', args.pet_interval)
-        
+
+def run_petter(watchdog, args, health=None):
+    scheduler = create_pet_scheduler(watchdog, args)
+    vprint('Pet interval:', args.pet_interval if not scheduler.adaptive else
+            'auto, starting at %.3f seconds' % scheduler.interval)
+    metrics = PetMetrics(watchdog.serial_number, scheduler.device_timeout)
+    start_metrics_exporters(args, [metrics])
+
+    notifier = SystemdNotifier()
+    interval = notifier.watchdog_interval()
+    if interval is not None and scheduler.interval > interval / 2:
+        print('Warning: pet interval is above half of the systemd watchdog interval of', interval, 'seconds')
+    recorder = start_flight_recorder(args)
+    try:
+        control = start_control_server(args, watchdog, scheduler, metrics)
+        try:
+            notifier.notify('READY=1')
+            run_pet_loop(watchdog, args, scheduler, health, metrics, notifier, recorder)
+        finally:
+            notifier.notify('STOPPING=1')
+            notifier.close()
+            if control is not None:
+                control.close()
+    finally:
+        recorder.close()
+
+
+class HeartbeatTracker(object):
+    # Time of the last heartbeat of every sender, kept oldest first. A heartbeat moves its sender
+    # to the end and expiry only ever looks at the front, so both cost O(1) per sender.
+
+    def __init__(self, expiry, senders=None):
+        self.expiry = expiry
+        self.senders = set(senders) if senders else None
+        self.last_seen = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.received = 0
+
+    def beat(self, sender, now=None):
+        if self.senders is not None and sender not in self.senders:
+            return False
+        if now is None:
+            now = monotonic()
+        with self.lock:
+            self.received += 1
+            self.last_seen.pop(sender, None)
+            self.last_seen[sender] = now
+        return True
+
+    def fresh(self, now=None):
+        if now is None:
+            now = monotonic()
+        with self.lock:
+            while self.last_seen:
+                for sender in self.last_seen:
+                    break
+                if now - self.last_seen[sender] <= self.expiry:
+                    break
+                del self.last_seen[sender]
+            return len(self.last_seen)
+
+
+class QuorumGate(object):
+    # Takes the place of a HealthMonitor, healthy while at least quorum senders are fresh
+
+    def __init__(self, tracker, quorum, grace=0.0):
+        self.tracker = tracker
+        self.quorum = quorum
+        self.grace_until = monotonic() + grace
+        self.state = None
+
+    def healthy(self):
+        fresh = self.tracker.fresh()
+        healthy = fresh >= self.quorum or monotonic() < self.grace_until
+        if healthy != self.state:
+            print('Quorum %s: %d of %d senders alive' % ('held' if healthy else 'lost', fresh, self.quorum))
+            self.state = healthy
+        return healthy
+
+
+def open_listen_sockets(args):
+    sockets = []
+    try:
+        for host, port in args.listen_udp:
+            sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_DGRAM)
+            sockets.append(sock)
+            sock.bind((host, port))
+        for path in args.listen_unix:
+            if os.path.exists(path):
+                # Only a socket left behind by an earlier run is replaced
+                if not stat.S_ISSOCK(os.stat(path).st_mode):
+                    raise IOError('%s is not a socket' % path)
+                probe = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                try:
+                    probe.connect(path)
+                except (IOError, OSError):
+                    os.unlink(path)
+                else:
+                    raise IOError('%s is already being listened on' % path)
+                finally:
+                    probe.close()
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sockets.append(sock)
+            sock.bind(path)
+    except (IOError, OSError) as e:
+        close_listen_sockets(sockets)
+        print('Error opening listening socket:', e)
+        raise USBWatchDogError(1)
+    return sockets
+
+
+def close_listen_sockets(sockets):
+    # Removes the files of the Unix sockets that were bound, and nothing else
+    for sock in sockets:
+        path = sock.getsockname() if sock.family == socket.AF_UNIX else None
+        sock.close()
+        if path and os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+
+
+def receive_heartbeats(sock, tracker):
+    while 1:
+        try:
+            data, address = sock.recvfrom(256)
+        except (IOError, OSError) as e:
+            vprint('Stopped receiving heartbeats:', e)
+            return
+        sender = data.strip().decode('utf-8', 'replace')
+        if not sender:
+            # Keyed by host alone, as every new socket on a host sends from a new port
+            if isinstance(address, tuple):
+                sender = address[0]
+            elif address:
+                sender = address
+            else:
+                continue
+        tracker.beat(sender)
+
+
+def handle_aggregate_action(watchdog, args):
+    if not args.listen_udp and not args.listen_unix:
+        print('The aggregator needs --listen-udp or --listen-unix')
+        raise USBWatchDogError(1)
+    general_configure(watchdog, args)
+    print_settings(watchdog)
+
+    tracker = HeartbeatTracker(args.heartbeat_expiry, args.sender)
+    gate = QuorumGate(tracker, args.quorum, args.startup_grace)
+    exit_on_sigterm()
+    sockets = open_listen_sockets(args)
+    try:
+        for sock in sockets:
+            thread = threading.Thread(target=receive_heartbeats, args=(sock, tracker))
+            thread.daemon = True
+            thread.start()
+
+        try:
+            triggered, reboot_indicator, beacon_mode, counter = watchdog.get_status()
+        except (IOError, ValueError) as e:
+            print('Error obtaining USB Watchdog status:', e)
+            raise USBWatchDogError(1)
+        if beacon_mode:
+            run_beacon_loop(watchdog, args, gate)
+        else:
+            run_petter(watchdog, args, gate)
+    finally:
+        close_listen_sockets(sockets)
+
+
+def run_beacon_loop(watchdog, args, gate):
+    # The beacon is only written when the quorum changes, or after reopening the USB Watchdog
+    interval = 1.0 if args.pet_interval == 'auto' else args.pet_interval
+    metrics = PetMetrics(watchdog.serial_number)
+    start_metrics_exporters(args, [metrics])
+
+    notifier = SystemdNotifier()
+    recorder = start_flight_recorder(args)
+    try:
+        # Served like a broker's, as there is no petter to pause or reconfigure
+        control = start_control_server(args, watchdog, None, metrics)
+        try:
+            notifier.notify('READY=1')
+            state = None
+            while 1:
+                if recorder.dump_requested:
+                    recorder.dump_requested = False
+                    print_flight_events(recorder.snapshot())
+                status = None
+                try:
+                    status = watchdog.poll_status()
+                except (IOError, ValueError):
+                    pass
+                metrics.sampled(status)
+                healthy = gate.healthy()
+                if healthy != state:
+                    start = monotonic()
+                    try:
+                        vprint('Setting beacon to', 'off' if healthy else 'on')
+                        watchdog.set_beacon_state(not healthy)
+                        state = healthy
+                        recorder.record(FlightRecorder.EVENT_BEACON_OFF if healthy else FlightRecorder.EVENT_BEACON_ON,
+                                monotonic() - start, status)
+                    except (IOError, ValueError) as e:
+                        print('Error setting USB Watchdog beacon:', e)
+                        if not isinstance(watchdog, USBWatchDogManager):
+                            raise USBWatchDogError(1)
+                        metrics.usb_errors += 1
+                        recorder.record(FlightRecorder.EVENT_USB_ERROR, monotonic() - start, status)
+                        watchdog.reconnect()
+                        metrics.reconnects = watchdog.reconnects
+                        recorder.record(FlightRecorder.EVENT_RECONNECT)
+                        state = None
+                        continue
+                notifier.notify('WATCHDOG=1')
+                time.sleep(interval)
+        finally:
+            notifier.notify('STOPPING=1')
+            notifier.close()
+            if control is not None:
+                control.close()
+    finally:
+        recorder.close()
+
+
+class BeaconEngine(object):
+    # Coalesces events into the state the beacon should be in. A change of the wanted state only
+    # takes effect once it has held for the on or off delay, so an alert that flaps faster than
+    # that never reaches the USB Watchdog, and changes are at least min_interval apart.
+
+    def __init__(self, on_delay=0.0, off_delay=10.0, min_interval=1.0, expiry=0.0,
+            on_patterns=(), off_patterns=()):
+        self.on_delay = on_delay
+        self.off_delay = off_delay
+        self.min_interval = min_interval
+        self.expiry = expiry
+        self.on_patterns = on_patterns
+        self.off_patterns = off_patterns
+        # Time of the last 'on' event of every KEY that is on, kept oldest first
+        self.active = collections.OrderedDict()
+        self.condition = threading.Condition()
+        self.wanted = False
+        self.wanted_since = monotonic()
+        # Effective state of the beacon, which starts off, and when it last changed
+        self.state = False
+        self.changed = None
+        self.events = 0
+        # Set by events that arrived since next_state last looked
+        self.pending = False
+
+    def parse(self, line):
+        # Returns (on, key) for an event line, or None
+        words = line.split(None, 1)
+        if words and words[0] in ('on', 'off'):
+            return words[0] == 'on', words[1].strip() if len(words) > 1 else None
+        for on, patterns in ((True, self.on_patterns), (False, self.off_patterns)):
+            for pattern in patterns:
+                match = pattern.search(line)
+                if match:
+                    return on, match.groupdict().get('key')
+        return None
+
+    def feed(self, data):
+        for line in data.decode('utf-8', 'replace').splitlines():
+            event = self.parse(line.strip())
+            if event is None:
+                if line.strip():
+                    vprint('Ignoring beacon event', repr(line.strip()))
+                continue
+            self.event(*event)
+
+    def event(self, on, key=None, now=None):
+        if now is None:
+            now = monotonic()
+        with self.condition:
+            self.events += 1
+            if on:
+                key = key or ''
+                self.active.pop(key, None)
+                self.active[key] = now
+            elif key is None:
+                self.active.clear()
+            else:
+                self.active.pop(key, None)
+            self.__update(now)
+            self.pending = True
+            self.condition.notify_all()
+
+    def __update(self, now):
+        if self.expiry:
+            while self.active:
+                for key in self.active:
+                    break
+                if now - self.active[key] <= self.expiry:
+                    break
+                del self.active[key]
+        wanted = bool(self.active)
+        if wanted != self.wanted:
+            self.wanted = wanted
+            self.wanted_since = now
+
+    def next_state(self, now=None):
+        # Returns the state to write, or None and the longest time until there might be one
+        if now is None:
+            now = monotonic()
+        with self.condition:
+            self.pending = False
+            self.__update(now)
+            if self.state == self.wanted:
+                wait = None
+                if self.expiry and self.active:
+                    for key in self.active:
+                        break
+                    wait = self.active[key] + self.expiry - now
+                return None, wait
+            due = self.wanted_since + (self.on_delay if self.wanted else self.off_delay)
+            if self.changed is not None:
+                due = max(due, self.changed + self.min_interval)
+            if now < due:
+                return None, due - now
+            return self.wanted, None
+
+    def written(self, state, now=None):
+        with self.condition:
+            self.state = state
+            self.changed = monotonic() if now is None else now
+            self.events = 0
+
+    def wait(self, timeout):
+        with self.condition:
+            if not self.pending:
+                self.condition.wait(timeout)
+
+
+def read_beacon_fifo(fd, engine):
+    # Read unbuffered, so closing the pipe never waits on a blocked reader
+    partial = b''
+    while 1:
+        try:
+            data = os.read(fd, 4096)
+        except (IOError, OSError) as e:
+            vprint('Stopped reading beacon events:', e)
+            return
+        if not data:
+            return
+        lines, sep, partial = (partial + data).rpartition(b'\n')
+        if sep:
+            engine.feed(lines)
+
+
+def receive_beacon_events(sock, engine):
+    while 1:
+        try:
+            data, address = sock.recvfrom(4096)
+        except (IOError, OSError) as e:
+            vprint('Stopped receiving beacon events:', e)
+            return
+        engine.feed(data)
+
+
+def tail_beacon_log(path, engine, poll_interval=0.25):
+    # Follows the file by name: when it is replaced or truncated it is read again from the start.
+    # Lines already in the file when the engine starts are not events.
+    log = None
+    identity = None
+    partial = b''
+    at_start = True
     while 1:
-        handle_petting(watchdog)
-        time.sleep(args.pet_interval)
+        if log is None:
+            try:
+                log = open(path, 'rb')
+            except (IOError, OSError):
+                at_start = False
+                time.sleep(poll_interval)
+                continue
+            info = os.fstat(log.fileno())
+            identity = (info.st_dev, info.st_ino)
+            if at_start:
+                log.seek(0, os.SEEK_END)
+                at_start = False
+            partial = b''
+        data = log.readline()
+        if data:
+            if data.endswith(b'\n'):
+                engine.feed(partial + data)
+                partial = b''
+            else:
+                partial += data
+            continue
+        time.sleep(poll_interval)
+        try:
+            info = os.stat(path)
+        except (IOError, OSError):
+            continue
+        if (info.st_dev, info.st_ino) != identity or info.st_size < log.tell():
+            vprint('Reopening', path)
+            log.close()
+            log = None
+
+
+def open_beacon_fifos(args):
+    fds = []
+    try:
+        for path in args.listen_fifo:
+            if not os.path.exists(path):
+                os.mkfifo(path, 0o600)
+            elif not stat.S_ISFIFO(os.stat(path).st_mode):
+                raise IOError('%s is not a named pipe' % path)
+            # Also opened for writing, so the pipe does not end when its last writer closes it
+            fds.append(os.open(path, os.O_RDWR))
+    except (IOError, OSError) as e:
+        for fd in fds:
+            os.close(fd)
+        print('Error opening named pipe:', e)
+        raise USBWatchDogError(1)
+    return fds
+
+
+def handle_beacon_engine_action(watchdog, args):
+    if not (args.listen_fifo or args.listen_unix or args.listen_udp or args.tail):
+        print('The beacon engine needs --listen-fifo, --listen-unix, --listen-udp or --tail')
+        raise USBWatchDogError(1)
+    general_configure(watchdog, args)
+    try:
+        triggered, reboot_indicator, beacon_mode, counter = watchdog.get_status()
+    except (IOError, ValueError) as e:
+        print('Error obtaining USB Watchdog status:', e)
+        raise USBWatchDogError(1)
+    if not beacon_mode:
+        print('USB Watchdog is in watchdog mode!')
+        raise USBWatchDogError(1)
+
+    engine = BeaconEngine(args.on_delay, args.off_delay, args.min_change_interval, args.event_expiry,
+            args.on_pattern, args.off_pattern)
+    exit_on_sigterm()
+    fds = open_beacon_fifos(args)
+    sockets = []
+    try:
+        sockets = open_listen_sockets(args)
+        sources = [(read_beacon_fifo, fd) for fd in fds]
+        sources += [(receive_beacon_events, sock) for sock in sockets]
+        sources += [(tail_beacon_log, path) for path in args.tail]
+        for target, source in sources:
+            thread = threading.Thread(target=target, args=(source, engine))
+            thread.daemon = True
+            thread.start()
+        run_beacon_engine(watchdog, engine)
+    finally:
+        for fd in fds:
+            os.close(fd)
+        close_listen_sockets(sockets)
+
+
+def run_beacon_engine(watchdog, engine):
+    notifier = SystemdNotifier()
+    notifier.notify('READY=1')
+    # The effective state is written on start and after reopening the USB Watchdog, as its
+    # beacon is unknown then. Only changes of the effective state go through the engine.
+    restore = True
+    try:
+        while 1:
+            if restore:
+                wanted, wait = engine.state, None
+            else:
+                wanted, wait = engine.next_state()
+            if wanted is not None:
+                try:
+                    if restore:
+                        vprint('Setting beacon to', 'on' if wanted else 'off')
+                        watchdog.set_beacon_state(wanted)
+                        restore = False
+                        continue
+                    else:
+                        vprint('Setting beacon to', 'on' if wanted else 'off', 'after', engine.events, 'events')
+                        watchdog.set_beacon_state(wanted)
+                        engine.written(wanted)
+                except (IOError, ValueError) as e:
+                    print('Error setting USB Watchdog beacon:', e)
+                    watchdog.reconnect()
+                    restore = True
+                    continue
+            notifier.notify('WATCHDOG=1')
+            # Woken early by events; the timeout keeps systemd's watchdog fed
+            engine.wait(1.0 if wait is None else min(wait, 1.0))
+    finally:
+        notifier.notify('STOPPING=1')
+        notifier.close()
 
 
-def handle_rebooted_action(watchdog):
+def create_pet_scheduler(watchdog, args):
+    try:
+        device_timeout = watchdog.get_volatile_timeout()
+    except (IOError, ValueError) as e:
+        print('Error obtaining USB Watchdog timeout:', e)
+        raise USBWatchDogError(1)
+
+    def time_to_trigger():
+        try:
+            return watchdog.time_to_trigger()
+        except (IOError, ValueError):
+            return None
+
+    adaptive = args.pet_interval == 'auto'
+    scheduler = PetScheduler(1.0 if adaptive else args.pet_interval, args.jitter_budget,
+            args.missed_deadline, device_timeout, args.slack_warning, adaptive,
+            args.safety_margin, args.latency_window, time_to_trigger)
+    if not adaptive and scheduler.interval + scheduler.jitter_budget >= device_timeout:
+        print('Warning: pet interval of', args.pet_interval, 'seconds does not fit within the',
+                device_timeout, 'second USB Watchdog timeout')
+    return scheduler
+
+
+def run_pet_loop(watchdog, args, scheduler, health=None, metrics=None, notifier=None, recorder=None):
+    while not scheduler.stopped:
+        start = scheduler.wait()
+        if recorder is not None and recorder.dump_requested:
+            recorder.dump_requested = False
+            print_flight_events(recorder.snapshot())
+        if scheduler.paused():
+            scheduler.skipped(start)
+            if notifier is not None:
+                notifier.notify('WATCHDOG=1')
+            continue
+        status = None
+        try:
+            if metrics is not None or recorder is not None:
+                # Free while the status reader runs; a failure shows up in handle_petting
+                try:
+                    status = watchdog.poll_status()
+                except (IOError, ValueError):
+                    pass
+                if metrics is not None:
+                    metrics.sampled(status)
+            petted = handle_petting(watchdog, args, health)
+        except USBWatchDogIOError:
+            if not isinstance(watchdog, USBWatchDogManager):
+                raise
+            if metrics is not None:
+                metrics.usb_errors += 1
+            if recorder is not None:
+                recorder.record(FlightRecorder.EVENT_USB_ERROR, monotonic() - start, status)
+            # The deadline is left in place so the pet is retried as soon as the device is back
+            print('Reconnecting to USB Watchdog', watchdog.serial_number)
+            watchdog.reconnect()
+            if metrics is not None:
+                metrics.reconnects = watchdog.reconnects
+            if recorder is not None:
+                recorder.record(FlightRecorder.EVENT_RECONNECT)
+            continue
+        missed = scheduler.missed
+        if petted:
+            if metrics is not None:
+                metrics.petted(monotonic() - start)
+            if recorder is not None:
+                recorder.record(FlightRecorder.EVENT_PET, monotonic() - start, status)
+            scheduler.petted(start)
+        else:
+            if recorder is not None:
+                recorder.record(FlightRecorder.EVENT_SKIPPED, monotonic() - start, status)
+            if metrics is not None:
+                metrics.skipped += 1
+            scheduler.skipped(start)
+        if recorder is not None and scheduler.missed != missed:
+            recorder.record(FlightRecorder.EVENT_MISSED)
+        if metrics is not None:
+            metrics.missed = scheduler.missed
+            metrics.interval = scheduler.interval
+            if scheduler.time_to_trigger is not None:
+                # Brokered USB Watchdogs keep their countdown in the broker
+                countdown = getattr(watchdog, 'countdown', None)
+                metrics.estimated(scheduler.time_to_trigger(), countdown.rate if countdown is not None else 1.0)
+        # Sent for skipped pets too, as systemd is watching this loop rather than the host's health
+        if notifier is not None:
+            notifier.notify('WATCHDOG=1')
+
+
+class FleetMember(object):
+    # One USB Watchdog of the fleet, configured and pet from its own thread
+
+    def __init__(self, serial_number, args, health=None, transport=None):
+        self.serial_number = serial_number
+        self.args = args
+        self.transport = transport
+        self.health = health
+        self.metrics = PetMetrics(serial_number)
+        self.watchdog = None
+        self.scheduler = None
+        self.error_number = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def run(self):
+        watchdog = None
+        try:
+            try:
+                watchdog = USBWatchDogManager(self.serial_number, status_max_age=self.args.status_max_age,
+                        max_delay=self.args.reconnect_max_delay, transport=self.transport)
+                self.watchdog = watchdog
+                general_configure(watchdog, self.args)
+                self.scheduler = create_pet_scheduler(watchdog, self.args)
+                self.metrics.timeout = self.scheduler.device_timeout
+                run_pet_loop(watchdog, self.args, self.scheduler, self.health, self.metrics)
+            except (IOError, ValueError) as e:
+                print('Error opening USB Watchdog', self.serial_number + ':', e)
+                self.error_number = 1
+            except USBWatchDogError as e:
+                self.error_number = e.error_number
+        finally:
+            self.watchdog = None
+            try:
+                if watchdog is not None:
+                    watchdog.close()
+            except (IOError, ValueError) as e:
+                print('Error closing USB Watchdog', self.serial_number + ':', e)
+
+    def stop(self):
+        if self.watchdog is not None:
+            self.watchdog.stopped = True
+        if self.scheduler is not None:
+            self.scheduler.stopped = True
+
+    def status(self):
+        # Newest (triggered, reboot indicator, counter) sample from the status reader, or None
+        watchdog = self.watchdog
+        if watchdog is None:
+            return None
+        try:
+            status = watchdog.poll_status()
+        except (IOError, ValueError):
+            return None
+        if status is None:
+            return None
+        triggered, reboot_indicator, beacon_mode, counter = status
+        return triggered, reboot_indicator, counter
+
+    def report(self):
+        if self.error_number is not None:
+            print(self.serial_number + ':', 'stopped with error', self.error_number)
+        elif self.scheduler is not None:
+            status = self.status()
+            if status is None:
+                status = 'no recent status'
+            else:
+                status = 'triggered: %s, reboot indicator: %s, counter: %d' % status
+            print(self.serial_number + ':', self.scheduler.pets, 'pets,',
+                    self.scheduler.missed, 'missed deadlines,', status)
+        else:
+            print(self.serial_number + ':', 'starting')
+
+
+def handle_fleet_action(args, transport=None):
+    try:
+        serial_numbers = []
+        for device in USBWatchDog.enumerate(transport):
+            serial_number = str(device['serial_number'])
+            if serial_number in serial_numbers:
+                print('Ignoring USB Watchdog with duplicate serial number', serial_number)
+            else:
+                serial_numbers.append(serial_number)
+    except (IOError, ValueError, ImportError) as e:
+        print('Error enumerating USB Watchdogs:', e)
+        raise USBWatchDogError(1)
+
+    if not serial_numbers:
+        print('No USB Watchdogs found')
+        raise USBWatchDogError(1)
+
+    if args.pet_interval == 'auto':
+        vprint('Petting', len(serial_numbers), 'USB Watchdogs at adaptive intervals')
+    else:
+        vprint('Petting', len(serial_numbers), 'USB Watchdogs every', args.pet_interval, 'seconds')
+    # The health checks describe this host, so one monitor gates every member
+    health = create_health_monitor(args)
+    members = [FleetMember(serial_number, args, health, transport) for serial_number in serial_numbers]
+    start_metrics_exporters(args, [member.metrics for member in members])
+    for member in members:
+        member.thread.start()
+
+    try:
+        next_report = monotonic() + args.report_interval
+        while any(member.thread.is_alive() for member in members):
+            # Joining with a timeout keeps the main thread responsive to KeyboardInterrupt
+            for member in members:
+                member.thread.join(0.5)
+            if args.verbose and monotonic() >= next_report:
+                next_report += args.report_interval
+                for member in members:
+                    member.report()
+    finally:
+        # Let every member finish its current pet and close its USB Watchdog
+        for member in members:
+            member.stop()
+        for member in members:
+            member.thread.join((member.scheduler.interval if member.scheduler is not None else 0) + 1)
+
+    for member in members:
+        member.report()
+        if member.error_number:
+            raise USBWatchDogError(member.error_number)
+
+
+# Snapshot fields holding each setting of an apply() config, where they are named differently
+SNAPSHOT_FIELDS = {
+    'timeout': 'volatile_timeout',
+    'pinglight': 'volatile_pinglight',
+    'buzzer': 'volatile_buzzer',
+    'buzzer_frequency': 'volatile_buzzer_frequency',
+}
+
+def provision_device(path, serial_number, args, transport=None):
+    # Returns None once the USB Watchdog at path is provisioned and verified, or what went wrong
+    watchdog = None
+    try:
+        watchdog = USBWatchDog(cache=True, transport=transport, path=path)
+        watchdog.set_serial_number(serial_number)
+        transaction = create_transaction(watchdog, args)
+        transaction.commit()
+
+        # Verified against the device itself rather than the register cache
+        watchdog.invalidate()
+        snapshot = watchdog.snapshot(status=False)
+        mismatches = []
+        if snapshot.serial_number != serial_number:
+            mismatches.append('serial_number')
+        for key, value in sorted(transaction.config.items()):
+            if key == 'clear_reboot_indicator':
+                if value and snapshot.reboot_indicator:
+                    mismatches.append('reboot_indicator')
+            elif getattr(snapshot, SNAPSHOT_FIELDS.get(key, key)) != value:
+                mismatches.append(key)
+        if mismatches:
+            return 'verification failed for ' + ', '.join(mismatches)
+        return None
+    except (IOError, ValueError) as e:
+        return str(e)
+    finally:
+        if watchdog is not None:
+            try:
+                watchdog.close()
+            except (IOError, ValueError):
+                pass
+
+
+def handle_provision_action(args, transport=None):
+    try:
+        devices = USBWatchDog.enumerate(transport)
+    except (IOError, ValueError, ImportError) as e:
+        print('Error enumerating USB Watchdogs:', e)
+        raise USBWatchDogError(1)
+
+    in_use = set(str(device['serial_number']) for device in devices)
+    paths = sorted(device['path'] for device in devices
+            if str(device['serial_number']) == USBWatchDog.UNPROVISIONED_SERIAL_NUMBER)
+    if not paths:
+        print('No unprovisioned USB Watchdogs found')
+        raise USBWatchDogError(1)
+
+    # Serial numbers are assigned up front so the result does not depend on thread scheduling.
+    # Each one joins in_use as it is assigned, so no two devices can be given the same one.
+    assignments = []
+    results = {}
+    if args.serial_numbers is not None:
+        for path, serial_number in zip(paths, args.serial_numbers):
+            assignments.append((path, serial_number))
+            if serial_number in in_use:
+                results[path] = 'serial number is already in use'
+            in_use.add(serial_number)
+    else:
+        counter = args.serial_start
+        for path in paths:
+            while args.serial_pattern % counter in in_use:
+                counter += 1
+            assignments.append((path, args.serial_pattern % counter))
+            in_use.add(args.serial_pattern % counter)
+            counter += 1
+
+    pending = collections.deque(assignment for assignment in assignments if assignment[0] not in results)
+    def work():
+        while 1:
+            try:
+                path, serial_number = pending.popleft()
+            except IndexError:
+                return
+            results[path] = provision_device(path, serial_number, args, transport)
+
+    vprint('Provisioning', len(assignments), 'of', len(paths), 'unprovisioned USB Watchdogs')
+    threads = [threading.Thread(target=work) for i in range(min(args.jobs, len(pending)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        # Joining with a timeout keeps the main thread responsive to KeyboardInterrupt
+        while thread.is_alive():
+            thread.join(0.5)
+
+    failures = 0
+    for path, serial_number in assignments:
+        error = results.get(path, 'not provisioned')
+        if error is not None:
+            failures += 1
+        print(path.decode('ascii', 'replace'), serial_number, 'ok' if error is None else 'FAILED: ' + error)
+    for path in paths[len(assignments):]:
+        failures += 1
+        print(path.decode('ascii', 'replace'), '-', 'FAILED: no serial number left to assign')
+
+    print('Provisioned', len(paths) - failures, 'of', len(paths), 'USB Watchdogs')
+    if failures:
+        raise USBWatchDogError(1)
+
+
+def handle_rebooted_action(watchdog, args):
     try:
         triggered, reboot_indicator, beacon_mode, counter = watchdog.get_status()
-    except (IOError, ValueError), e:
+    except (IOError, ValueError) as e:
         print('Error getting USB Watchdog status:', e)
         raise USBWatchDogError(1)
 
@@ -552,10 +3626,10 @@ def handle_rebooted_action(watchdog):
         raise USBWatchDogError(2)
 
 
-def handle_triggered_action(watchdog):
+def handle_triggered_action(watchdog, args):
     try:
         triggered, reboot_indicator, beacon_mode, counter = watchdog.get_status()
-    except (IOError, ValueError), e:
+    except (IOError, ValueError) as e:
         print('Error getting USB Watchdog status:', e)
         raise USBWatchDogError(1)
 
@@ -564,10 +3638,10 @@ def handle_triggered_action(watchdog):
         raise USBWatchDogError(3)
 
 
-def handle_mode_action(watchdog):
+def handle_mode_action(watchdog, args):
     try:
         triggered, reboot_indicator, beacon_mode, counter = watchdog.get_status()
-    except (IOError, ValueError), e:
+    except (IOError, ValueError) as e:
         print('Error getting USB Watchdog status:', e)
         raise USBWatchDogError(1)
 
@@ -579,11 +3653,25 @@ def handle_mode_action(watchdog):
         raise USBWatchDogError(0)
 
 
-def handle_beacon_action(watchdog):
-    general_configure(watchdog)
+def handle_status_action(watchdog, args):
+    try:
+        snapshot = watchdog.snapshot()
+    except (IOError, ValueError) as e:
+        print('Error obtaining USB Watchdog status:', e)
+        raise USBWatchDogError(1)
+
+    if args.json:
+        print(json.dumps(snapshot_to_dict(snapshot), sort_keys=True))
+    else:
+        print('Version:', '%d.%d' % snapshot.version)
+        print_snapshot(snapshot)
+
+
+def handle_beacon_action(watchdog, args):
+    general_configure(watchdog, args)
     try:
         triggered, reboot_indicator, beacon_mode, counter = watchdog.get_status()
-    except (IOError, ValueError), e:
+    except (IOError, ValueError) as e:
         print('Error obtaining USB Watchdog status:', e)
         raise USBWatchDogError(1)
 
@@ -594,39 +3682,271 @@ def handle_beacon_action(watchdog):
     try:
         vprint('Setting beacon to', args.beacon_state)
         watchdog.set_beacon_state(True if args.beacon_state == 'on' else False)
-    except (IOError, ValueError), e:
+    except (IOError, ValueError) as e:
         print('Error petting USB Watchdog:', e)
         raise USBWatchDogError(1)
 
 
-def main():
+def handle_broker_action(watchdog, args):
+    if args.control_socket is None and not systemd_listen_fds():
+        print('The broker needs --control-socket')
+        raise USBWatchDogError(1)
+    print_settings(watchdog)
+    exit_on_sigterm()
+
+    notifier = SystemdNotifier()
+    control = start_control_server(args, watchdog)
+    try:
+        notifier.notify('READY=1')
+        # Requests are served from the control server's threads; this one only notices when the
+        # USB Watchdog goes away and reopens it
+        while 1:
+            time.sleep(1)
+            try:
+                watchdog.get_status()
+            except (IOError, ValueError) as e:
+                print('Reconnecting to USB Watchdog', watchdog.serial_number + ':', e)
+                watchdog.reconnect()
+            notifier.notify('WATCHDOG=1')
+    finally:
+        notifier.notify('STOPPING=1')
+        notifier.close()
+        control.close()
+
+
+def handle_invalidate_path_cache_action(args, transport=None):
+    if not isinstance(transport, PathCacheTransport):
+        vprint('No device path cache in use')
+        return
+    try:
+        transport.invalidate()
+    except (IOError, OSError) as e:
+        print('Error invalidating device path cache:', e)
+        raise USBWatchDogError(1)
+
+
+def handle_dump_action(args):
+    try:
+        with open(args.path, 'rb') as f:
+            events = FlightRecorder.events(f.read())
+    except (IOError, OSError, ValueError, struct.error) as e:
+        print('Error reading flight recorder:', e)
+        raise USBWatchDogError(1)
+    print_flight_events(events, args.json)
+
+
+def summarize_samples(samples):
+    samples = sorted(samples)
+    # Nearest-rank percentiles
+    percentile = lambda fraction: samples[max(0, int(-(-fraction * len(samples) // 1)) - 1)]
+    return {
+        'iterations': len(samples),
+        'p50': percentile(0.5),
+        'p99': percentile(0.99),
+        'max': samples[-1],
+        'mean': sum(samples) / len(samples),
+    }
+
+
+def time_operation(function, iterations, before=None):
+    samples = []
+    # Keep the messages printed by the handlers out of the JSON report
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        for i in range(iterations):
+            if before is not None:
+                before()
+            start = monotonic()
+            try:
+                function()
+            except USBWatchDogError as e:
+                # Handlers report device states through error numbers; only 1 is a failure
+                if e.error_number == 1:
+                    raise
+            samples.append(monotonic() - start)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return summarize_samples(samples)
+
+
+def measure_pet_jitter(watchdog, pets, interval):
+    # Lateness of each pet against its deadline and the spread of the resulting pet intervals
+    scheduler = PetScheduler(interval, jitter_budget=float('inf'))
+    lateness = []
+    intervals = []
+    previous = None
+    for i in range(pets):
+        start = scheduler.wait()
+        lateness.append(start - scheduler.deadline)
+        watchdog.pet()
+        if previous is not None:
+            intervals.append(abs(start - previous - interval))
+        previous = start
+        scheduler.petted(start)
+    return {
+        'interval': interval,
+        'lateness': summarize_samples(lateness),
+        'interval_error': summarize_samples(intervals or [0.0]),
+    }
+
+
+def run_benchmark(watchdog, iterations=50, jitter_pets=50, jitter_interval=0.1):
+    # watchdog must have its register cache enabled; it is invalidated before every
+    # uncached sample so those measure real USB transfers
+    timeout = watchdog.get_volatile_timeout()
+    pinglight = watchdog.get_volatile_pinglight()
+    buzzer = watchdog.get_volatile_buzzer()
+    frequency = watchdog.get_volatile_buzzer_frequency()
+    parser = build_parser()
+    pet_args = parser.parse_args(['oneshot'])
+    detect_args = parser.parse_args(['oneshot', '--detect-reboot', '--detect-triggered'])
+    configure_args = parser.parse_args(['configure', '--timeout', str(timeout),
+            '--pinglight', 'on' if pinglight else 'off', '--buzzer', 'on' if buzzer else 'off',
+            '--buzzer-frequency', str(frequency)])
+
+    operations = [
+        ('get_version', watchdog.get_version),
+        ('get_serial_number', watchdog.get_serial_number),
+        ('get_nonvolatile_timeout', watchdog.get_nonvolatile_timeout),
+        ('get_volatile_timeout', watchdog.get_volatile_timeout),
+        ('get_nonvolatile_pinglight', watchdog.get_nonvolatile_pinglight),
+        ('get_nonvolatile_buzzer', watchdog.get_nonvolatile_buzzer),
+        ('get_volatile_pinglight', watchdog.get_volatile_pinglight),
+        ('get_volatile_buzzer', watchdog.get_volatile_buzzer),
+        ('get_nonvolatile_buzzer_frequency', watchdog.get_nonvolatile_buzzer_frequency),
+        ('get_volatile_buzzer_frequency', watchdog.get_volatile_buzzer_frequency),
+        ('get_reboot_indicator', watchdog.get_reboot_indicator),
+        ('get_nonvolatile_beacon_mode', watchdog.get_nonvolatile_beacon_mode),
+        ('set_volatile_timeout', lambda: watchdog.set_volatile_timeout(timeout)),
+        ('set_volatile_pinglight', lambda: watchdog.set_volatile_pinglight(pinglight)),
+        ('set_volatile_buzzer', lambda: watchdog.set_volatile_buzzer(buzzer)),
+        ('set_volatile_buzzer_frequency', lambda: watchdog.set_volatile_buzzer_frequency(frequency)),
+        ('get_status', watchdog.get_status),
+        ('poll_status', watchdog.poll_status),
+        ('pet', watchdog.pet),
+        ('print_settings', lambda: print_settings(watchdog)),
+        ('general_configure', lambda: general_configure(watchdog, configure_args)),
+        ('handle_petting', lambda: handle_petting(watchdog, pet_args)),
+        ('handle_petting_detect', lambda: handle_petting(watchdog, detect_args)),
+        ('handle_rebooted_action', lambda: handle_rebooted_action(watchdog, pet_args)),
+        ('handle_triggered_action', lambda: handle_triggered_action(watchdog, pet_args)),
+        ('handle_mode_action', lambda: handle_mode_action(watchdog, pet_args)),
+    ]
+
+    results = {}
+    for name, function in operations:
+        results[name] = time_operation(function, iterations, watchdog.invalidate)
+
+    # The same paths once the register cache and the background status reader are warm
+    watchdog.refresh()
+    results['print_settings_cached'] = time_operation(lambda: print_settings(watchdog), iterations)
+    results['general_configure_cached'] = time_operation(
+            lambda: general_configure(watchdog, configure_args), iterations)
+    watchdog.start_status_reader()
+    try:
+        results['get_status_reader'] = time_operation(watchdog.get_status, iterations)
+        results['handle_petting_detect_reader'] = time_operation(
+                lambda: handle_petting(watchdog, detect_args), iterations)
+    finally:
+        watchdog.stop_status_reader()
+
+    return {
+        'operations': results,
+        'pet_jitter': measure_pet_jitter(watchdog, jitter_pets, jitter_interval),
+    }
+
+
+def handle_bench_action(watchdog, args):
+    try:
+        results = run_benchmark(watchdog, args.iterations, args.jitter_pets, args.jitter_interval)
+    except (IOError, ValueError) as e:
+        print('Error benchmarking USB Watchdog:', e)
+        raise USBWatchDogError(1)
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+def create_transport(args):
+    if args.simulate is None:
+        if not args.path_cache:
+            return None
+        return PathCacheTransport(HIDTransport(), args.path_cache)
+    return SimulatedTransport(args.simulate, latency=args.simulate_latency,
+            failure_rate=args.simulate_failure_rate)
+
+
+def main(argv=None):
+    global verbose
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.action == 'aggregate' and args.sender and args.quorum > len(set(args.sender)):
+        parser.error('--quorum is larger than the number of --sender entries')
+    verbose = args.verbose
+
+    transport = create_transport(args)
     watchdog = None
     try:
         try:
+            if args.action == 'fleet':
+                handle_fleet_action(args, transport)
+                raise USBWatchDogError(0)
+            elif args.action == 'dump':
+                handle_dump_action(args)
+                raise USBWatchDogError(0)
+            elif args.action == 'provision':
+                handle_provision_action(args, transport)
+                raise USBWatchDogError(0)
+            elif args.action == 'invalidate-path-cache':
+                handle_invalidate_path_cache_action(args, transport)
+                raise USBWatchDogError(0)
+
             try:
-                watchdog = USBWatchDog(args.serial_number)
-            except (IOError, ValueError), e:
+                if args.action in ('continuous', 'aggregate', 'beacon-engine'):
+                    watchdog = USBWatchDogManager(args.serial_number, status_max_age=args.status_max_age,
+                            max_delay=args.reconnect_max_delay, transport=transport)
+                elif args.action == 'broker':
+                    watchdog = USBWatchDogManager(args.serial_number, status_max_age=args.status_max_age,
+                            transport=transport)
+                else:
+                    if args.action != 'bench':
+                        watchdog = open_control_client(args)
+                    if watchdog is None:
+                        watchdog = USBWatchDog(args.serial_number, cache=True, transport=transport)
+                        if args.action not in ('configure', 'bench'):
+                            watchdog.start_status_reader(args.status_max_age)
+            except (IOError, ValueError, ImportError) as e:
                 print('Error opening USB Watchdog:', e)
                 exit(1)
 
             if args.action == 'configure':
-                handle_configure_action(watchdog)
+                handle_configure_action(watchdog, args)
             elif args.action == 'oneshot': 
-                handle_oneshot_action(watchdog)
+                handle_oneshot_action(watchdog, args)
             elif args.action == 'continuous':
-                handle_continuous_action(watchdog)
+                handle_continuous_action(watchdog, args)
+            elif args.action == 'broker':
+                handle_broker_action(watchdog, args)
+            elif args.action == 'aggregate':
+                handle_aggregate_action(watchdog, args)
+            elif args.action == 'beacon-engine':
+                handle_beacon_engine_action(watchdog, args)
             elif args.action == 'rebooted':
-                handle_rebooted_action(watchdog)
+                handle_rebooted_action(watchdog, args)
             elif args.action == 'triggered': 
-                handle_triggered_action(watchdog)
+                handle_triggered_action(watchdog, args)
             elif args.action == 'mode': 
-                handle_mode_action(watchdog)
+                handle_mode_action(watchdog, args)
             elif args.action == 'beacon': 
-                handle_beacon_action(watchdog)
+                handle_beacon_action(watchdog, args)
+            elif args.action == 'status':
+                handle_status_action(watchdog, args)
+            elif args.action == 'bench':
+                handle_bench_action(watchdog, args)
 
         except KeyboardInterrupt:        
             raise USBWatchDogError(1)
-    except USBWatchDogError, e:
+    except USBWatchDogError as e:
         error_number = e.error_number
     else:
         error_number = 0
@@ -635,7 +3955,7 @@ def main():
             if watchdog is not None:
                 #TODO see if this does anything
                 watchdog.close()
-        except (IOError, ValueError), e:
+        except (IOError, ValueError) as e:
             print('Error closing USB Watchdog:', e)
             exit(1)
 